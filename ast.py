@@ -13,10 +13,38 @@ class ASTExpr:
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    # Compile AST into a CExpr
-    def compile(self, env):
+    # Sub-expressions which must be compiled first, each paired with the
+    # environment to compile it in
+    def subExprs(self, deEnv):
         pass
 
+    @abstractmethod
+    # Combine the compiled sub-expressions into a CExpr
+    def build(self, deEnv, compiled):
+        pass
+
+    def compile(self, deEnv):
+        # Compile AST into a CExpr. An explicit stack is used rather than
+        # recursion so that program size is not bounded by the Python stack
+        results = []
+        stack = [(self, deEnv, None)]
+
+        while len(stack) > 0:
+            ast, env, numSubs = stack.pop()
+
+            if numSubs is None:
+                subs = ast.subExprs(env)
+                stack.append((ast, env, len(subs)))
+                for sub in reversed(subs):
+                    stack.append(sub + (None,))
+            else:
+                start = len(results) - numSubs
+                compiled = results[start:]
+                del results[start:]
+                results.append(ast.build(env, compiled))
+
+        return results[0]
+
 '''
 ASTs related to booleans
 '''
@@ -31,7 +59,10 @@ class ASTBool(ASTExpr):
     def __repr__(self):
         return "ASTBool(" + str(self.state) + ")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return []
+
+    def build(self, deEnv, compiled):
         return CBool(self.state)
 
 class ASTIf(ASTExpr):
@@ -48,12 +79,15 @@ class ASTIf(ASTExpr):
             str(self.ifBranch) + ", " + \
             str(self.elseBranch) + ")"
 
-    def compile(self, deEnv):
-        return CIf(
-            self.cond.compile(deEnv),
-            self.ifBranch.compile(deEnv),
-            self.elseBranch.compile(deEnv)
-        )
+    def subExprs(self, deEnv):
+        return [
+            (self.cond, deEnv),
+            (self.ifBranch, deEnv),
+            (self.elseBranch, deEnv)
+        ]
+
+    def build(self, deEnv, compiled):
+        return CIf(*compiled)
 
 '''
 ASTs related to arithmetic
@@ -69,7 +103,10 @@ class ASTNum(ASTExpr):
     def __repr__(self):
         return "ASTNum(" + str(self.value) + ")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return []
+
+    def build(self, deEnv, compiled):
         return CNum(self.value)
 
 '''
@@ -86,8 +123,11 @@ class ASTCons(ASTExpr):
     def __repr__(self):
         return "ASTCons(" + str(self.head) + ", " + str(self.tail) + ")"
 
-    def compile(self, deEnv):
-        return CCons(self.head.compile(deEnv), self.tail.compile(deEnv))
+    def subExprs(self, deEnv):
+        return [(self.head, deEnv), (self.tail, deEnv)]
+
+    def build(self, deEnv, compiled):
+        return CCons(*compiled)
 
 class ASTCar(ASTExpr):
     """Abstract syntax tree for a car datatype"""
@@ -99,9 +139,12 @@ class ASTCar(ASTExpr):
     def __repr__(self):
         return "ASTCar(" + str(self.pair) + ")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return [(self.pair, deEnv)]
+
+    def build(self, deEnv, compiled):
         # Fix this to make sure cons can be evaluated lazily
-        return CCar(self.pair.compile(deEnv))
+        return CCar(compiled[0])
 
 class ASTCdr(ASTExpr):
     """Abstract syntax tree for a car datatype"""
@@ -113,9 +156,12 @@ class ASTCdr(ASTExpr):
     def __repr__(self):
         return "ASTCdr(" + str(self.pair) + ")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return [(self.pair, deEnv)]
+
+    def build(self, deEnv, compiled):
         # Fix this to make sure cons can be evaluated lazily
-        return CCdr(self.pair.compile(deEnv))
+        return CCdr(compiled[0])
 
 '''
 ASTs related to functions
@@ -134,21 +180,19 @@ class ASTFun(ASTExpr):
     def __repr__(self):
         return "ASTFun(" + str(self.ids) + ", " + str(self.body) + ")"
 
-    def compile(self, deEnv):
-        # Curry any multi-argument functions during compilation
-        if len(self.ids) == 1:
-            # If there is only one argument (base case) compile the body with an
-            # environment extended with the argument name
-            return CFun(self.body.compile(DeExtend(deEnv, self.ids[0].name)))
-        else:
-            # If there are multiple, compile recursively
-            return ASTFun(
-                self.ids[1:],
-                ASTFun(
-                    [self.ids[0]],
-                    self.body
-                )
-            ).compile(deEnv)
+    def subExprs(self, deEnv):
+        # Compile the body with an environment extended with every argument
+        # name, the first argument being bound outermost
+        for id in self.ids:
+            deEnv = DeExtend(deEnv, id.name)
+        return [(self.body, deEnv)]
+
+    def build(self, deEnv, compiled):
+        # Curry any multi-argument functions into nested single-argument ones
+        fun = compiled[0]
+        for id in self.ids:
+            fun = CFun(fun)
+        return fun
 
 class ASTCall(ASTExpr):
     """Abstract syntax tree for a function invocation data type"""
@@ -163,24 +207,119 @@ class ASTCall(ASTExpr):
     def __repr__(self):
         return "ASTCall(" + str(self.funExpr) + ", " + str(self.argExprs) + ")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return [(expr, deEnv) for expr in [self.funExpr] + self.argExprs]
+
+    def build(self, deEnv, compiled):
+        # Fully-applied calls to primitives which have not been shadowed skip
+        # the curried call chain entirely
+        if isinstance(self.funExpr, ASTId):
+            prim = deEnv.lookupPrim(self.funExpr.name)
+            if prim is not None and prim[0] == len(self.argExprs):
+                return CPrimOp(self.funExpr.name, prim[1], compiled[1:])
+
         # Function invocation will follow a similar currying pattern as function
         # definitions
-        if len(self.argExprs) == 1:
-            # If there is only one argument (base case), compilation is easy
-            return CCall(
-                self.funExpr.compile(deEnv),
-                self.argExprs[0].compile(deEnv)
-            )
-        else:
-            # If there are multiple, compile recursively
-            return ASTCall(
-                ASTCall(
-                    self.funExpr,
-                    [self.argExprs[0]]
-                ),
-                self.argExprs[1:]
-            ).compile(deEnv)
+        call = compiled[0]
+        for arg in compiled[1:]:
+            call = CCall(call, arg)
+        return call
+
+'''
+ASTs related to loops
+'''
+
+class ASTLoop(ASTExpr):
+    """Abstract syntax tree for a loop with rebindable variables"""
+    def __init__(self, ids, inits, body):
+        self.ids, self.inits, self.body = ids, inits, body
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "ASTLoop(" + \
+            str(self.ids) + ", " + \
+            str(self.inits) + ", " + \
+            str(self.body) + ")"
+
+    def checkRecurs(self):
+        # Ensure every recur targeting this loop is in tail position, and
+        # note whether the loop variables can be captured by a closure
+        self.captured = False
+        stack = [(self.body, True)]
+        while len(stack) > 0:
+            ast, tail = stack.pop()
+
+            if isinstance(ast, ASTRecur):
+                if not tail:
+                    raise LispCompilationException(
+                        "compile",
+                        "recur must be in tail position of a loop"
+                    )
+                elif len(ast.argExprs) != len(self.ids):
+                    raise LispCompilationException(
+                        "compile",
+                        "recur expects " + str(len(self.ids)) + \
+                        " arguments but got " + str(len(ast.argExprs))
+                    )
+                ast.loop = self
+                stack.extend((arg, False) for arg in ast.argExprs)
+            elif isinstance(ast, ASTIf):
+                stack.extend([
+                    (ast.cond, False),
+                    (ast.ifBranch, tail),
+                    (ast.elseBranch, tail)
+                ])
+            elif isinstance(ast, ASTCond):
+                for test, branch in ast.branches:
+                    stack.extend([(test, False), (branch, tail)])
+            elif isinstance(ast, ASTCase):
+                stack.append((ast.key, False))
+                stack.extend((body, tail) for body in ast.bodies)
+            elif isinstance(ast, ASTWith):
+                stack.extend((expr, False) for expr in ast.exprs)
+                stack.append((ast.body, tail))
+            elif isinstance(ast, ASTLoop):
+                # A nested loop's body is checked against the nested loop, and
+                # its closures capture a copy of this loop's variables
+                stack.extend((init, False) for init in ast.inits)
+            elif isinstance(ast, ASTFun):
+                self.captured = True
+                stack.append((ast.body, False))
+            else:
+                stack.extend((sub, False) for sub, env in ast.subExprs(None))
+
+    def subExprs(self, deEnv):
+        self.checkRecurs()
+
+        # Each initial value can see the variables before it, like let
+        subs = []
+        for id, init in zip(self.ids, self.inits):
+            subs.append((init, deEnv))
+            deEnv = DeExtend(deEnv, id.name)
+        return subs + [(self.body, deEnv)]
+
+    def build(self, deEnv, compiled):
+        return CLoop(compiled[:-1], compiled[-1], not self.captured)
+
+class ASTRecur(ASTExpr):
+    """Abstract syntax tree for rebinding the variables of a loop"""
+    def __init__(self, argExprs):
+        self.argExprs = argExprs
+        self.loop = None
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "ASTRecur(" + str(self.argExprs) + ")"
+
+    def subExprs(self, deEnv):
+        return [(arg, deEnv) for arg in self.argExprs]
+
+    def build(self, deEnv, compiled):
+        if self.loop is None:
+            raise LispCompilationException("compile", "recur outside of loop")
+        return CRecur(compiled)
 
 '''
 ASTs related to symbols
@@ -196,10 +335,28 @@ class ASTSym(ASTExpr):
     def __repr__(self):
         return "ASTId(\"" + str(self.name) + "\")"
 
-    def compile(self, deEnv):
-        # Compile the identifier name down into a de-Bruijn index
+    def subExprs(self, deEnv):
+        return []
+
+    def build(self, deEnv, compiled):
         return CSym(self.name)
 
+class ASTStr(ASTExpr):
+    """Abstract syntax tree for a string literal"""
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "ASTStr(" + repr(self.text) + ")"
+
+    def subExprs(self, deEnv):
+        return []
+
+    def build(self, deEnv, compiled):
+        return CStr(self.text)
+
 '''
 ASTs related to identifiers
 '''
@@ -214,7 +371,15 @@ class ASTId(ASTExpr):
     def __repr__(self):
         return "ASTId(\"" + str(self.name) + "\")"
 
-    def compile(self, deEnv):
+    def subExprs(self, deEnv):
+        return []
+
+    def build(self, deEnv, compiled):
+        # Top-level bindings are referenced directly
+        glob = deEnv.lookupGlobal(self.name)
+        if glob is not None:
+            return CGlobal(glob)
+
         # Compile the identifier name down into a de-Bruijn index
         return CRef(deEnv.lookup(self.name))
 
@@ -233,15 +398,15 @@ class ASTList(ASTExpr):
     def __repr__(self):
         return "ASTList(" + str(self.elements) + ")"
 
-    def compile(self, deEnv):
-        if len(self.elements) == 0:
-            # In Lisp, '() == nil
-            return ASTBool(False).compile(deEnv)
-        else:
-            return ASTCons(
-                self.elements[0],
-                ASTList(self.elements[1:])
-            ).compile(deEnv)
+    def subExprs(self, deEnv):
+        return [(element, deEnv) for element in self.elements]
+
+    def build(self, deEnv, compiled):
+        # In Lisp, '() == nil
+        lst = CBool(False)
+        for element in reversed(compiled):
+            lst = CCons(element, lst)
+        return lst
 
 class ASTWith(ASTExpr):
     """Abstract syntax tree for a local binding"""
@@ -260,26 +425,19 @@ class ASTWith(ASTExpr):
             str(self.exprs) + ", " + \
             str(self.body) + ")"
 
-    def compile(self, deEnv):
-        if len(self.ids) == 1:
-            return ASTCall(
-                ASTFun(
-                    self.ids[0],
-                    self.body),
-                self.exprs[0]
-            ).compile(deEnv)
-        else:
-            return ASTCall(
-                ASTFun(
-                    self.ids[0],
-                    ASTWith(
-                        self.ids[1:],
-                        self.exprs[1:],
-                        self.body
-                    ),
-                ),
-                self.exprs[0]
-            ).compile(deEnv)
+    def subExprs(self, deEnv):
+        # Each binding can see the ones before it
+        subs = []
+        for id, expr in zip(self.ids, self.exprs):
+            subs.append((expr, deEnv))
+            deEnv = DeExtend(deEnv, id.name)
+        return subs + [(self.body, deEnv)]
+
+    def build(self, deEnv, compiled):
+        body = compiled[-1]
+        for expr in reversed(compiled[:-1]):
+            body = CLet(expr, body)
+        return body
 
 
 class ASTCond(ASTExpr):
@@ -292,19 +450,46 @@ class ASTCond(ASTExpr):
     def __repr__(self):
         return "ASTBind(" + ", ".join(map(str, self.branches)) + ")"
 
-    def compile(self, deEnv):
-        first = self.branches[0]
-        rest = self.branches[1:]
+    def subExprs(self, deEnv):
+        return [(expr, deEnv) for branch in self.branches for expr in branch]
 
-        elseBranch = ASTBool(False)
-        if len(rest) > 0:
-            elseBranch = ASTCond(rest)
+    def build(self, deEnv, compiled):
+        # Chain branches into nested conditionals, falling through to nil
+        cond = CBool(False)
+        for i in range(len(compiled) - 2, -1, -2):
+            cond = CIf(compiled[i], compiled[i + 1], cond)
+        return cond
 
-        return ASTIf(
-            first[0],
-            first[1],
-            elseBranch
-        ).compile(deEnv)
+class ASTCase(ASTExpr):
+    """Abstract syntax tree for dispatch on a key among literal cases"""
+    def __init__(self, key, cases, bodies):
+        # cases[i] lists the literal values (numbers, symbols or booleans)
+        # selecting bodies[i], or is None for the default branch
+        self.key, self.cases, self.bodies = key, cases, bodies
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "ASTCase(" + str(self.key) + ", " + \
+            ", ".join(
+                str(case) + ": " + str(body)
+                for case, body in zip(self.cases, self.bodies)
+            ) + ")"
+
+    def subExprs(self, deEnv):
+        return [(self.key, deEnv)] + [(body, deEnv) for body in self.bodies]
+
+    def build(self, deEnv, compiled):
+        # Unlike the nested conditionals of cond, the branch is selected in
+        # one step however many cases there are
+        cases, branches, default = [], [], CBool(False)
+        for case, branch in zip(self.cases, compiled[1:]):
+            if case is None:
+                default = branch
+            else:
+                cases.append(tuple(CCase.tag(val) for val in case))
+                branches.append(branch)
+        return CCase(compiled[0], tuple(cases), branches, default)
 
 
 '''
@@ -365,6 +550,30 @@ class ASTTest(unittest.TestCase):
             self.emptyEnv
         )
 
+    def test_prim_call(self):
+        add = Global("+", None, (2, lambda x, y: x + y))
+        deEnv = DeEnv.fromList(["x"], DeGlobalEnv({"+": add}))
+
+        self.assertCompilesTo(
+            ASTCall(ASTId("+"), [ASTId("x"), ASTNum(1)]),
+            CPrimOp("+", add.prim[1], [CRef(1), CNum(1)]),
+            DeExtend(deEnv, "y")
+        )
+
+        # Partial application still goes through the curried primitive
+        self.assertCompilesTo(
+            ASTCall(ASTId("+"), [ASTNum(1)]),
+            CCall(CGlobal(add), CNum(1)),
+            deEnv
+        )
+
+        # A local binding shadowing the primitive must not be bypassed
+        self.assertCompilesTo(
+            ASTCall(ASTId("+"), [ASTNum(1), ASTNum(2)]),
+            CCall(CCall(CRef(0), CNum(1)), CNum(2)),
+            DeExtend(deEnv, "+")
+        )
+
     def test_list(self):
         deEnv = self.emptyEnv
 
@@ -377,5 +586,66 @@ class ASTTest(unittest.TestCase):
             ).compile(deEnv)
         )
 
+    def test_fun_args(self):
+        # The first argument is bound by the outermost function
+        self.assertCompilesTo(
+            ASTFun([ASTId("x"), ASTId("y")], ASTId("x")),
+            CFun(CFun(CRef(1))),
+            self.emptyEnv
+        )
+
+    def test_loop(self):
+        loop = ASTLoop(
+            [ASTId("i")],
+            [ASTNum(0)],
+            ASTIf(ASTId("i"), ASTId("i"), ASTRecur([ASTBool(True)]))
+        )
+        self.assertCompilesTo(
+            loop,
+            CLoop(
+                [CNum(0)],
+                CIf(CRef(0), CRef(0), CRecur([CBool(True)])),
+                True
+            ),
+            self.emptyEnv
+        )
+
+        # Loops whose variables may be captured rebind them in a fresh frame
+        captured = ASTLoop([ASTId("i")], [ASTNum(0)], ASTFun(ASTId("x"), loop))
+        self.assertFalse(captured.compile(self.emptyEnv).inPlace)
+
+    def test_recur_errors(self):
+        recur = ASTRecur([ASTNum(1)])
+        bad = [
+            recur,
+            ASTLoop([ASTId("i")], [ASTNum(0)], ASTCons(recur, ASTNum(1))),
+            ASTLoop([ASTId("i")], [ASTNum(0)], ASTFun(ASTId("x"), recur)),
+            ASTLoop([ASTId("i"), ASTId("j")], [ASTNum(0), ASTNum(0)], recur)
+        ]
+        for ast in bad:
+            recur.loop = None
+            self.assertRaises(
+                LispCompilationException,
+                ast.compile,
+                self.emptyEnv
+            )
+
+    def test_long(self):
+        n = 5000
+        nums = [ASTNum(i) for i in range(n)]
+
+        lst = ASTList(nums).compile(self.emptyEnv)
+        self.assertEqual(lst.head, CNum(0))
+
+        cond = ASTCond([[ASTBool(False), num] for num in nums])
+        self.assertEqual(cond.compile(self.emptyEnv).ifBranch, CNum(0))
+
+        ids = [ASTId("x" + str(i)) for i in range(n)]
+        let = ASTWith(ids, nums, ids[0]).compile(self.emptyEnv)
+        self.assertEqual(let.expr, CNum(0))
+
+        call = ASTCall(ASTId("a"), nums).compile(self.testEnv)
+        self.assertEqual(call.argExpr, CNum(n - 1))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
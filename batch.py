@@ -0,0 +1,349 @@
+import time
+import array
+import threading
+import unittest
+from lisp_exceptions import *
+from core import *
+from val import *
+from runtime import Budget
+from tiering import CodeGen, truth
+import optimizer
+import runtime
+import writer
+
+'''
+Evaluation of one expression over many rows of parameter values, supplied and
+returned as columns
+'''
+
+# Primitives which may be applied element by element to whole columns
+elementwise = frozenset([
+    "+", "-", "*", "/", "eq?", ">", ">=", "<", "<=", "max", "min", "not",
+    "and", "or"
+])
+
+def vectorizable(expr):
+    # Whether every node of expr can be evaluated a column at a time: it
+    # calls no functions, runs no loops and builds no structures
+    for node in optimizer.walk(expr):
+        t = type(node)
+        if t is CPrimOp:
+            if node.name not in elementwise:
+                return False
+        elif t is CGlobal:
+            if node.glob.value is None:
+                return False
+        elif t not in (CNum, CBool, CSym, CStr, CRef, CNumOp, CIf, CIfBool,
+                CLet):
+            return False
+    return True
+
+def charge(budget, count):
+    # Charge count steps at once, polling the clock and cancellation flag as
+    # often as the evaluator would over as many steps
+    budget.steps -= count
+    while budget.steps < 0:
+        budget.exhausted()
+
+def evalColumns(expr, env, size):
+    # Values of expr for every row, where env holds a column of values for
+    # each variable in scope, innermost first. Each branch of a conditional
+    # is only evaluated for the rows which take it, so work is only done
+    # (and errors only raised) where row-by-row evaluation would. Every
+    # operation on columns is charged a step for each row it covers
+    budget, values = runtime.state.budget, []
+
+    # Frames visit a node for the given rows (None for every row), or
+    # continue with a node once the values of some of its subexpressions
+    # are on the values stack
+    stack = [("visit", expr, env, None)]
+    while len(stack) > 0:
+        frame = stack.pop()
+        action, node = frame[0], frame[1]
+        t = type(node)
+        if action == "visit":
+            env, rows = frame[2], frame[3]
+            count = size if rows is None else len(rows)
+            if t is CNum:
+                values.append([node.value] * count)
+            elif t is CBool:
+                values.append([node.state] * count)
+            elif t is CStr or t is CSym:
+                values.append([node.eval(env)] * count)
+            elif t is CGlobal:
+                values.append([node.glob.value] * count)
+            elif t is CRef:
+                column = env[node.idx]
+                if rows is None:
+                    values.append(column)
+                else:
+                    values.append([column[i] for i in rows])
+            elif t is CNumOp:
+                stack.append(("apply", node.fast, 2))
+                stack.append(("visit", node.right, env, rows))
+                stack.append(("visit", node.left, env, rows))
+            elif t is CPrimOp:
+                stack.append(("apply", node.op, len(node.argExprs)))
+                stack.extend(
+                    ("visit", arg, env, rows)
+                    for arg in reversed(node.argExprs)
+                )
+            elif t is CIf or t is CIfBool:
+                stack.append(("branch", node, env, rows))
+                stack.append(("visit", node.cond, env, rows))
+            else:
+                stack.append(("let", node, env, rows))
+                stack.append(("visit", node.expr, env, rows))
+
+        elif action == "apply":
+            arity = frame[2]
+            args = values[-arity:]
+            del values[-arity:]
+            charge(budget, len(args[0]))
+            values.append(map(node, *args))
+
+        elif action == "let":
+            # Columns in the environment always have a value for every row,
+            # though only the rows the binding is evaluated for are set
+            env, rows = frame[2], frame[3]
+            bound = values.pop()
+            charge(budget, len(bound))
+            if rows is not None:
+                column = [None] * size
+                for i, value in zip(rows, bound):
+                    column[i] = value
+                bound = column
+            stack.append(("visit", node.body, [bound] + env, rows))
+
+        elif action == "branch":
+            env, rows = frame[2], frame[3]
+            conds = values.pop()
+            charge(budget, len(conds))
+            if t is CIf:
+                conds = map(truth, conds)
+            taken, skipped = [], []
+            for i, cond in zip(xrange(size) if rows is None else rows, conds):
+                (taken if cond else skipped).append(i)
+            stack.append(("merge", node, conds))
+            stack.append(("visit", node.elseBranch, env, skipped))
+            stack.append(("visit", node.ifBranch, env, taken))
+
+        else:
+            conds = frame[2]
+            charge(budget, len(conds))
+            skipped = iter(values.pop())
+            taken = iter(values.pop())
+            values.append([
+                next(taken) if cond else next(skipped) for cond in conds
+            ])
+
+    return values[0]
+
+class Batch(object):
+    """Expression compiled once over named parameters, evaluated over rows"""
+    def __init__(self, interpreter, params, stx):
+        # Every row is evaluated by the same code: as Python code generated
+        # by the tiering compiler unless the interpreter has tiering off, and
+        # a column at a time if the expression allows
+        self.interpreter, self.params = interpreter, list(params)
+        self.expr = interpreter.compile(stx, params=self.params)
+        self.vectorized = vectorizable(self.expr)
+        if interpreter.tiering is None:
+            self.code = self.expr.eval
+        else:
+            self.code = CodeGen().function(self.expr)
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Batch(" + ", ".join(self.params) + ")"
+
+    def run(self, columns, maxSteps=None, maxAllocs=None, timeout=None,
+            cancel=None):
+        # Values of the expression for each row, where columns maps each
+        # parameter to a sequence (such as a list or an array) of its value
+        # in every row. Limits apply to the batch as a whole
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        budget = Budget(maxSteps, maxAllocs, deadline, cancel)
+
+        env, size = self.columns(columns)
+        interpreter = self.interpreter
+        with interpreter.metrics.phase("eval", budget):
+            with runtime.charging(budget, interpreter.tiering):
+                results = None
+                if self.vectorized:
+                    # An error is raised again by evaluating the rows one at
+                    # a time, which tells which row raised it, but the limits
+                    # stop the batch as a whole
+                    try:
+                        results = evalColumns(self.expr, env, size)
+                    except (LispRuntimeException, ArithmeticError):
+                        if budget.exceeded():
+                            raise
+                if results is None:
+                    results = self.rows(env, size)
+
+        with interpreter.metrics.phase("normalize", budget):
+            with runtime.charging(budget, interpreter.tiering):
+                return [
+                    value if type(value) in UNBOXED
+                    else writer.normalize(value)
+                    for value in results
+                ]
+
+    def columns(self, columns):
+        # Environment of columns of evaluator values, the last parameter
+        # innermost, along with the number of rows
+        env, size = [], None
+        for name in reversed(self.params):
+            if name not in columns:
+                raise LispRuntimeException(
+                    "batch",
+                    "no column given for parameter " + name
+                )
+            column = [
+                value if type(value) in UNBOXED else Val.lift(value)
+                for value in columns[name]
+            ]
+            if size is not None and len(column) != size:
+                raise LispRuntimeException(
+                    "batch",
+                    "column " + name + " has " + str(len(column)) +
+                    " rows rather than " + str(size)
+                )
+            env.append(column)
+            size = len(column)
+        return env, 0 if size is None else size
+
+    def rows(self, env, size):
+        # Each row is charged a step, so that the limits are polled even for
+        # expressions which apply no functions
+        code, results = self.code, []
+        budget = runtime.state.budget
+        for i in xrange(size):
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+            try:
+                results.append(code([column[i] for column in env]))
+            except LispRuntimeException, e:
+                raise LispRuntimeException(
+                    e.func,
+                    "row " + str(i) + ": " + e.msg
+                )
+            except Exception, e:
+                raise LispRuntimeException(
+                    "eval",
+                    "row " + str(i) + ": encountered unknown error during " +
+                    "runtime: " + str(e)
+                )
+        return results
+
+'''
+Tests!
+'''
+
+class BatchTest(unittest.TestCase):
+    """Test class for evaluation over columns of rows"""
+    def setUp(self):
+        from interpreter import Interpreter
+        self.interpreter = Interpreter()
+        self.xs = [1, 2, 3, 4]
+        self.ys = [0.5, 0, 2, -1]
+
+    def assertRows(self, params, stx, columns, vectorized):
+        # Batches agree with running the expression on each row on its own
+        query = self.interpreter.batch(params, stx)
+        self.assertEqual(query.vectorized, vectorized)
+        expected = []
+        for row in zip(*[columns[name] for name in params]):
+            bindings = " ".join(
+                "(%s %r)" % binding for binding in zip(params, row)
+            )
+            expected.append(
+                self.interpreter.run("(let (" + bindings + ") " + stx + ")")
+            )
+        self.assertEqual(query.run(columns), expected)
+
+    def test_vectorized(self):
+        columns = {"x": self.xs, "y": self.ys}
+        self.assertRows(["x", "y"], "(+ (* x 2) y)", columns, True)
+        self.assertRows(["x", "y"],
+            "(let ((z (- x 2))) (if (> z 0) (/ y z) (max z y)))",
+            columns, True)
+        self.assertRows(["x"], "(cond ((< x 2) 'low) ((< x 4) \"mid\") " +
+            "(t nil))", columns, True)
+        self.assertRows(["x", "y"], "(and (> x 1) (not (eq? y 0)))",
+            columns, True)
+
+        # Division by zero only happens in a branch no row takes
+        query = self.interpreter.batch(["y"], "(if (eq? y 0) 0 (/ 1.0 y))")
+        self.assertEqual(query.run({"y": array.array("d", self.ys)}),
+            [2.0, 0, 0.5, -1.0])
+        env, size = query.columns({"y": self.ys})
+        self.assertEqual(evalColumns(query.expr, env, size),
+            [2.0, 0, 0.5, -1.0])
+
+    def test_rows(self):
+        columns = {"x": self.xs}
+        self.interpreter.define("square", "(lambda (n) (* n n))")
+        self.assertRows(["x"], "(square (+ x 1))", columns, False)
+        self.assertRows(["x"], "(list x (range 0 x))", columns, False)
+        self.assertRows(["x"],
+            "(loop ((i 0) (acc 0)) " +
+            "(if (< i x) (recur (+ i 1) (+ acc i)) acc))",
+            columns, False)
+
+    def test_errors(self):
+        query = self.interpreter.batch(["x", "y"], "(/ x y)")
+        try:
+            query.run({"x": self.xs, "y": self.ys})
+            self.fail()
+        except LispRuntimeException, e:
+            self.assertIn("row 1", e.msg)
+        self.assertRaises(LispRuntimeException, query.run, {"x": self.xs})
+        self.assertRaises(
+            LispRuntimeException,
+            query.run, {"x": self.xs, "y": [1]}
+        )
+        self.assertRaises(
+            LispCompilationException,
+            self.interpreter.batch, ["x"], "(+ x z)"
+        )
+        query = self.interpreter.batch(["x"], "(force (range 0 x))")
+        self.assertRaises(
+            LispRuntimeException,
+            query.run, {"x": [10] * 100}, maxAllocs=500
+        )
+        self.assertEqual(query.run({"x": []}), [])
+
+    def test_limits(self):
+        # Limits stop a batch whether it is evaluated a column or a row at a
+        # time
+        size = 100000
+        for stx, vectorized in [("(if (> x 0) (+ (* x 2) 1) (- 0 x))", True),
+                ("(list x)", False)]:
+            query = self.interpreter.batch(["x"], stx)
+            self.assertEqual(query.vectorized, vectorized)
+            columns = {"x": range(size)}
+            self.assertRaises(
+                LispRuntimeException,
+                query.run, columns, maxSteps=size / 2
+            )
+            self.assertRaises(
+                LispRuntimeException,
+                query.run, columns, timeout=-1
+            )
+            cancel = threading.Event()
+            cancel.set()
+            try:
+                query.run(columns, cancel=cancel)
+                self.fail()
+            except LispRuntimeException, e:
+                self.assertEqual(e.msg, "cancelled")
+            self.assertEqual(len(query.run(columns, maxSteps=10 * size)), size)
+
+if __name__ == "__main__":
+    unittest.main()
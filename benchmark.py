@@ -0,0 +1,670 @@
+import sys
+import time
+import threading
+import resource
+import os
+import shutil
+import tempfile
+import subprocess
+import Queue
+from lisp_parser import Parser, Token
+from interpreter import Interpreter
+from runtime import Budget
+from val import Val, SymV
+import optimizer
+import metrics
+import pool
+import data
+import modules
+
+'''
+Benchmarks for the interpreter; run with `python benchmark.py [name ...]`
+'''
+
+def timed(fn, *args):
+    # Best wall-clock time of a few runs
+    best = None
+    for i in range(3):
+        start = time.time()
+        fn(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchScanner():
+    """Scanner throughput on increasingly large sources"""
+    line = "(define-rule (+ x1 2.5 -17 'sym (f \"text\")) (g y)) ; comment\n"
+    for megabytes in [1, 2, 4, 8]:
+        stx = line * (megabytes * 2 ** 20 / len(line))
+        elapsed = timed(Parser.tokenize, stx)
+        print("scan %2d MB: %6.3fs  %6.2f MB/s" % (
+            megabytes,
+            elapsed,
+            len(stx) / elapsed / 2 ** 20
+        ))
+
+fib = """
+    (let ((fib (lambda (self n)
+                 (if (< n 2)
+                     n
+                     (+ (self self (- n 1)) (self self (- n 2)))))))
+      (fib fib %d))
+"""
+
+def benchBudget():
+    """Recursive evaluation with and without step/allocation limits"""
+    interpreter = Interpreter()
+    stx = fib % 20
+    unlimited = timed(interpreter.run, stx)
+    limited = timed(interpreter.run, stx, 10 ** 8, 10 ** 8)
+    print("fib 20 unlimited: %.3fs  limited: %.3fs  difference: %+.1f%%" % (
+        unlimited,
+        limited,
+        (limited / unlimited - 1) * 100
+    ))
+
+def benchThreads():
+    """Throughput and latency of one interpreter shared by a thread pool"""
+    interpreter = Interpreter([
+        ("square", "(lambda (x) (* x x))"),
+        ("fact", "(lambda (n) (if (<= n 1) 1 (* n (fact (- n 1)))))")
+    ])
+    stx = "(map square (list (fact 10) (fact 12) 3 4 5))"
+    jobs = 4000
+
+    for numThreads in [1, 2, 4, 8, 16]:
+        queue = Queue.Queue()
+        for i in range(jobs):
+            queue.put(stx)
+        latencies = []
+
+        def worker():
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                interpreter.run(job, timeout=1)
+                latencies.append(time.time() - start)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for i in range(numThreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        print("%2d threads: %7.0f runs/s  p50 %6.3fms  p99 %6.3fms" % (
+            numThreads,
+            jobs / elapsed,
+            latencies[len(latencies) / 2] * 1000,
+            latencies[len(latencies) * 99 / 100] * 1000
+        ))
+
+def benchSessions():
+    """Forking many sessions off a large shared prelude"""
+    prelude = [
+        ("rule%d" % i, "(lambda (x) (+ x %d))" % i) for i in range(5000)
+    ]
+    start = time.time()
+    base = Interpreter(prelude)
+    print("prelude of %d definitions: %.3fs" % (len(prelude), time.time() - start))
+
+    for numSessions in [1000, 10000]:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        sessions = []
+        for i in range(numSessions):
+            session = base.fork()
+            session.define("tenant", str(i))
+            sessions.append(session)
+        elapsed = time.time() - start
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print("%5d forks+defines: %.3fs (%.1fus each)  max RSS +%d KB" % (
+            numSessions,
+            elapsed,
+            elapsed / numSessions * 10 ** 6,
+            grown
+        ))
+        assert sessions[-1].run("(rule7 tenant)") == numSessions - 1 + 7
+
+def benchLoop():
+    """Numeric loop/recur iteration"""
+    interpreter = Interpreter()
+    for n in [10 ** 5, 10 ** 6]:
+        stx = """
+            (loop ((i 0) (acc 0))
+              (if (< i %d) (recur (+ i 1) (+ acc i)) acc))
+        """ % n
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = timed(interpreter.run, stx)
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print("%8d iterations: %.3fs (%.2fus each)  max RSS +%d KB" % (
+            n,
+            elapsed,
+            elapsed / n * 10 ** 6,
+            grown
+        ))
+
+# Each native list function next to the same computation written in Lisp
+listFunctions = [
+    ("length", "(length xs)",
+        "(loop ((l xs) (n 0)) (if (eq? l nil) n (recur (cdr l) (+ n 1))))"),
+    ("sum", "(sum xs)",
+        "(loop ((l xs) (n 0)) (if (eq? l nil) n (recur (cdr l) (+ n (car l)))))"),
+    ("foldl", "(foldl + 0 xs)",
+        "(loop ((l xs) (n 0)) (if (eq? l nil) n (recur (cdr l) (+ (car l) n))))"),
+    ("foldr", "(foldr + 0 xs)", """
+        (loop ((l (loop ((l xs) (r nil))
+                    (if (eq? l nil) r (recur (cdr l) (cons (car l) r)))))
+               (n 0))
+          (if (eq? l nil) n (recur (cdr l) (+ (car l) n))))"""),
+    ("reverse", "(reverse xs)",
+        "(loop ((l xs) (r nil)) (if (eq? l nil) r (recur (cdr l) (cons (car l) r))))"),
+    ("append", "(append xs xs)", """
+        (loop ((l (loop ((l xs) (r nil))
+                    (if (eq? l nil) r (recur (cdr l) (cons (car l) r)))))
+               (r xs))
+          (if (eq? l nil) r (recur (cdr l) (cons (car l) r))))"""),
+    ("filter", "(filter (lambda (x) (< x 500)) xs)", """
+        (loop ((l (loop ((l xs) (r nil))
+                    (if (eq? l nil)
+                        r
+                        (recur (cdr l) (if (< (car l) 500) (cons (car l) r) r)))))
+               (r nil))
+          (if (eq? l nil) r (recur (cdr l) (cons (car l) r))))"""),
+    ("nth", "(nth 9999 xs)",
+        "(loop ((l xs) (i 9999)) (if (eq? i 0) (car l) (recur (cdr l) (- i 1))))"),
+    ("range", "(force (range 0 10000))",
+        "(loop ((i 9999) (r nil)) (if (< i 0) r (recur (- i 1) (cons i r))))")
+]
+
+def benchLists():
+    """Native list functions against their Lisp equivalents on 10000 elements"""
+    interpreter = Interpreter([("xs", "(force (range 0 10000))")])
+    for name, native, lisp in listFunctions:
+        assert interpreter.run(native) == interpreter.run(lisp)
+        nativeTime = timed(interpreter.run, native)
+        lispTime = timed(interpreter.run, lisp)
+        print("%-8s native: %7.2fms  lisp: %7.2fms  speedup: %5.1fx" % (
+            name,
+            nativeTime * 1000,
+            lispTime * 1000,
+            lispTime / nativeTime
+        ))
+
+def benchStreams():
+    """Lazy stream pipelines against the same pipelines over lists"""
+    interpreter = Interpreter()
+    pipeline = """
+        (reduce (lambda (acc x) (+ acc x)) 0
+                (%s (lambda (x) (* x x))
+                    (%s (lambda (x) (eq? 0 (- x (* 2 (/ x 2))))) %s)))
+    """
+    for n in [10 ** 5, 10 ** 6]:
+        nums = "(range 0 %d)" % n
+        for kind, stx in [
+            ("stream", pipeline % ("stream-map", "stream-filter", nums)),
+            ("list", pipeline % ("map", "filter", "(force " + nums + ")"))
+        ]:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            elapsed = timed(interpreter.run, stx)
+            grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            print("%8d elements %-6s: %.3fs  max RSS +%d KB" % (
+                n,
+                kind,
+                elapsed,
+                grown
+            ))
+
+def benchTiering():
+    """Recursive evaluation with hot functions tree-walked and compiled"""
+    for n in [20, 24]:
+        stx = fib % n
+        times = []
+        for threshold in [None, 1000]:
+            interpreter = Interpreter(tierThreshold=threshold)
+            times.append(timed(interpreter.run, stx))
+        print("fib %d tree-walked: %.3fs  tiered: %.3fs  speedup: %.2fx" % (
+            n,
+            times[0],
+            times[1],
+            times[0] / times[1]
+        ))
+
+def benchFusion():
+    """Multi-stage list pipelines with and without fusion"""
+    interpreter = Interpreter([("xs", "(force (range 0 200000))")])
+    for stages in [1, 2, 4]:
+        stx = "(sum " + "(map (+ 1) " * stages + "xs" + ")" * (stages + 1)
+        fused = interpreter.compile(stx)
+        unfused = Parser.parse(stx).compile(interpreter.initDeEnv)
+        for kind, compiled in [("unfused", unfused), ("fused", fused)]:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            elapsed = timed(interpreter.evaluate, compiled, Budget())
+            grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            print("%d stages %-7s: %.3fs  max RSS +%d KB" % (
+                stages,
+                kind,
+                elapsed,
+                grown
+            ))
+
+def benchElimination():
+    """Generated rules with repeated subexpressions and unused bindings"""
+    interpreter = Interpreter(tierThreshold=None)
+    stx = """
+        (let ((rule (lambda (x)
+                      (let ((a (* x 2))
+                            (unused (list 1 2 3))
+                            (b (+ (* x 2) 1))
+                            (also-unused (lambda (y) (* y y))))
+                        (+ (* (+ a b) (+ a b))
+                           (* (+ a b) (- (+ a b) (* x 2))))))))
+          (sum (map rule (range 0 %d))))
+    """ % 20000
+    plain = optimizer.fuse(Parser.parse(stx).compile(interpreter.initDeEnv))
+    stats = {}
+    optimized = interpreter.compile(stx, stats)
+    assert interpreter.evaluate(plain, Budget()) == \
+        interpreter.evaluate(optimized, Budget())
+    print("nodes: %d -> %d (%d removed)" % (
+        optimizer.size(plain),
+        optimizer.size(optimized),
+        stats["removed"]
+    ))
+    before = timed(interpreter.evaluate, plain, Budget())
+    after = timed(interpreter.evaluate, optimized, Budget())
+    print("20000 applications: %.3fs -> %.3fs  speedup: %.2fx" % (
+        before,
+        after,
+        before / after
+    ))
+
+def benchCompile():
+    """Compiling deeply nested let bindings"""
+    interpreter = Interpreter()
+    for n in [2500, 5000, 10000, 20000]:
+        stx = "(let (" + \
+            " ".join("(x%d (+ %d 1))" % (i, i) for i in range(n)) + \
+            ") (+ x0 x%d))" % (n - 1)
+        parsed = Parser.parse(stx)
+        elapsed = timed(parsed.compile, interpreter.initDeEnv)
+        print("%5d bindings: %.3fs (%.1fus each)" % (
+            n,
+            elapsed,
+            elapsed / n * 10 ** 6
+        ))
+
+def benchHashes():
+    """Keyed lookups in hash maps against association lists"""
+    for n in [1000, 5000, 20000]:
+        interpreter = Interpreter([
+            ("pairs", "(force (stream-map (lambda (i) (cons i i)) (range 0 %d)))" % n),
+            ("table", "(hash pairs)"),
+            ("assoc", """
+                (lambda (k lst)
+                  (loop ((l lst))
+                    (if (eq? (car (car l)) k) (cdr (car l)) (recur (cdr l)))))
+            """)
+        ])
+        lookups = "(sum (map (lambda (i) %s) (range 0 200)))"
+        key = "(* i %d)" % (n / 200)
+        hashed = timed(interpreter.run,
+            lookups % ("(hash-ref table " + key + ")"))
+        scanned = timed(interpreter.run, lookups % ("(assoc " + key + " pairs)"))
+        print("%5d entries, 200 lookups  hash: %.4fs  alist: %.3fs" % (
+            n,
+            hashed,
+            scanned
+        ))
+
+def benchVectors():
+    """Random access by index into vectors against lists"""
+    for n in [2000, 10000, 50000]:
+        interpreter = Interpreter([
+            ("lst", "(force (range 0 %d))" % n),
+            ("vec", "(vector lst)")
+        ])
+        # 500 accesses spread evenly over the sequence
+        access = """
+            (loop ((i 0) (acc 0))
+              (if (< i 500) (recur (+ i 1) (+ acc (%%s (* i %d)))) acc))
+        """ % (n / 500)
+        vectorTime = timed(interpreter.run, access % "vector-ref vec")
+        listTime = timed(interpreter.run, access % "(lambda (i) (nth i lst))")
+        print("%5d elements, 500 accesses  vector: %.4fs  list: %.3fs" % (
+            n,
+            vectorTime,
+            listTime
+        ))
+
+def benchModules():
+    """Requiring a generated rule library with and without its cache"""
+    directory = tempfile.mkdtemp()
+    try:
+        for n in [100, 400, 1600]:
+            path = os.path.join(directory, "rules%d.lisp" % n)
+            with open(path, "w") as f:
+                for i in range(n):
+                    f.write("""
+                        (define rule%d
+                          (lambda (x)
+                            (let ((a (* x %d)) (b (+ x 1)))
+                              (cond ((< a b) (list a b))
+                                    ((> (+ a b) 1000) (map (+ a) (list b 2)))
+                                    (t (filter (lambda (y) (< y a))
+                                               (list b 2 3)))))))
+                    """ % (i, i))
+
+            def require(cache):
+                if not cache:
+                    shutil.rmtree(os.path.join(directory, modules.CACHE_DIR),
+                        True)
+                Interpreter().require(path)
+
+            require(True)
+            cold = timed(require, False)
+            warm = timed(require, True)
+            print("%4d definitions  compiled: %.3fs  cached: %.3fs  "
+                "speedup: %.2fx" % (n, cold, warm, cold / warm))
+    finally:
+        shutil.rmtree(directory)
+
+def benchData():
+    """Touching the first records of data files read lazily and eagerly"""
+    directory = tempfile.mkdtemp()
+    try:
+        record = "(%d (%d.5 %d -3) 'tag (nested (list 1 2 (3 4)) 'x))\n"
+        paths = []
+        for megabytes in [1, 4, 64]:
+            path = os.path.join(directory, "data%d.sexp" % megabytes)
+            with open(path, "w") as f:
+                for i in xrange(megabytes * 2 ** 20 / len(record % (0, 0, 0))):
+                    f.write(record % (i, i, i))
+            paths.append((megabytes, path))
+        touch = "(sum (map (lambda (r) (nth 0 r)) (take 100 records)))"
+
+        def eager(path):
+            # Reading the whole file as the interpreter did before read-data
+            with open(path) as f:
+                stx = f.read()
+            def value(expr):
+                if type(expr) is list:
+                    return Val.fromList([value(e) for e in expr])
+                elif expr.kind == Token.NUM:
+                    return expr.value
+                else:
+                    return SymV(expr.value)
+            return Val.fromList(map(value, Parser.lexAll(Parser.tokenize(stx))))
+
+        # Peak memory only ever grows, so the eager runs come last
+        for name, reader in [("lazy", data.read), ("eager", eager)]:
+            for megabytes, path in paths:
+                if name == "eager" and megabytes > 4:
+                    continue
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                interpreter = Interpreter()
+                interpreter.bind("records", reader(path))
+                interpreter.run(touch)
+                elapsed = time.time() - start
+                grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+                print("%-5s %2d MB: %7.3fs  max RSS +%d KB" % (
+                    name,
+                    megabytes,
+                    elapsed,
+                    grown
+                ))
+    finally:
+        shutil.rmtree(directory)
+
+def benchPool():
+    """Isolated evaluations in pooled workers against a process per request"""
+    prelude = [
+        ("square", "(lambda (x) (* x x))"),
+        ("fact", "(lambda (n) (if (<= n 1) 1 (* n (fact (- n 1)))))")
+    ]
+    stx = "(map square (list (fact 10) (fact 12) 3 4 5))"
+    script = "from interpreter import Interpreter\n" + \
+        "print(Interpreter(%r).run(%r))" % (prelude, stx)
+
+    def report(name, jobs, elapsed, latencies):
+        latencies.sort()
+        print("%-16s %7.0f runs/s  p50 %7.3fms  p99 %7.3fms" % (
+            name,
+            jobs / elapsed,
+            latencies[len(latencies) / 2] * 1000,
+            latencies[len(latencies) * 99 / 100] * 1000
+        ))
+
+    jobs, latencies = 50, []
+    start = time.time()
+    for i in range(jobs):
+        begin = time.time()
+        subprocess.check_output([sys.executable, "-c", script])
+        latencies.append(time.time() - begin)
+    report("spawn per run", jobs, time.time() - start, latencies)
+
+    for size in [1, 4]:
+        with pool.WorkerPool(size, prelude) as workers:
+            jobs, latencies = 4000, []
+            def client(count):
+                for i in range(count):
+                    begin = time.time()
+                    workers.run(stx, timeout=1)
+                    latencies.append(time.time() - begin)
+            start = time.time()
+            threads = [
+                threading.Thread(target=client, args=(jobs / size,))
+                for i in range(size)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report("pool of %d" % size, jobs, time.time() - start, latencies)
+
+def benchMetrics():
+    """Runs with metrics disabled and enabled"""
+    small = "(map (+ 1) (list 1 2 3))"
+    cases = [("small run", small, 5000), ("fib 20", fib % 20, 1)]
+    for name, stx, count in cases:
+        plain = Interpreter()
+        metered = Interpreter(metrics=metrics.Metrics())
+        disabled = timed(lambda: [plain.run(stx) for i in range(count)])
+        enabled = timed(lambda: [metered.run(stx) for i in range(count)])
+        print("%-9s x%4d  disabled: %.3fs  enabled: %.3fs  (%+.1f%%)" % (
+            name,
+            count,
+            disabled,
+            enabled,
+            (enabled / disabled - 1) * 100
+        ))
+
+    phase = metrics.UNMETERED.phase
+    def phases(n):
+        for i in xrange(n):
+            with phase("eval"):
+                pass
+    print("disabled phase: %.3fus" % (timed(phases, 10 ** 6)))
+
+def benchCase():
+    """Dispatch among many symbols with case against a cond chain"""
+    for n in [10, 50, 200]:
+        keys = ["k%d" % i for i in range(n)]
+        conds = " ".join(
+            "((eq? x '%s) %d)" % (k, i) for i, k in enumerate(keys)
+        )
+        cases = " ".join("(%s %d)" % (k, i) for i, k in enumerate(keys))
+        interpreter = Interpreter([
+            ("keys", "(vector (list %s))" % " ".join("'" + k for k in keys)),
+            ("byCond", "(lambda (x) (cond %s (t -1)))" % conds),
+            ("byCase", "(lambda (x) (case x %s (else -1)))" % cases)
+        ])
+        # Each rule is looked up equally often
+        stx = "(sum (map (lambda (i) (%%s (vector-ref keys (- i (* %d " \
+            "(/ i %d)))))) (range 0 20000)))" % (n, n)
+        condTime = timed(interpreter.run, stx % "byCond")
+        caseTime = timed(interpreter.run, stx % "byCase")
+        print("%3d keys, 20000 lookups  cond: %.3fs  case: %.3fs" % (
+            n,
+            condTime,
+            caseTime
+        ))
+
+def benchStrings():
+    """Building a string from many pieces: ropes and builders vs. copying"""
+    def copying(pieces):
+        # What string-append costs when every call copies both strings. The
+        # previous string is kept alive, as it is in Lisp, so CPython cannot
+        # extend it in place
+        s = ""
+        for piece in pieces:
+            previous = s
+            s = previous + piece
+        return s
+
+    append = """
+        (loop ((i 0) (s "")) (if (< i %d)
+            (recur (+ i 1) (string-append s "%s"))
+            (string-length s)))
+    """
+    build = """
+        (loop ((i 0) (b (string-builder ""))) (if (< i %d)
+            (recur (+ i 1) (builder-add b "%s"))
+            (string-length (builder->string b))))
+    """
+    interpreter = Interpreter()
+    piece = "x" * 100
+    for n in [1000, 5000, 20000]:
+        print("%5d pieces  copy: %.3fs  rope: %.3fs  builder: %.3fs" % (
+            n,
+            timed(copying, [piece] * n),
+            timed(interpreter.run, append % (n, piece)),
+            timed(interpreter.run, build % (n, piece))
+        ))
+
+def benchWrite():
+    """Peak memory of writing a large result against returning it"""
+    stx = "(stream-map (lambda (i) (list i (* i i))) (range 0 %d))"
+    script = "import json, resource\n" + \
+        "from interpreter import Interpreter\n" + \
+        "interpreter = Interpreter()\n" + \
+        "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n" + \
+        "%s\n" + \
+        "after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n" + \
+        "print(after - before)"
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "out.json")
+        returned = "json.dump(interpreter.run(%r), open(%r, 'w'))"
+        written = "interpreter.write(%r, open(%r, 'w'))"
+        for n in [10 ** 4, 10 ** 5, 10 ** 6]:
+            growth = []
+            for run in [returned, written]:
+                start = time.time()
+                output = subprocess.check_output([
+                    sys.executable, "-c", script % (run % (stx % n, path))
+                ])
+                growth.append((time.time() - start, int(output) / 1024.0))
+            print("%7d rows  run+dump: %.2fs %7.1fMB  write: %.2fs %7.1fMB" %
+                (n, growth[0][0], growth[0][1], growth[1][0], growth[1][1]))
+    finally:
+        shutil.rmtree(directory)
+
+def benchTypes():
+    """Numeric loops with and without type specialization"""
+    stx = """
+        (let ((scale (lambda (x) (* x 3))))
+          (loop ((i 0) (acc 0))
+            (if (< i %d)
+                (recur (+ i 1) (if (> (- (scale i) acc) 0) (+ acc 1) acc))
+                acc)))
+    """ % 100000
+    for threshold in [None, 1000]:
+        interpreter = Interpreter(tierThreshold=threshold)
+        parsed = Parser.parse(stx)
+        plain = optimizer.eliminate(optimizer.fuse(
+            parsed.compile(interpreter.initDeEnv)
+        ))[0]
+        specialized = interpreter.compile(stx)
+        assert interpreter.evaluate(plain, Budget()) == \
+            interpreter.evaluate(specialized, Budget())
+        before = timed(interpreter.evaluate, plain, Budget())
+        after = timed(interpreter.evaluate, specialized, Budget())
+        print("%-9s 100000 iterations: %.3fs -> %.3fs  speedup: %.2fx" % (
+            "tiered" if threshold else "tree-walk",
+            before,
+            after,
+            before / after
+        ))
+
+def benchBatch():
+    """Scoring many records: a run per record against batches of columns"""
+    n = 100000
+    columns = {
+        "age": [20 + i % 50 for i in range(n)],
+        "income": [1000.0 + (i * 37) % 5000 for i in range(n)],
+        "visits": [i % 13 for i in range(n)]
+    }
+    params = ["age", "income", "visits"]
+    score = """
+        (let ((base (+ (* income 0.01) (* visits 3))))
+          (if (> age 60) (* base 1.5) (max base (- 100 age))))
+    """
+    # The same score, through a function the columns cannot be passed to
+    called = "((lambda (b) (if (> age 60) (* b 1.5) (max b (- 100 age)))) " \
+        "(+ (* income 0.01) (* visits 3)))"
+    interpreter = Interpreter()
+
+    def perRecord(count):
+        for i in xrange(count):
+            interpreter.run("(let (%s) %s)" % (" ".join(
+                "(%s %r)" % (name, columns[name][i]) for name in params
+            ), score))
+    sample = 2000
+    elapsed = timed(perRecord, sample) * n / sample
+    print("run per record: %.3fs (extrapolated from %d)" % (elapsed, sample))
+
+    for name, stx in [("rows", called), ("columns", score)]:
+        query = interpreter.batch(params, stx)
+        assert query.vectorized == (name == "columns")
+        print("batch by %-7s %.3fs" % (
+            name + ":",
+            timed(query.run, columns)
+        ))
+
+benchmarks = {
+    "batch": benchBatch,
+    "budget": benchBudget,
+    "case": benchCase,
+    "compile": benchCompile,
+    "data": benchData,
+    "elimination": benchElimination,
+    "fusion": benchFusion,
+    "hashes": benchHashes,
+    "lists": benchLists,
+    "loop": benchLoop,
+    "metrics": benchMetrics,
+    "modules": benchModules,
+    "pool": benchPool,
+    "sessions": benchSessions,
+    "streams": benchStreams,
+    "strings": benchStrings,
+    "threads": benchThreads,
+    "types": benchTypes,
+    "vectors": benchVectors,
+    "write": benchWrite,
+    "tiering": benchTiering,
+    "scanner": benchScanner
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(benchmarks.keys()):
+        print("== " + name + ": " + benchmarks[name].__doc__)
+        benchmarks[name]()
@@ -1,7 +1,11 @@
+import sys
+import operator
+import itertools
 import unittest
 from abc import ABCMeta, abstractmethod
 from lisp_exceptions import LispRuntimeException
 from val import *
+import runtime
 
 '''
 Compiled expressions which can be directly evaluated
@@ -16,6 +20,10 @@ class CExpr:
     def eval(self, env):
         pass
 
+    # Direct subexpressions, for passes over compiled code
+    def subExprs(self):
+        return []
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self.__dict__ == other.__dict__
@@ -40,8 +48,8 @@ class CBool(CExpr):
         return "CBool(" + str(self.state) + ")"
 
     def eval(self, env):
-        # Simply wrap value in BoolV
-        return BoolV(self.state)
+        # Booleans are left unboxed
+        return self.state
 
 class CIf(CExpr):
     """Core conditional data type"""
@@ -57,22 +65,112 @@ class CIf(CExpr):
             str(self.ifBranch) + ", " + \
             str(self.elseBranch) + ")"
 
+    def subExprs(self):
+        return [self.cond, self.ifBranch, self.elseBranch]
+
     def eval(self, env):
-        # It is very important we only evaluate one branch of the conditional
-        b = self.cond.eval(env)
-        if type(b) is BoolV:
-            if b.state:
-                return self.ifBranch.eval(env)
+        # Chains of conditionals (as produced by cond) are walked iteratively,
+        # checked and specialized alike, however the two kinds are mixed
+        expr = self
+        while True:
+            t = type(expr)
+            if t is CIfBool:
+                if expr.cond.eval(env):
+                    expr = expr.ifBranch
+                else:
+                    expr = expr.elseBranch
+                continue
+            elif t is not CIf:
+                return expr.eval(env)
+
+            # It is very important we only evaluate one branch of the
+            # conditional
+            b = expr.cond.eval(env)
+            if type(b) is BoolV:
+                b = b.state
+
+            if b is True:
+                expr = expr.ifBranch
+            elif b is False:
+                expr = expr.elseBranch
             else:
-                return self.elseBranch.eval(env)
+                raise LispRuntimeException(
+                    "eval",
+                    "expected a boolean when evaluating " + \
+                    str(expr.cond) + \
+                    " but got " + \
+                    str(b)
+                )
+
+class CIfBool(CExpr):
+    """Core conditional whose condition is known to be an unboxed boolean"""
+    def __init__(self, cond, ifBranch, elseBranch):
+        self.cond, self.ifBranch, self.elseBranch = \
+            cond, ifBranch, elseBranch
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CIfBool(" + \
+            str(self.cond) + ", " + \
+            str(self.ifBranch) + ", " + \
+            str(self.elseBranch) + ")"
+
+    def subExprs(self):
+        return [self.cond, self.ifBranch, self.elseBranch]
+
+    # Shares the loop of CIf, so that a chain mixing the two is walked in one
+    # frame
+    eval = CIf.eval.im_func
+
+class CCase(CExpr):
+    """Core dispatch on the value of a key among literal cases"""
+    def __init__(self, key, cases, branches, default):
+        # cases holds a tuple of tagged keys (see tag) for each branch. The
+        # branch is chosen with a single lookup in a table of every key; a key
+        # listed more than once selects its first branch
+        self.key, self.cases, self.branches, self.default = \
+            key, cases, branches, default
+        self.table = {}
+        for i, keys in enumerate(cases):
+            for k in keys:
+                self.table.setdefault(k, i)
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CCase(" + \
+            str(self.key) + ", " + \
+            ", ".join(
+                str([CCase.untag(k) for k in keys]) + ": " + str(branch)
+                for keys, branch in zip(self.cases, self.branches)
+            ) + ", " + \
+            str(self.default) + ")"
+
+    def subExprs(self):
+        return [self.key] + self.branches + [self.default]
+
+    @staticmethod
+    def tag(val):
+        # Key under which a value is looked up. Python considers True equal
+        # to 1 and False to 0, so booleans are tagged to keep them apart
+        t = type(val)
+        if t is bool:
+            return (bool, val)
+        elif t is BoolV:
+            return (bool, val.state)
         else:
-            raise LispRuntimeException(
-                "eval",
-                "expected a boolean when evaluating " + \
-                str(cond) + \
-                " but got " + \
-                str(b)
-            )
+            return val
+
+    @staticmethod
+    def untag(key):
+        return key[1] if type(key) is tuple else key
+
+    def eval(self, env):
+        idx = self.table.get(CCase.tag(self.key.eval(env)))
+        if idx is None:
+            return self.default.eval(env)
+        return self.branches[idx].eval(env)
 
 '''
 Expressions related to arithmetic
@@ -89,8 +187,8 @@ class CNum(CExpr):
         return "CNum(" + str(self.value) + ")"
 
     def eval(self, env):
-        # Simply wrap value in NumV
-        return NumV(self.value)
+        # Numbers are left unboxed
+        return self.value
 
 '''
 Expressions related to cons
@@ -106,8 +204,21 @@ class CCons(CExpr):
     def __repr__(self):
         return "CCons(" + str(self.head) + ", " + str(self.tail) + ")"
 
+    def subExprs(self):
+        return [self.head, self.tail]
+
     def eval(self, env):
-        return ConsV(self.head.eval(env), self.tail.eval(env))
+        # Chains of conses (as produced by list) are evaluated iteratively
+        heads, expr = [], self
+        while type(expr) is CCons:
+            heads.append(expr.head.eval(env))
+            expr = expr.tail
+
+        runtime.state.budget.alloc(len(heads))
+        lst = expr.eval(env)
+        for head in reversed(heads):
+            lst = ConsV(head, lst)
+        return lst
 
 class CCar(CExpr):
     """Core car data type"""
@@ -119,9 +230,28 @@ class CCar(CExpr):
     def __repr__(self):
         return "CCar(" + str(self.pair) + ")"
 
+    def subExprs(self):
+        return [self.pair]
+
     def eval(self, env):
-        # Evaluate the pair to fetch the head (make lazy later)
-        return self.pair.eval(env).head
+        pair = self.pair.eval(env)
+        if type(pair) is ConsV:
+            return pair.head
+        return CCar.of(pair)
+
+    @staticmethod
+    def of(pair):
+        # Head of a pair, or first element of a stream
+        if type(pair) is ConsV:
+            return pair.head
+        elif type(pair) is StreamV:
+            for x in pair:
+                return x
+            raise LispRuntimeException("eval", "car: empty stream")
+        raise LispRuntimeException(
+            "eval",
+            "car expects a pair or a stream, got: " + str(pair)
+        )
 
 class CCdr(CExpr):
     """Core car data type"""
@@ -133,9 +263,28 @@ class CCdr(CExpr):
     def __repr__(self):
         return "CCdr(" + str(self.pair) + ")"
 
+    def subExprs(self):
+        return [self.pair]
+
     def eval(self, env):
-        # Evaluate the pair to fetch the tail (make lazy later)
-        return self.pair.eval(env).tail
+        pair = self.pair.eval(env)
+        if type(pair) is ConsV:
+            return pair.tail
+        return CCdr.of(pair)
+
+    @staticmethod
+    def of(pair):
+        # Tail of a pair, or the elements of a stream after its first, as a
+        # stream
+        if type(pair) is ConsV:
+            return pair.tail
+        elif type(pair) is StreamV:
+            CCar.of(pair)
+            return StreamV(lambda: itertools.islice(iter(pair), 1, None))
+        raise LispRuntimeException(
+            "eval",
+            "cdr expects a pair or a stream, got: " + str(pair)
+        )
 
 '''
 Expressions related to functions
@@ -146,14 +295,42 @@ class CFun(CExpr):
     def __init__(self, body):
         self.body = body
 
+        # Calls left until the next call to hot; see tiering.Tiering
+        self.countdown = 0
+        self.counting = False
+
     def __str__(self):
         return repr(self)
     def __repr__(self):
         return "CFun(" + str(self.body) + ")"
 
+    def subExprs(self):
+        return [self.body]
+
     def eval(self, env):
         # Simply wrap value and scope in the appropriate Val to be called later
-        return FunV(self.body, env)
+        return FunV(self, env)
+
+    def hot(self):
+        # Called by function application whenever the countdown runs out
+        tiering = runtime.state.tiering
+        if tiering is None:
+            self.countdown = sys.maxint
+        else:
+            tiering.observe(self)
+
+class CCompiled(CExpr):
+    """Core expression replaced by native Python code"""
+    def __init__(self, code, original):
+        self.code, self.original = code, original
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CCompiled(" + str(self.original) + ")"
+
+    def eval(self, env):
+        return self.code(env)
 
 class CPrimFun(CExpr):
     """Core primitive (native) function data type"""
@@ -168,6 +345,83 @@ class CPrimFun(CExpr):
     def eval(self, env):
         return PrimFunV(self.thunk)
 
+class CPrimOp(CExpr):
+    """Core fully-applied primitive operation data type"""
+    def __init__(self, name, op, argExprs):
+        self.name, self.op, self.argExprs = name, op, argExprs
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CPrimOp(" + self.name + ", " + str(self.argExprs) + ")"
+
+    def subExprs(self):
+        return self.argExprs
+
+    def eval(self, env):
+        # Apply the native operation directly, skipping the curried PrimFunV
+        # call chain the equivalent CCall would go through
+        args = self.argExprs
+        if len(args) == 2:
+            return self.op(args[0].eval(env), args[1].eval(env))
+        else:
+            return self.op(*[arg.eval(env) for arg in args])
+
+class CNumOp(CExpr):
+    """Core arithmetic or comparison of operands known to be numbers"""
+    # Python operator computing each primitive on numbers, by name
+    operators = {
+        "+": operator.add,
+        "-": operator.sub,
+        "*": operator.mul,
+        "/": operator.div,
+        "eq?": operator.eq,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le
+    }
+
+    def __init__(self, name, op, left, right):
+        # op is the primitive's own implementation, which code cached by
+        # modules is linked to, while fast computes the same thing natively
+        self.name, self.op, self.left, self.right = name, op, left, right
+        self.fast = CNumOp.operators[name]
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CNumOp(" + self.name + ", " + \
+            str(self.left) + ", " + str(self.right) + ")"
+
+    def subExprs(self):
+        return [self.left, self.right]
+
+    def eval(self, env):
+        return self.fast(self.left.eval(env), self.right.eval(env))
+
+class CLet(CExpr):
+    """Core local binding data type"""
+    def __init__(self, expr, body):
+        self.expr, self.body = expr, body
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CLet(" + str(self.expr) + ", " + str(self.body) + ")"
+
+    def subExprs(self):
+        return [self.expr, self.body]
+
+    def eval(self, env):
+        # Chains of bindings (as produced by let) are entered iteratively,
+        # without creating and applying a function for each
+        expr = self
+        while type(expr) is CLet:
+            env = [expr.expr.eval(env)] + env
+            expr = expr.body
+        return expr.eval(env)
+
 class CCall(CExpr):
     """Core function invocation data type"""
     def __init__(self, funExpr, argExpr):
@@ -178,17 +432,135 @@ class CCall(CExpr):
     def __repr__(self):
         return "CCall(" + str(self.funExpr) + ", " + str(self.argExpr) + ")"
 
-    def eval(self, env):
-        fval = self.funExpr.eval(env)
+    def subExprs(self):
+        return [self.funExpr, self.argExpr]
 
-        if type(fval) not in [FunV, PrimFunV]:
+    def eval(self, env):
+        expr = self
+        while True:
+            # Unroll curried calls so that calls with many arguments do not
+            # recurse once per argument
+            argExprs, funExpr = [expr.argExpr], expr.funExpr
+            while type(funExpr) is CCall:
+                argExprs.append(funExpr.argExpr)
+                funExpr = funExpr.funExpr
+
+            fval = funExpr.eval(env)
+            for argExpr in reversed(argExprs[1:]):
+                fval = CCall.apply(fval, argExpr.eval(env))
+
+            # A user-defined function whose body is itself a call (such as a
+            # chain of let bindings) is entered by looping rather than
+            # recursing
+            if type(fval) is FunV and type(fval.fun.body) is CCall:
+                budget = runtime.state.budget
+                budget.steps -= 1
+                if budget.steps < 0:
+                    budget.exhausted()
+
+                env = [argExprs[0].eval(env)] + fval.env
+                expr = fval.fun.body
+            else:
+                return CCall.apply(fval, argExprs[0].eval(env))
+
+    @staticmethod
+    def apply(fval, argVal):
+        if type(fval) is FunV:
+            budget = runtime.state.budget
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+
+            fun = fval.fun
+            fun.countdown -= 1
+            if fun.countdown < 0:
+                fun.hot()
+            return fun.body.eval([argVal] + fval.env)
+        elif isinstance(fval, PrimFunV):
+            return fval.apply(argVal)
+        else:
             raise LispRuntimeException(
                 "eval",
                 "'call' expects a function, got: " + str(fval)
             )
 
-        fun = fval.unwrap()
-        return fun(self.argExpr.eval(env))
+class CCallFun(CExpr):
+    """Core invocation of an expression known to be a user-defined function"""
+    def __init__(self, funExpr, argExpr):
+        self.funExpr, self.argExpr = funExpr, argExpr
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CCallFun(" + str(self.funExpr) + ", " + \
+            str(self.argExpr) + ")"
+
+    def subExprs(self):
+        return [self.funExpr, self.argExpr]
+
+    def eval(self, env):
+        return self.funExpr.eval(env).apply(self.argExpr.eval(env))
+
+'''
+Expressions related to loops
+'''
+
+class CLoop(CExpr):
+    """Core loop data type"""
+    def __init__(self, inits, body, inPlace):
+        # Loop variables are rebound by mutating their frame unless a closure
+        # might capture it
+        self.inits, self.body, self.inPlace = inits, body, inPlace
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CLoop(" + str(self.inits) + ", " + str(self.body) + ")"
+
+    def subExprs(self):
+        return self.inits + [self.body]
+
+    def eval(self, env):
+        outer = env
+        for init in self.inits:
+            env = [init.eval(env)] + env
+
+        # Each recur hands back a tuple of the new values of the variables,
+        # the first variable being deepest in the frame
+        numVars = len(self.inits)
+        body = self.body
+        budget = runtime.state.budget
+        while True:
+            result = body.eval(env)
+            if type(result) is not tuple:
+                return result
+
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+
+            if self.inPlace:
+                env[:numVars] = result[::-1]
+            else:
+                env = list(result[::-1]) + outer
+
+class CRecur(CExpr):
+    """Core loop rebinding data type"""
+    def __init__(self, argExprs):
+        self.argExprs = argExprs
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CRecur(" + str(self.argExprs) + ")"
+
+    def subExprs(self):
+        return self.argExprs
+
+    def eval(self, env):
+        # Evaluated in tail position only, so the tuple travels straight back
+        # to the enclosing CLoop
+        return tuple([arg.eval(env) for arg in self.argExprs])
 
 '''
 Expressions related to symbols
@@ -207,6 +579,20 @@ class CSym(CExpr):
         # Get a value referenced in the environment based in its de-Bruijn index
         return SymV(self.name)
 
+class CStr(CExpr):
+    """Core string literal data type"""
+    def __init__(self, text):
+        # Strings are immutable, so every evaluation shares one value
+        self.text, self.value = text, StrV(text)
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CStr(" + repr(self.value) + ")"
+
+    def eval(self, env):
+        return self.value
+
 '''
 Expressions related to references/de-Bruijn indices
 '''
@@ -223,7 +609,26 @@ class CRef(CExpr):
 
     def eval(self, env):
         # Get a value referenced in the environment based in its de-Bruijn index
-        return Val.wrap(env[self.idx])
+        return env[self.idx]
+
+class CGlobal(CExpr):
+    """Core reference to a top-level binding"""
+    def __init__(self, glob):
+        self.glob = glob
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "CGlobal(" + self.glob.name + ")"
+
+    def eval(self, env):
+        value = self.glob.value
+        if value is None:
+            raise LispRuntimeException(
+                "eval",
+                self.glob.name + " was referenced before being defined"
+            )
+        return value
 
 '''
 Tests!
@@ -259,6 +664,17 @@ class CoreTest(unittest.TestCase):
             []
         )
 
+    def test_case(self):
+        case = CCase(
+            CRef(0),
+            ((CCase.tag(1), SymV("a")), (CCase.tag(True),), (2.0,)),
+            [CNum(10), CNum(20), CNum(30)],
+            CNum(0)
+        )
+        results = [case.eval([key])
+            for key in [1, 1.0, SymV("a"), True, BoolV(True), False, 0, 2]]
+        self.assertEqual(results, [10, 10, 10, 20, 20, 0, 0, 30])
+
     def test_cons(self):
         self.assertEqualEval(
             CCar(CCdr(
@@ -268,6 +684,17 @@ class CoreTest(unittest.TestCase):
             []
         )
 
+    def test_stream_cons(self):
+        stream = StreamV(lambda: iter([1, 2, 3]))
+        self.assertEqual(CCar(CRef(0)).eval([stream]), 1)
+        rest = CCdr(CRef(0)).eval([stream])
+        self.assertEqual(list(rest), [2, 3])
+        self.assertEqual(CCar(CCdr(CRef(0))).eval([rest]), 3)
+        empty = StreamV(lambda: iter([]))
+        for expr in [CCar(CRef(0)), CCdr(CRef(0))]:
+            self.assertRaises(LispRuntimeException, expr.eval, [empty])
+            self.assertRaises(LispRuntimeException, expr.eval, [1])
+
     def test_fun_call(self):
         self.assertEqualEval(
             CCall(
@@ -293,6 +720,50 @@ class CoreTest(unittest.TestCase):
             []
         )
 
+    def test_prim_op(self):
+        self.assertEqualEval(
+            CPrimOp("+", lambda x, y: x + y, [CNum(21), CNum(13)]),
+            CNum(34),
+            []
+        )
+
+        self.assertEqualEval(
+            CPrimOp("not", lambda x: not x, [CBool(False)]),
+            CBool(True),
+            []
+        )
+
+    def test_long(self):
+        lst = CBool(False)
+        for i in range(5000):
+            lst = CCons(CNum(i), lst)
+        self.assertEqual(lst.eval([]).head, 4999)
+
+        cond = CNum(0)
+        for i in range(5000):
+            cond = CIf(CBool(False), CNum(1), cond)
+        self.assertEqualEval(cond, CNum(0), [])
+
+    def test_unboxed(self):
+        self.assertIs(type(CNum(3).eval([])), int)
+        self.assertIs(CBool(True).eval([]), True)
+        self.assertIs(type(CCar(CCons(CNum(1.5), CBool(False))).eval([])), float)
+
+        # Values boxed at a boundary are still accepted
+        self.assertEqualEval(
+            CIf(CRef(0), CNum(5), CNum(10)),
+            CNum(5),
+            [BoolV(True)]
+        )
+
+    def test_let(self):
+        self.assertEqualEval(
+            CLet(CNum(2), CLet(CNum(3), CPrimOp("-", lambda x, y: x - y,
+                [CRef(0), CRef(1)]))),
+            CNum(1),
+            []
+        )
+
     def test_ref(self):
         env = self.testEnv
 
@@ -0,0 +1,181 @@
+import os
+import re
+import mmap
+import shutil
+import tempfile
+import unittest
+from lisp_exceptions import LispRuntimeException
+from lisp_parser import Parser
+from val import *
+import natives
+
+'''
+Lazy reading of s-expression data files into evaluator values
+'''
+
+class DataFile(object):
+    """Memory-mapped file of s-expression data, scanned on demand"""
+    # Everything which matters when skipping over a list without reading it:
+    # parentheses, along with strings and comments which may contain them
+    structure = re.compile(r'"(?:[^"\\]|\\.)*"|;[^\n]*|[()]')
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # Pages of the mapping are only read in as they are scanned, and
+            # tokens are matched in place rather than copied out of a string.
+            # An empty file cannot be mapped, but it has no data anyway
+            if os.fstat(f.fileno()).st_size == 0:
+                self.buffer = ""
+            else:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Offset just past each list read or skipped so far, keyed by the
+        # offset just past its opening parenthesis
+        self.ends = {}
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "DataFile(" + str(len(self.buffer)) + " bytes)"
+
+    def data(self):
+        # The top-level data of the file, as a stream
+        return StreamV(lambda: self.items(0, True))
+
+    def list(self, start):
+        # A list is a stream whose elements are only built as it is traversed
+        return StreamV(lambda: self.items(start, False))
+
+    def items(self, pos, top):
+        buf, match = self.buffer, Parser.scanner.match
+        while True:
+            token = match(buf, pos)
+            if token is None:
+                if not top:
+                    self.error("unclosed '('", pos)
+                return
+
+            kind, end = token.lastgroup, token.end()
+            if kind == "open":
+                yield self.list(end)
+                pos = self.skip(end)
+            elif kind == "close":
+                if top:
+                    self.error("unexpected ')'", pos)
+                self.ends[pos] = end
+                return
+            elif kind == "space" or kind == "comment":
+                pos = end
+            else:
+                yield self.atom(kind, token.group(), pos)
+                pos = end
+
+    def skip(self, start):
+        # Offset just past the list opened before start
+        end = self.ends.get(start)
+        if end is not None:
+            return end
+
+        buf, search = self.buffer, self.structure.search
+        depth, pos = 1, start
+        while depth > 0:
+            delim = search(buf, pos)
+            if delim is None:
+                self.error("unclosed '('", start - 1)
+            pos = delim.end()
+            char = buf[delim.start()]
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+
+        self.ends[start] = pos
+        return pos
+
+    def atom(self, kind, text, pos):
+        # Atoms read as they would be quoted in code: identifiers (with or
+        # without a quote) are symbols
+        if kind == "int":
+            return int(text)
+        elif kind == "float":
+            return float(text)
+        elif kind == "atom":
+            if text == "t":
+                return True
+            elif text == "nil":
+                return False
+            elif text[0] == "'" and len(text) > 1:
+                return SymV(intern(text[1:]))
+            else:
+                return SymV(intern(text))
+        elif kind == "str":
+            return StrV(text[1:-1].decode("string_escape"))
+        else:
+            self.error("unexpected character " + repr(text), pos)
+
+    def error(self, msg, pos):
+        raise LispRuntimeException(
+            "read-data",
+            msg + " at byte " + str(pos)
+        )
+
+def read(path):
+    # Stream of the data in the file at path, read lazily
+    try:
+        return DataFile(path).data()
+    except (IOError, OSError), e:
+        raise LispRuntimeException(
+            "read-data",
+            "cannot read " + path + ": " + e.strerror
+        )
+
+'''
+Tests!
+'''
+
+class DataTest(unittest.TestCase):
+    """Test class for lazily read data files"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, stx):
+        path = os.path.join(self.directory, "data.sexp")
+        with open(path, "w") as f:
+            f.write(stx)
+        return read(path)
+
+    def test_values(self):
+        data = self.read("(1 -2.5 (x 'y) t nil) ; comment\n 7 () \"a)\\n\"")
+        self.assertEqual(data.normalize(),
+            [[1, -2.5, ["'x", "'y"], True, False], 7, [], "a)\n"])
+        self.assertEqual(self.read("").normalize(), [])
+
+    def test_lazy(self):
+        # Lists are skipped over unread, so malformed data is only reported
+        # once it is reached
+        data = self.read("(1 (2 \")\" ; )\n x) 3) (4 \"oops)")
+        first = natives.nth(0, data)
+        self.assertEqual(natives.nth(2, first), 3)
+        self.assertEqual(natives.nth(0, natives.nth(1, first)), 2)
+        self.assertEqual(natives.length(data), 2)
+        self.assertRaises(
+            LispRuntimeException,
+            natives.length, natives.nth(1, data)
+        )
+
+    def test_errors(self):
+        for stx in ["(1 2", ") 1", "((1)", "(\"()"]:
+            self.assertRaises(
+                LispRuntimeException,
+                self.read(stx).normalize
+            )
+        self.assertRaises(
+            LispRuntimeException,
+            read, os.path.join(self.directory, "missing")
+        )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,23 @@
 import unittest
 from abc import ABCMeta, abstractmethod
 from lisp_exceptions import LispCompilationException
+from pmap import PMap
 
 '''
 Environments to handle symbol lookup and scoping
 '''
 
+class Global(object):
+    """Top-level binding, shared by every scope and evaluation"""
+    def __init__(self, name, value=None, prim=None):
+        # prim is the (arity, native operation) pair of primitive bindings
+        self.name, self.value, self.prim = name, value, prim
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Global(" + self.name + ")"
+
 class DeEnv:
     """Syntactic environments for the de-Bruijn preprocessing"""
     __metaclass__ = ABCMeta
@@ -14,32 +26,77 @@ class DeEnv:
     def lookup(self, id):
         pass
 
-    @staticmethod
-    def fromList(ids):
-        if len(ids) == 0:
-            return DeEmptyEnv()
+    @abstractmethod
+    # Top-level binding of id, or None if id is not global or has been
+    # shadowed by a local binding
+    def lookupGlobal(self, id):
+        pass
+
+    def lookupPrim(self, id):
+        # Native operation bound to id, or None if id is not a primitive or
+        # has been shadowed
+        glob = self.lookupGlobal(id)
+        if glob is None:
+            return None
         else:
-            return DeExtend(
-                DeEnv.fromList(ids[1:]),
-                ids[0]
-            )
+            return glob.prim
+
+    @staticmethod
+    def fromList(ids, tail=None):
+        # The first id ends up with index 0
+        deEnv = DeEmptyEnv() if tail is None else tail
+        for id in reversed(ids):
+            deEnv = DeExtend(deEnv, id)
+        return deEnv
 
 class DeEmptyEnv(DeEnv):
     """Empty environment"""
+    # Number of local bindings in scope, and the depth at which each name in
+    # scope was bound
+    depth = 0
+    names = PMap()
+
+    @property
+    def base(self):
+        return self
 
     def lookup(self, id):
         raise LispCompilationException("lookup", "free identifier: " + id)
 
+    def lookupGlobal(self, id):
+        return None
+
+class DeGlobalEnv(DeEmptyEnv):
+    """Environment of top-level bindings with no local bindings"""
+    def __init__(self, globals):
+        # globals maps names to Global bindings
+        self.globals = globals
+
+    def lookupGlobal(self, id):
+        return self.globals.get(id)
+
 class DeExtend(DeEnv):
     """de-Bruijn indexed environment"""
     def __init__(self, tail, head):
         self.tail, self.head = tail, head
 
+        # Rather than walking the chain of bindings, names are resolved with a
+        # persistent map from each name to the depth of its innermost binding,
+        # shared with the enclosing scopes
+        self.base = tail.base
+        self.depth = tail.depth + 1
+        self.names = tail.names.set(head, tail.depth)
+
     def lookup(self, id):
-        if id == self.head:
-            return 0
-        else:
-            return 1 + self.tail.lookup(id)
+        depth = self.names.get(id)
+        if depth is None:
+            return self.base.lookup(id)
+        return self.depth - 1 - depth
+
+    def lookupGlobal(self, id):
+        if id in self.names:
+            return None
+        return self.base.lookupGlobal(id)
 
 '''
 Tests!
@@ -67,5 +124,26 @@ class EnvTest(unittest.TestCase):
             2
         )
 
+    def test_globals(self):
+        add = Global("+", None, (2, lambda x, y: x + y))
+        e = DeEnv.fromList(["x"], DeGlobalEnv({"+": add}))
+        self.assertEqual(e.lookupGlobal("+"), add)
+        self.assertEqual(e.lookupPrim("+"), add.prim)
+        self.assertEqual(e.lookupGlobal("x"), None)
+        self.assertEqual(DeExtend(e, "+").lookupPrim("+"), None)
+        self.assertRaises(LispCompilationException, e.lookup, "+")
+
+    def test_deep(self):
+        ids = ["x" + str(i) for i in range(5000)]
+        self.assertEqual(DeEnv.fromList(ids).lookup("x4999"), 4999)
+
+    def test_shadowing(self):
+        base = DeEnv.fromList(["x", "y", "x"])
+        self.assertEqual([base.lookup("x"), base.lookup("y")], [0, 1])
+        branch1, branch2 = DeExtend(base, "y"), DeExtend(base, "z")
+        self.assertEqual([branch1.lookup("x"), branch1.lookup("y")], [1, 0])
+        self.assertEqual([branch2.lookup("y"), branch2.lookup("z")], [2, 0])
+        self.assertEqual(base.lookup("y"), 1)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
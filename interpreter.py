@@ -2,8 +2,27 @@ import unittest
 from lisp_exceptions import *
 from lisp_parser import Parser
 from ast import *
-from val import PrimFunV
-from env import DeEnv
+from val import Val, NativeFunV
+from env import Global, DeGlobalEnv, DeExtend
+from pmap import PMap
+from runtime import Budget
+from tiering import Tiering
+from metrics import Metrics, UNMETERED
+import threading
+import runtime
+import natives
+import optimizer
+import modules
+import copy
+import data
+import writer
+import batch
+import os
+import shutil
+import tempfile
+import time
+import json
+from cStringIO import StringIO
 
 '''
 Interpreter class to execute the parsing, compilation, and evaluation steps
@@ -11,73 +30,295 @@ Interpreter class to execute the parsing, compilation, and evaluation steps
 
 class Interpreter:
     """Full Lisp interpreter"""
+    # An interpreter may be shared between threads: its primitives and prelude
+    # are set up once and never modified afterwards, while each call to run
+    # keeps its mutable state to itself
 
-    def __init__(self):
+    def __init__(self, prelude=[], tierThreshold=1000, onTierUp=None,
+            metrics=None, dataRoot=None):
+        # Primitives map names to their arity and native implementation, which
+        # takes and returns evaluator values (numbers and booleans unboxed)
         self.primOps = {
-            "+": lambda x: lambda y: x + y,
-            "-": lambda x: lambda y: x - y,
-            "*": lambda x: lambda y: x * y,
-            "/": lambda x: lambda y: x / y,
-            "eq?": lambda x: lambda y: x == y,
-            "map": lambda f: lambda lst: map(f, lst),
-            "max": lambda x: lambda y: max(x, y),
-            "min": lambda x: lambda y: min(x, y),
-            "not": lambda x: not x,
-            "and": lambda x: lambda y: x and y,
-            "or": lambda x: lambda y: x or y,
-            ">": lambda x: lambda y: x > y,
-            ">=": lambda x: lambda y: x >= y,
-            "<": lambda x: lambda y: x < y,
-            "<=": lambda x: lambda y: x <= y
+            "+": (2, natives.numeric("+")),
+            "-": (2, natives.numeric("-")),
+            "*": (2, natives.numeric("*")),
+            "/": (2, natives.numeric("/")),
+            "eq?": (2, lambda x, y: x == y),
+            "map": (2, natives.listMap),
+            "filter": (2, natives.listFilter),
+            "foldl": (3, natives.foldl),
+            "foldr": (3, natives.foldr),
+            "length": (1, natives.length),
+            "append": (2, natives.append),
+            "reverse": (1, natives.reverse),
+            "nth": (2, natives.nth),
+            "sum": (1, natives.listSum),
+            "range": (2, natives.listRange),
+            "stream-map": (2, natives.streamMap),
+            "stream-filter": (2, natives.streamFilter),
+            "take": (2, natives.take),
+            "reduce": (3, natives.reduce),
+            "force": (1, natives.force),
+            "vector": (1, natives.vector),
+            "vector-ref": (2, natives.vectorRef),
+            "vector-length": (1, natives.vectorLength),
+            "vector-slice": (3, natives.vectorSlice),
+            "vector->list": (1, natives.vectorToList),
+            "hash": (1, natives.hashFromList),
+            "hash-ref": (2, natives.hashRef),
+            "hash-set": (3, natives.hashSet),
+            "hash-has?": (2, natives.hashHas),
+            "hash-keys": (1, natives.hashKeys),
+            "string-append": (2, natives.stringAppend),
+            "substring": (3, natives.substring),
+            "string-length": (1, natives.stringLength),
+            "string-join": (2, natives.stringJoin),
+            "string-builder": (1, natives.stringBuilder),
+            "builder-add": (2, natives.builderAdd),
+            "builder->string": (1, natives.builderToString),
+            "max": (2, lambda x, y: max(x, y)),
+            "min": (2, lambda x, y: min(x, y)),
+            "not": (1, lambda x: not x),
+            "and": (2, lambda x, y: x and y),
+            "or": (2, lambda x, y: x or y),
+            ">": (2, natives.numeric(">")),
+            ">=": (2, natives.numeric(">=")),
+            "<": (2, natives.numeric("<")),
+            "<=": (2, natives.numeric("<="))
         }
 
-        self.initEnv = map(PrimFunV, self.primOps.values())
-        self.initDeEnv = DeEnv.fromList(self.primOps.keys())
+        # Programs can only read files if given a directory to read them
+        # from, and then only files under it
+        if dataRoot is not None:
+            self.primOps["read-data"] = (1, natives.dataReader(dataRoot))
 
-    def run(self, stx):
-        # Parse input into abstract syntax tree
-        try:
-            parsed = Parser.parse(stx)
-        except LispParsingException, e:
-            raise e
-        except Exception, e:
-            raise LispParsingException(
-                "parse",
-                "encountered unknown error during parsing: " + str(e)
-            )
+        # Top-level bindings are referenced directly, so evaluation starts
+        # with no local bindings. They are kept in a persistent map so that
+        # sessions forked from this one share them
+        self.initEnv = []
+        self.restore(PMap.fromItems(
+            (name, Global(name, NativeFunV(*prim), prim))
+            for name, prim in self.primOps.items()
+        ))
+
+        # Functions called more than tierThreshold times are compiled to
+        # Python code, after which onTierUp (if given) is called with their
+        # CFun. A tierThreshold of None keeps every function tree-walked
+        self.tiering = None
+        if tierThreshold is not None:
+            self.tiering = Tiering(tierThreshold, onTierUp)
+
+        # The time taken by each phase of a run, the exceptions raised, and
+        # the work done by evaluation are recorded in metrics, a
+        # metrics.Metrics which may be shared with other interpreters
+        self.metrics = UNMETERED if metrics is None else metrics
+
+        # The prelude is a list of (name, expression) pairs, each of which may
+        # refer to itself and to the definitions before it
+        for name, stx in prelude:
+            self.define(name, stx)
 
-        # Compile abstract syntax tree into core objects
+    def define(self, name, stx):
+        # Bind name at the top level of this session. Code compiled earlier
+        # keeps referring to any previous binding of the name
+        previous = self.globals
+        glob = Global(name)
+        self.restore(previous.set(name, glob))
         try:
-            compiled = parsed.compile(self.initDeEnv)
-        except LispCompilationException, e:
-            raise e
-        except Exception, e:
-            raise LispCompilationException(
-                "compile",
-                "encountered unknown error during compilation: " + str(e)
-            )
+            glob.value = self.evaluate(self.compile(stx), Budget())
+        except:
+            self.restore(previous)
+            raise
+
+    def bind(self, name, value):
+        # Bind name at the top level of this session to an evaluator value
+        # built in Python, such as a data file read by data.read
+        self.restore(self.globals.set(name, Global(name, value)))
+
+    def require(self, path):
+        # Load the module at path (see modules.load) unless this session has
+        # already done so
+        modules.load(self, path, True)
+
+    def load(self, path):
+        # Load the module at path, even if this session already has
+        modules.load(self, path)
+
+    def snapshot(self):
+        # Top-level bindings of this session. They are never modified, so a
+        # snapshot can be restored or forked from any number of times
+        return self.globals
+
+    def restore(self, snapshot):
+        self.globals = snapshot
+        self.initDeEnv = DeGlobalEnv(snapshot)
+
+    def fork(self, snapshot=None):
+        # New session sharing the bindings of this one (or of the snapshot)
+        # along with all of their compiled code; it costs O(1) to create and
+        # each later definition copies O(log n) of the shared map
+        session = copy.copy(self)
+        session.restore(self.globals if snapshot is None else snapshot)
+        return session
+
+    def compile(self, stx, stats=None, params=()):
+        # Parse input into abstract syntax tree. If a stats dict is given, the
+        # optimizer records the number of nodes it removed in it. Names in
+        # params are bound as local variables, the last one innermost
+        with self.metrics.phase("parse"):
+            try:
+                parsed = Parser.parse(stx)
+            except LispParsingException, e:
+                raise e
+            except Exception, e:
+                raise LispParsingException(
+                    "parse",
+                    "encountered unknown error during parsing: " + str(e)
+                )
+        return self.compileParsed(parsed, stats, params)
+
+    def compileParsed(self, parsed, stats=None, params=()):
+        # Compile abstract syntax tree into optimized core objects
+        with self.metrics.phase("compile"):
+            try:
+                deEnv = self.initDeEnv
+                for name in params:
+                    deEnv = DeExtend(deEnv, name)
+                compiled = parsed.compile(deEnv)
+                return optimizer.optimize(compiled, stats)
+            except LispCompilationException, e:
+                raise e
+            except Exception, e:
+                raise LispCompilationException(
+                    "compile",
+                    "encountered unknown error during compilation: " + str(e)
+                )
+
+    def evaluate(self, compiled, budget, phase=None):
+        # Evaluate core objects into a result value, charging the work to the
+        # budget and measuring it as phase if given
+        if phase is None:
+            phase = self.metrics.phase("eval", budget)
+        with phase:
+            try:
+                with runtime.charging(budget, self.tiering):
+                    return compiled.eval(self.initEnv)
+            except LispRuntimeException, e:
+                raise e
+            except Exception, e:
+                raise LispRuntimeException(
+                    "eval",
+                    "encountered unknown error during runtime: " + str(e)
+                )
+
+    def normalize(self, evaluated, budget, phase=None):
+        # Convert result values into native Python objects. Streams are only
+        # evaluated as they are normalized, so the work is charged to budget
+        if phase is None:
+            phase = self.metrics.phase("normalize", budget)
+        with phase:
+            try:
+                with runtime.charging(budget, self.tiering):
+                    return writer.normalize(evaluated)
+            except LispRuntimeException, e:
+                raise e
+            except Exception, e:
+                raise LispRuntimeException(
+                    "normalize",
+                    "encountered unknown error displaying result: " + str(e)
+                )
+
+    def run(self, stx, maxSteps=None, maxAllocs=None, timeout=None,
+            cancel=None):
+        # maxSteps bounds the number of function applications (and elements
+        # traversed by native list functions) and maxAllocs the number of
+        # cons cells the evaluation may perform. Evaluation is abandoned once
+        # timeout seconds have passed or the cancel threading.Event is set
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        return self.execute(stx, Budget(maxSteps, maxAllocs, deadline, cancel))
 
-        # Evaluate core objects into a result value
+    def execute(self, stx, budget):
+        # Run stx to a native Python object, charging all of the work to budget
+        evaluated = self.evaluate(self.compile(stx), budget)
+        return self.normalize(evaluated, budget)
+
+    def write(self, stx, f, format="json", maxSteps=None, maxAllocs=None,
+            timeout=None, cancel=None):
+        # Like run, but the result is written to the file f as it is
+        # normalized, in one of writer.FORMATS, rather than returned. Memory
+        # use does not grow with the size of the result, only with its depth
+        out = writer.formatWriter(format)(f)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        budget = Budget(maxSteps, maxAllocs, deadline, cancel)
+
+        evaluated = self.evaluate(self.compile(stx), budget)
+        with self.metrics.phase("normalize", budget):
+            try:
+                with runtime.charging(budget, self.tiering):
+                    out.write(evaluated)
+            except (LispRuntimeException, IOError, OSError), e:
+                raise e
+            except Exception, e:
+                raise LispRuntimeException(
+                    "normalize",
+                    "encountered unknown error writing result: " + str(e)
+                )
+
+    def batch(self, params, stx):
+        # Compile stx once, with the names in params free, for evaluating it
+        # over many rows of parameter values; see batch.Batch
+        return batch.Batch(self, params, stx)
+
+    def stream(self, stx, maxSteps=None, maxAllocs=None, timeout=None,
+            cancel=None):
+        # Like run, for expressions producing a list or stream, but yields the
+        # normalized elements one at a time so that the result is never held
+        # in memory at once. Limits apply to the evaluation as a whole
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        budget = Budget(maxSteps, maxAllocs, deadline, cancel)
+
+        # Evaluating the expression and each element is measured as a single
+        # eval phase, and normalizing the elements as a single normalize
+        # phase, however many elements there are
+        compiled = self.compile(stx)
+        evalPhase = self.metrics.phase("eval", budget, True)
         try:
-            evaluated = compiled.eval(self.initEnv)
-        except LispRuntimeException, e:
-            raise e
-        except Exception, e:
-            raise LispRuntimeException(
-                "eval",
-                "encountered unknown error during runtime: " + str(e)
-            )
+            evaluated = self.evaluate(compiled, budget, evalPhase)
+        except:
+            evalPhase.close()
+            raise
+        return self.streamElements(
+            natives.elements(evaluated), budget, evalPhase
+        )
 
-        # Convert result values into native Python objects
+    def streamElements(self, elements, budget, evalPhase):
+        normalizePhase = self.metrics.phase("normalize", budget, True)
         try:
-            return evaluated.normalize()
-        except LispRuntimeException, e:
-            raise e
-        except Exception, e:
-            raise LispRuntimeException(
-                "normalize",
-                "encountered unknown error displaying result: " + str(e)
-            )
+            while True:
+                with evalPhase:
+                    try:
+                        with runtime.charging(budget, self.tiering):
+                            element = next(elements)
+                    except StopIteration:
+                        return
+                    except LispRuntimeException, e:
+                        raise e
+                    except Exception, e:
+                        raise LispRuntimeException(
+                            "eval",
+                            "encountered unknown error during runtime: " +
+                            str(e)
+                        )
+                yield self.normalize(element, budget, normalizePhase)
+        finally:
+            evalPhase.close()
+            normalizePhase.close()
 
 '''
 Tests!
@@ -104,6 +345,7 @@ class InterpreterTest(unittest.TestCase):
         self.assertEqualRun("t", True)
         self.assertEqualRun("nil", False)
         self.assertEqualRun("'hello", "'hello")
+        self.assertEqual(self.interpreter.run(u"(+ 1 2)"), 3)
         self.assertEqualRun("(cons 1 (cons 2 (cons 3 nil)))", [1, 2, 3])
 
     def test_bools(self):
@@ -140,12 +382,573 @@ class InterpreterTest(unittest.TestCase):
             "(map not (list t nil nil t nil))",
             [False, True, True, False, True]
         )
+        self.assertEqualRun("(map not nil)", False)
+        self.assertEqualRun("(cons 1.5 (cons 'a nil))", [1.5, "'a"])
+        self.assertEqualRun("(car (range 3 6))", 3)
+        self.assertEqualRun("(cdr (cdr (range 3 6)))", [5])
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(car (cdr (range 0 1)))"
+        )
+
+    def test_list_library(self):
+        """Test the native list functions"""
+        self.assertEqualRun("(foldl + 0 (range 0 10))", 45)
+        self.assertEqualRun(
+            "(let ((kons (lambda (x xs) (cons x xs))))"
+            " (list (foldl kons nil (list 1 2 3)) (foldr kons nil (list 1 2 3))))",
+            [[3, 2, 1], [1, 2, 3]]
+        )
+        self.assertEqualRun(
+            "(filter (lambda (x) (< x 3)) (list 1 5 2 4))",
+            [1, 2]
+        )
+        self.assertEqualRun("(length (append (list 1 2) (range 0 3)))", 5)
+        self.assertEqualRun("(reverse (list 1 2 3))", [3, 2, 1])
+        self.assertEqualRun("(nth 1 (list 'a 'b))", "'b")
+        self.assertEqualRun("(sum (map (* 2) (range 0 100000)))", 9999900000)
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(reverse (range 0 100))", maxAllocs=99
+        )
+
+    def test_fusion(self):
+        """Test that fused list pipelines behave like unfused ones"""
+        self.assertEqualRun(
+            "(map (+ 1) (filter (lambda (x) (< x 3)) (map (* 2) (list 0 1 2))))",
+            [1, 3]
+        )
+        self.assertEqualRun(
+            "(foldr (lambda (x acc) (cons x acc)) nil (map (* 2) (range 0 3)))",
+            [0, 2, 4]
+        )
+        self.assertEqualRun("(length (filter not (map not (list t nil t))))", 2)
+        # Fusion needs no intermediate lists
+        self.assertEqualRun(
+            "(sum (map (* 2) (map (+ 1) (range 0 100))))",
+            10100
+        )
+        self.assertEqual(
+            self.interpreter.run(
+                "(sum (map (* 2) (map (+ 1) (range 0 100))))",
+                maxAllocs=0
+            ),
+            10100
+        )
+
+    def test_elimination(self):
+        """Test dead binding and common subexpression elimination"""
+        stats = {}
+        stx = """
+            (let ((unused (list 1 2 3))
+                  (x 4)
+                  (also-unused (lambda (y) (y y))))
+              (+ (* (+ x 1) (+ x 1)) (let ((z (+ x 1))) (* z (+ x 1)))))
+        """
+        self.interpreter.compile(stx, stats)
+        self.assertTrue(stats["removed"] > 0)
+        self.assertEqual(self.interpreter.run(stx), 50)
+        self.assertEqualRun("""
+            (loop ((i 0) (acc 0))
+              (if (< i 10)
+                  (recur (+ i 1) (+ acc (+ (* i i) (* i i))))
+                  acc))
+        """, 570)
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(let ((x (car 1))) 5)"
+        )
+
+    def test_vectors(self):
+        """Test vectors and their slices"""
+        self.assertEqualRun("(vector (list 1 'a nil))", [1, "'a", False])
+        self.assertEqualRun("""
+            (let ((v (vector (range 0 50000))))
+              (loop ((i 0) (acc 0))
+                (if (< i 50000)
+                    (recur (+ i 7) (+ acc (vector-ref v i)))
+                    acc)))
+        """, sum(range(0, 50000, 7)))
+        self.assertEqualRun("""
+            (let ((v (vector-slice (vector (range 0 100)) 10 20)))
+              (list (vector-length v)
+                    (vector-ref v 0)
+                    (vector->list (vector-slice v 8 10))
+                    (sum (map (* 2) v))))
+        """, [10, 10, [18, 19], 290])
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(vector-ref (vector (list 1 2)) 2)"
+        )
+
+    def test_hashes(self):
+        """Test persistent hash maps"""
+        self.assertEqualRun(
+            "(hash-ref (hash (list (cons 'a 1) (cons 2 'b))) 'a)",
+            1
+        )
+        self.assertEqualRun("""
+            (let ((h (hash (map (lambda (i) (cons i (* i i))) (range 0 20000)))))
+              (list (hash-ref h 12345)
+                    (hash-has? h 20000)
+                    (hash-has? (hash-set h 20000 'x) 20000)
+                    (length (hash-keys h))))
+        """, [12345 ** 2, False, True, 20000])
+        self.assertEqualRun("(hash (list (cons 'k (list 1 2))))", {"'k": [1, 2]})
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(hash-ref (hash nil) 'missing)"
+        )
+
+    def test_write(self):
+        """Test writing results to files as they are normalized"""
+        out = StringIO()
+        self.interpreter.write(
+            "(list (hash (list (cons 'a \"x\"))) (vector (list 1.5 t)))",
+            out
+        )
+        self.assertEqual(json.loads(out.getvalue()),
+            [{"'a": "x"}, [1.5, True]])
+        out = StringIO()
+        self.interpreter.write("(range 0 5)", out, "sexp")
+        self.assertEqual(out.getvalue(), "(0 1 2 3 4)")
+
+        # Streams are written as they are generated, under the same limits
+        out = StringIO()
+        self.interpreter.write("(range 0 200000)", out, "sexp")
+        self.assertEqual(len(out.getvalue().split()), 200000)
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.write,
+            "(stream-map (lambda (x) x) (range 0 10000))",
+            StringIO(),
+            maxSteps=1000
+        )
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.write, "1", StringIO(), "xml"
+        )
+
+        # Deeply nested results normalize without recursion
+        depth, lst = 0, self.interpreter.run(
+            "(foldl (lambda (x acc) (list acc)) nil (range 0 5000))"
+        )
+        while lst is not False:
+            depth, lst = depth + 1, lst[0]
+        self.assertEqual(depth, 5000)
+
+    def test_streams(self):
+        """Test lazy streams"""
+        self.assertEqualRun("(range 0 5)", [0, 1, 2, 3, 4])
+        self.assertEqualRun("""
+            (take 3 (stream-map (lambda (x) (* x x))
+                                (stream-filter (lambda (x) (> x 10))
+                                               (range 0 1000000000))))
+        """, [121, 144, 169])
+        self.assertEqualRun("""
+            (reduce (lambda (acc x) (+ acc x)) 0
+                    (stream-map (* 2) (range 0 1000000)))
+        """, 999999000000)
+        self.assertEqualRun("(car (cdr (force (range 3 6))))", 4)
+        self.assertEqualRun("(list (range 0 2) (take 1 (list 1 2)))", [[0, 1], [1]])
+        self.assertEqual(
+            list(self.interpreter.stream("(stream-map (+ 1) (range 0 3))")),
+            [1, 2, 3]
+        )
+        self.assertRaises(
+            LispRuntimeException,
+            list,
+            self.interpreter.stream(
+                "(stream-map (lambda (x) x) (range 0 10000))",
+                maxSteps=1000
+            )
+        )
+
+        # Producing each element is charged, so limits stop iteration over
+        # long streams which applies no functions, wherever it happens
+        for stx in ["(length (range 0 1000000000))", "(range 0 1000000000)"]:
+            self.assertRaises(
+                LispRuntimeException,
+                self.interpreter.run, stx, timeout=0.05
+            )
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(range 0 1000000000)", maxSteps=100
+        )
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.write, "(range 0 1000000000)", StringIO(),
+            timeout=0.05
+        )
+
+    def test_data(self):
+        """Test reading data files, from Lisp and from Python"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "points.sexp")
+            with open(path, "w") as f:
+                for i in range(1000):
+                    f.write("(%d (%d %d) 'p%d)\n" % (i, i, i * 2, i))
+            interpreter = Interpreter(dataRoot=directory)
+            self.assertEqual(
+                interpreter.run(
+                    "(sum (map (lambda (r) (nth 1 (nth 1 r))) " +
+                    "(read-data \"points.sexp\")))"
+                ),
+                999000
+            )
+            self.assertEqual(
+                interpreter.run("(length (read-data '" + path + "))"),
+                1000
+            )
+            for name in ['"../points.sexp"', '"/etc/passwd"']:
+                self.assertRaises(
+                    LispRuntimeException,
+                    interpreter.run, "(read-data " + name + ")"
+                )
+            self.assertRaises(
+                LispRuntimeException,
+                interpreter.run, "(read-data 1)"
+            )
+
+            # Without a data directory there is no read-data at all
+            self.assertRaises(
+                LispCompilationException,
+                self.interpreter.run, '(read-data "' + path + '")'
+            )
+            self.interpreter.bind("points", data.read(path))
+            self.assertEqualRun("(nth 2 (nth 7 points))", "'p7")
+            self.assertEqualRun("(car (cdr (car (cdr points))))", [1, 2])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metrics(self):
+        """Test the metrics recorded for runs"""
+        metrics = Metrics()
+        interpreter = Interpreter(metrics=metrics)
+        self.assertEqual(interpreter.run("(reverse (list 1 2 3))"), [3, 2, 1])
+        self.assertRaises(LispRuntimeException, interpreter.run, "(car 1)")
+        self.assertRaises(LispParsingException, interpreter.run, "(")
+        interpreter.run("""
+            (let ((down (lambda (self n)
+                          (if (eq? n 0) 0 (+ 1 (self self (- n 1)))))))
+              (down down 200))
+        """)
+        self.assertEqual(
+            [metrics.latencies[phase].count for phase in metrics.phases],
+            [4, 3, 3, 2]
+        )
+        self.assertEqual(metrics.exceptions, {
+            "LispRuntimeException": 1,
+            "LispParsingException": 1
+        })
+        self.assertEqual(metrics.allocations, 6)
+
+        # A streamed run is one observation of each phase, not one for every
+        # element
+        self.assertEqual(
+            list(interpreter.stream("(stream-map (+ 1) (range 0 50))")),
+            range(1, 51)
+        )
+        self.assertEqual(
+            [metrics.latencies[phase].count for phase in metrics.phases],
+            [5, 4, 4, 3]
+        )
+        self.assertTrue(metrics.maxDepth > 100)
+        self.assertIn("lispy_max_depth", metrics.text())
+        self.assertIs(self.interpreter.metrics.phase("eval"), UNMETERED)
+
+    def test_types(self):
+        """Test type errors found at compile time"""
+        self.assertEqualRun("""
+            (let ((f (lambda (x) (* x 2.5))))
+              (loop ((i 0) (acc 0))
+                (if (< i 4) (recur (+ i 1) (+ acc (f i))) acc)))
+        """, 15.0)
+        self.assertEqualRun("(eq? (+ 1 2) 'a)", False)
+        self.assertEqualRun("(+ 1 (append nil 5))", 6)
+        self.assertRaises(
+            LispCompilationException,
+            self.interpreter.run, "(+ 1 (append nil (list 5)))"
+        )
+        for stx in [
+            "(+ 1 'a)",
+            "(< \"a\" 2)",
+            "(if (+ 1 2) 1 2)",
+            "(let ((x 5)) (x 1))",
+            "(lambda (x) (- (string-length x) (list x)))"
+        ]:
+            self.assertRaises(
+                LispCompilationException,
+                self.interpreter.run, stx
+            )
+        # Operands of unknown type are checked at runtime instead, with the
+        # same outcome
+        for stx in [
+            "((lambda (x) (if x 1 2)) 5)",
+            "((lambda (x) (+ x 1)) t)",
+            "((lambda (x) (< x 2)) \"a\")",
+            "(map (* 2) (list 1 nil))"
+        ]:
+            self.assertRaises(
+                LispRuntimeException,
+                self.interpreter.run, stx
+            )
+        self.assertRaises(
+            LispCompilationException,
+            self.interpreter.run, "(+ t 1)"
+        )
+
+    def test_case(self):
+        """Test dispatch on literal keys with case"""
+        classify = """
+            (lambda (x)
+              (case x
+                ((1 2 3) 'small)
+                ('big 'symbol)
+                (t 'true)
+                (nil 'false)
+                (else 'other)))
+        """
+        self.assertEqualRun(
+            "(map " + classify + " (list 1 2.0 'big t nil 0 'x 4))",
+            ["'small", "'small", "'symbol", "'true", "'false", "'other",
+                "'other", "'other"]
+        )
+        self.assertEqualRun("(case 5 (1 'one))", False)
+
+        # Tables of many rules, with recur in each branch or around the case
+        rules = " ".join(
+            "(r%d (recur (cdr keys) (+ acc %d)))" % (i, i) for i in range(500)
+        )
+        self.assertEqualRun("""
+            (loop ((keys (list 'r1 'r499 'r250 'missing)) (acc 0))
+              (if (eq? keys nil)
+                  acc
+                  (case (car keys)
+                    %s
+                    (else (recur (cdr keys) (+ acc 1000))))))
+        """ % rules, 1750)
+        rules = " ".join("(r%d %d)" % (i, i) for i in range(500))
+        self.assertEqualRun("""
+            (loop ((keys (list 'r1 'r499 'r250 'missing)) (acc 0))
+              (if (eq? keys nil)
+                  acc
+                  (recur (cdr keys)
+                         (+ acc (case (car keys) %s (else 1000))))))
+        """ % rules, 1750)
+
+    def test_strings(self):
+        """Test string literals, ropes and builders"""
+        self.assertEqualRun('"a\\"b\\n"', 'a"b\n')
+        self.assertEqualRun(
+            '(string-append "foo" (substring "xbarx" 1 4))',
+            "foobar"
+        )
+        self.assertEqualRun(
+            '(string-length (string-join (list "a" "b") ", "))',
+            4
+        )
+        self.assertEqualRun('''
+            (let ((s (loop ((i 0) (s ""))
+                       (if (< i 5000) (recur (+ i 1) (string-append s "ab")) s))))
+              (list (string-length s) (substring s 9997 10000)))
+        ''', [10000, "bab"])
+        self.assertEqualRun('''
+            (builder->string
+              (foldl (lambda (x b) (builder-add b x))
+                     (string-builder "<")
+                     (list "a" "b" "c")))
+        ''', "<abc")
+        self.assertEqualRun('''
+            (list (eq? (string-append "a" "b") "ab")
+                  (case "ab" (("x" "ab") 1) (else 2))
+                  (hash-ref (hash (list (cons "k" 3))) "k"))
+        ''', [True, 1, 3])
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, '(substring "abc" 2 1)'
+        )
 
     def test_funcs(self):
         """Test function calls and currying"""
         self.assertEqualRun("(((lambda (x y) (+ x y)) 1) 2)", 3)
         self.assertEqualRun("((lambda (x y) (+ x y)) 1 2)", 3)
         self.assertEqualRun("(let ((x 1) (y 2)) (+ x y))", 3)
+        self.assertEqualRun("((lambda (x y) (- x y)) 10 3)", 7)
+        self.assertEqualRun("(let ((x (+ 1 2)) (y (* x 2))) (- y x))", 3)
+
+    def test_prims(self):
+        """Test primitives used first-class, partially applied and shadowed"""
+        self.assertEqualRun("((+ 1) 2)", 3)
+        self.assertEqualRun("(map (- 10) (list 1 2 3))", [9, 8, 7])
+        self.assertEqualRun("(let ((+ -)) (+ 5 3))", 2)
+        self.assertEqualRun("((lambda (not) (not 5 3)) -)", 2)
+
+    def test_long(self):
+        """Test inputs far longer than the Python recursion limit"""
+        n = 5000
+        nums = " ".join(map(str, range(n)))
+        self.assertEqualRun("(list " + nums + ")", range(n))
+        self.assertEqualRun(
+            "(cond " + "(nil 0) " * n + "(t 1))",
+            1
+        )
+        # Conditions proven boolean alternate with unchecked ones
+        self.assertEqualRun(
+            "(let ((x 5) (y (list nil))) (cond " +
+            "((< x 0) 0) ((car y) 0) " * n + "(t 'end)))",
+            "'end"
+        )
+        self.assertEqualRun(
+            "(let (" + " ".join("(x%d %d)" % (i, i) for i in range(n)) + ")"
+            + " (+ x0 x4999))",
+            4999
+        )
+
+        # Deep nesting is only limited by evaluation, not parsing or compiling
+        deep = Parser.parse("(car " * n + "(list 7)" + ")" * n)
+        self.assertTrue(isinstance(deep.compile(self.interpreter.initDeEnv), CCar))
+
+    def test_tiering(self):
+        """Test that promoting hot functions to compiled code is invisible"""
+        promoted = []
+        prelude = [
+            ("fact", "(lambda (n) (if (<= n 1) 1 (* n (fact (- n 1)))))"),
+            ("fib", """
+                (lambda (n)
+                  (cond ((< n 2) n)
+                        (t (+ (fib (- n 1)) (fib (- n 2))))))
+            """)
+        ]
+        hot = Interpreter(prelude, 5, promoted.append)
+        cold = Interpreter(prelude, None)
+        for stx in [
+            "(fib 15)",
+            "(map fact (range 0 30))",
+            "(sum (map (lambda (x) (car (list x 'a))) (range 0 50)))",
+            "(foldl (lambda (x acc) (cons x acc)) nil (range 0 20))"
+        ]:
+            self.assertEqual(hot.run(stx), cold.run(stx))
+        self.assertTrue(len(promoted) >= 3)
+        self.assertRaises(
+            LispRuntimeException,
+            hot.run, "(fib 30)", maxSteps=10000
+        )
+
+    def test_loop(self):
+        """Test loop/recur iteration"""
+        self.assertEqualRun("""
+            (loop ((i 0) (acc 0))
+              (if (< i 100000)
+                  (recur (+ i 1) (+ acc i))
+                  acc))
+        """, 4999950000)
+        self.assertEqualRun("""
+            (loop ((i 3) (acc nil))
+              (cond ((eq? i 0) acc)
+                    (t (let ((j (- i 1))) (recur j (cons i acc))))))
+        """, [1, 2, 3])
+        self.assertEqualRun("""
+            (loop ((fs nil) (i 0))
+              (if (< i 3)
+                  (recur (cons (lambda (x) (+ x i)) fs) (+ i 1))
+                  (map (lambda (f) (f 10)) fs)))
+        """, [12, 11, 10])
+        self.assertRaises(
+            LispCompilationException,
+            self.interpreter.run, "(loop ((i 0)) (+ 1 (recur i)))"
+        )
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(loop ((i 0)) (recur i))", maxSteps=1000
+        )
+
+    def test_budget(self):
+        """Test step and allocation limits"""
+        omega = "((lambda (x) (x x)) (lambda (x) (x x)))"
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, omega, maxSteps=1000
+        )
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, "(map not (list t t t t))", maxAllocs=7
+        )
+        self.assertEqualRun("((lambda (x) (+ x 1)) 1)", 2)
+        self.assertEqual(
+            self.interpreter.run("(map not (list t t))", 2, 4),
+            [False, False]
+        )
+
+    def test_prelude(self):
+        """Test prelude definitions shared by every run"""
+        interpreter = Interpreter([
+            ("square", "(lambda (x) (* x x))"),
+            ("fact", "(lambda (n) (if (<= n 1) 1 (* n (fact (- n 1)))))"),
+            ("+", "-")
+        ])
+        self.assertEqual(interpreter.run("(square (fact 4))"), 576)
+        self.assertEqual(interpreter.run("(+ 5 3)"), 2)
+        self.assertEqual(interpreter.run("(let ((square 2)) square)"), 2)
+
+    def test_sessions(self):
+        """Test forking sessions off shared bindings"""
+        base = Interpreter([("x", "1"), ("f", "(lambda (y) (+ x y))")])
+        snapshot = base.snapshot()
+
+        session = base.fork()
+        session.define("x", "10")
+        session.define("g", "(lambda (y) (+ x (f y)))")
+        self.assertEqual(session.run("(g 1)"), 12)
+        self.assertRaises(LispCompilationException, base.run, "(g 1)")
+        self.assertEqual(base.run("(+ x (f 1))"), 3)
+
+        base.define("x", "100")
+        self.assertEqual(base.run("x"), 100)
+        self.assertEqual(base.fork(snapshot).run("x"), 1)
+        self.assertEqual(session.run("x"), 10)
+
+        self.assertRaises(LispRuntimeException, session.define, "x", "(car 1)")
+        self.assertEqual(session.run("x"), 10)
+
+        base.restore(snapshot)
+        self.assertEqual(base.run("x"), 1)
+
+    def test_timeout(self):
+        """Test wall-clock timeouts and cancellation"""
+        omega = "((lambda (x) (x x)) (lambda (x) (x x)))"
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, omega, timeout=0.05
+        )
+
+        cancel = threading.Event()
+        threading.Timer(0.05, cancel.set).start()
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.run, omega, cancel=cancel
+        )
+
+    def test_threads(self):
+        """Test one interpreter serving several threads at once"""
+        interpreter = Interpreter([("double", "(lambda (x) (* 2 x))")])
+        results = {}
+
+        def worker(n):
+            results[n] = [
+                interpreter.run("(map double (list %d %d))" % (n, i))
+                for i in range(200)
+            ]
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(8):
+            self.assertEqual(results[n], [[2 * n, 2 * i] for i in range(200)])
 
     def test_recursive(self):
         """Test recursive definitions and calls"""
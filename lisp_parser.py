@@ -1,116 +1,403 @@
 from lisp_exceptions import LispParsingException
 from ast import *
+from val import SymV, StrV
+import unittest
 import re
 
+class Token(object):
+    """Lexical token annotated with its position in the source"""
+    OPEN, CLOSE, NUM, SYM, ID, STR = "(", ")", "num", "sym", "id", "str"
+
+    # Large inputs produce millions of tokens
+    __slots__ = ["kind", "value", "line", "col"]
+
+    def __init__(self, kind, value, line, col):
+        self.kind, self.value, self.line, self.col = kind, value, line, col
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return (self.kind, self.value, self.line, self.col) == \
+                (other.kind, other.value, other.line, other.col)
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Token(" + self.kind + ", " + repr(self.value) + ", " + \
+            str(self.line) + ":" + str(self.col) + ")"
+
+    def position(self):
+        return "line " + str(self.line) + ", column " + str(self.col)
+
 class Parser:
     """Parses string into abstract syntax tree"""
 
+    # Master pattern for the scanner. Alternatives are tried in order; numbers
+    # must be followed by a delimiter so that atoms such as 1+ stay atoms
+    scanner = re.compile(r"""
+          (?P<space>\s+)
+        | (?P<comment>;[^\n]*)
+        | (?P<open>\()
+        | (?P<close>\))
+        | (?P<str>"(?:[^"\\]|\\.)*")
+        | (?P<int>[+-]?\d+(?=[\s()";]|\Z))
+        | (?P<float>[+-]?(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][+-]?\d+)?
+            (?=[\s()";]|\Z))
+        | (?P<atom>[^\s()";]+)
+        | (?P<error>.)
+    """, re.VERBOSE | re.DOTALL)
+
     @staticmethod
     def tokenize(stx):
-        # Pad parentheses for convenient tokenizing by whitespace
-        stx = re.sub(r"([\(\)])", r" \1 ", stx)
-        parts = re.split(r"\s+", stx)
+        # Scan the input in a single pass, tracking line and column numbers
+        tkns = []
+        line, lineStart = 1, 0
 
-        if parts[0] == "":
-            parts = parts[1:]
-        if parts[-1] == "":
-            parts = parts[:-1]
+        for match in Parser.scanner.finditer(stx):
+            kind = match.lastgroup
+            start = match.start()
 
-        return parts
+            if kind == "space":
+                # Only whitespace and strings may span several lines
+                newlines = stx.count("\n", start, match.end())
+                if newlines > 0:
+                    line += newlines
+                    lineStart = stx.rfind("\n", start, match.end()) + 1
+                continue
+            elif kind == "comment":
+                continue
+
+            col = start - lineStart + 1
+            if kind == "open":
+                tkns.append(Token(Token.OPEN, "(", line, col))
+            elif kind == "close":
+                tkns.append(Token(Token.CLOSE, ")", line, col))
+            elif kind == "int":
+                tkns.append(Token(Token.NUM, int(match.group()), line, col))
+            elif kind == "float":
+                tkns.append(Token(Token.NUM, float(match.group()), line, col))
+            elif kind == "atom":
+                text = match.group()
+                kind = Token.ID
+                if text[0] == "'" and len(text) > 1:
+                    kind, text = Token.SYM, text[1:]
+                if type(text) is str:
+                    # Only byte strings can be interned; names read from
+                    # unicode input compare equal to them all the same
+                    text = intern(text)
+                tkns.append(Token(kind, text, line, col))
+            elif kind == "str":
+                text = match.group()
+                tkns.append(Token(
+                    Token.STR,
+                    text[1:-1].decode("string_escape"),
+                    line,
+                    col
+                ))
+
+                newlines = text.count("\n")
+                if newlines > 0:
+                    line += newlines
+                    lineStart = stx.rfind("\n", start, match.end()) + 1
+            else:
+                raise LispParsingException(
+                    "tokenize",
+                    "unexpected character " + repr(match.group()) + \
+                    " at line " + str(line) + ", column " + str(col)
+                )
+
+        return tkns
 
     @staticmethod
     def lex(tkns):
-        if len(tkns) == 1:
-            return tkns[0]
-        elif tkns[0] != "(" or tkns[-1] != ")":
+        # Group tokens into nested lists, insisting on a single s-expression
+        exprs = Parser.lexAll(tkns)
+        if len(exprs) != 1:
+            raise LispParsingException(
+                "lex",
+                "expected a single atomic or s-expression; got " + \
+                str(len(exprs))
+            )
+        return exprs[0]
+
+    @staticmethod
+    def lexAll(tkns):
+        # Group tokens into nested lists, one per top-level s-expression
+        stack = [[]]
+        opens = []
+        for token in tkns:
+            if token.kind == Token.OPEN:
+                expr = []
+                stack[-1].append(expr)
+                stack.append(expr)
+                opens.append(token)
+            elif token.kind == Token.CLOSE:
+                if len(opens) == 0:
+                    raise LispParsingException(
+                        "lex",
+                        "unexpected ')' at " + token.position()
+                    )
+                stack.pop()
+                opens.pop()
+            else:
+                stack[-1].append(token)
+
+        if len(opens) > 0:
             raise LispParsingException(
                 "lex",
-                "expected atomic or s-expression; got " + str(tkons)
+                "unclosed '(' at " + opens[-1].position()
             )
+        return stack[0]
+
+    @staticmethod
+    def form(expr):
+        # Name of the special form or function an s-expression starts with
+        head = expr[0]
+        if type(head) is Token and head.kind == Token.ID:
+            return head.value
         else:
-            stack = [[]]
-            topExpr = stack[0]
-            for token in tkns[1:]:
-                currExpr = stack[-1]
-
-                if token == "(":
-                    currExpr = []
-                    stack.append(currExpr)
-                elif token == ")":
-                    if currExpr == topExpr:
-                        break
-                    else:
-                        stack[-2].append(currExpr)
-                        stack = stack[:-1]
-                else:
-                    currExpr.append(token)
-            return topExpr
+            return None
 
     @staticmethod
-    def interpret(expr):
-        if type(expr) is list:
-            ast = map(Parser.interpret, expr)
+    def subExprs(expr):
+        # S-expressions within a special form which are themselves expressions
+        if len(expr) == 0:
+            raise LispParsingException("interpret", "empty expression: ()")
 
-            if expr[0] == "if":
-                return ASTIf(
-                    ast[1],
-                    ast[2],
-                    ast[3]
-                )
-            elif expr[0] == "cond":
-                return ASTCond(
-                    map(lambda b: map(Parser.interpret, b), expr[1:])
+        form = Parser.form(expr)
+        if form == "if":
+            return expr[1:4]
+        elif form == "cond":
+            return [e for branch in expr[1:] for e in branch]
+        elif form in ["cons", "car", "cdr", "list"]:
+            return expr[1:]
+        elif form == "lambda":
+            return expr[2:3]
+        elif form in ["let", "loop"]:
+            return [bind[1] for bind in expr[1]] + expr[2:3]
+        elif form == "recur":
+            return expr[1:]
+        elif form == "case":
+            if len(expr) < 2:
+                raise LispParsingException(
+                    "interpret",
+                    "case requires a key expression to dispatch on"
                 )
-            elif expr[0] == "cons":
-                return ASTCons(ast[1], ast[2])
-            elif expr[0] == "car":
-                return ASTCar(ast[1])
-            elif expr[0] == "cdr":
-                return ASTCdr(ast[1])
-            elif expr[0] == "list":
-                return ASTList(ast[1:])
-            elif expr[0] == "lambda":
-                return ASTFun(
-                    map(Parser.interpret, expr[1]),
-                    Parser.interpret(expr[2])
-                )
-            elif expr[0] == "let":
-                bindings = expr[1]
-                values, names = \
-                    map(list, zip(*[
-                        [Parser.interpret(str(e))
-                            for e in bind]
-                        for bind in bindings
-                    ]))
-
-                return ASTWith(
-                    values,
-                    names,
-                    Parser.interpret(expr[2])
-                )
-            else:
-                return ASTCall(
-                    ast[0],
-                    ast[1:]
+            for clause in expr[2:]:
+                if type(clause) is not list or len(clause) != 2:
+                    raise LispParsingException(
+                        "interpret",
+                        "case clauses must be (keys body); got " + str(clause)
+                    )
+            return expr[1:2] + [clause[1] for clause in expr[2:]]
+        else:
+            return expr
+
+    @staticmethod
+    def build(expr, ast):
+        # Construct the AST for an s-expression given its interpreted
+        # sub-expressions
+        form = Parser.form(expr)
+        if form == "if":
+            return ASTIf(
+                ast[0],
+                ast[1],
+                ast[2]
+            )
+        elif form == "cond":
+            return ASTCond(
+                [ast[i:i + 2] for i in range(0, len(ast), 2)]
+            )
+        elif form == "cons":
+            return ASTCons(ast[0], ast[1])
+        elif form == "car":
+            return ASTCar(ast[0])
+        elif form == "cdr":
+            return ASTCdr(ast[0])
+        elif form == "list":
+            return ASTList(ast)
+        elif form == "lambda":
+            return ASTFun(
+                map(Parser.interpretAtom, expr[1]),
+                ast[0]
+            )
+        elif form == "let":
+            return ASTWith(
+                [Parser.interpretAtom(bind[0]) for bind in expr[1]],
+                ast[:-1],
+                ast[-1]
+            )
+        elif form == "loop":
+            return ASTLoop(
+                [Parser.interpretAtom(bind[0]) for bind in expr[1]],
+                ast[:-1],
+                ast[-1]
+            )
+        elif form == "recur":
+            return ASTRecur(ast)
+        elif form == "case":
+            cases = [Parser.caseKeys(clause[0]) for clause in expr[2:]]
+            if None in cases[:-1]:
+                raise LispParsingException(
+                    "interpret",
+                    "else must be the last clause of a case"
                 )
+            return ASTCase(ast[0], cases, ast[1:])
         else:
-            if expr == "t":
-                return ASTBool(True)
-            elif expr == "nil":
-                return ASTBool(False)
-            elif expr == "nil":
-                return ASTBool(False)
-            elif expr[0] == "'":
-                return ASTSym(expr[1:])
+            return ASTCall(
+                ast[0],
+                ast[1:]
+            )
+
+    @staticmethod
+    def interpret(expr):
+        # An explicit stack is used rather than recursion so that nesting depth
+        # is not bounded by the Python stack
+        results = []
+        stack = [(expr, None)]
+
+        while len(stack) > 0:
+            expr, numSubs = stack.pop()
+
+            if type(expr) is not list:
+                results.append(Parser.interpretAtom(expr))
+            elif numSubs is None:
+                subs = Parser.subExprs(expr)
+                stack.append((expr, len(subs)))
+                for sub in reversed(subs):
+                    stack.append((sub, None))
             else:
-                try:
-                    return ASTNum(int(expr))
-                except ValueError:
-                    try:
-                        return ASTNum(float(expr))
-                    except ValueError:
-                        return ASTId(expr)
+                start = len(results) - numSubs
+                ast = results[start:]
+                del results[start:]
+                results.append(Parser.build(expr, ast))
+
+        return results[0]
+
+    @staticmethod
+    def caseKeys(keys):
+        # Values selecting a case clause, or None for an else clause. A clause
+        # may list several keys or give a single one
+        if type(keys) is not list:
+            if keys.kind == Token.ID and keys.value == "else":
+                return None
+            keys = [keys]
+        return map(Parser.literal, keys)
+
+    @staticmethod
+    def literal(expr):
+        # Value of a literal key. As in quoted data, symbols may be written
+        # with or without a quote
+        if type(expr) is list:
+            raise LispParsingException(
+                "interpret",
+                "case keys must be numbers, strings, symbols or booleans; " + \
+                "got " + str(expr)
+            )
+        elif expr.kind == Token.NUM:
+            return expr.value
+        elif expr.kind == Token.STR:
+            return StrV(expr.value)
+        elif expr.value == "t":
+            return True
+        elif expr.value == "nil":
+            return False
+        else:
+            return SymV(expr.value)
+
+    @staticmethod
+    def interpretAtom(expr):
+        if type(expr) is list:
+            raise LispParsingException(
+                "interpret",
+                "expected an identifier; got " + str(expr)
+            )
+        elif expr.kind == Token.NUM:
+            return ASTNum(expr.value)
+        elif expr.kind == Token.SYM:
+            return ASTSym(expr.value)
+        elif expr.kind == Token.STR:
+            return ASTStr(expr.value)
+        elif expr.value == "t":
+            return ASTBool(True)
+        elif expr.value == "nil":
+            return ASTBool(False)
+        else:
+            return ASTId(expr.value)
 
     @staticmethod
     def parse(stx):
-        return Parser.interpret(Parser.lex(Parser.tokenize(stx)))
\ No newline at end of file
+        return Parser.interpret(Parser.lex(Parser.tokenize(stx)))
+
+'''
+Tests!
+'''
+
+class ParserTest(unittest.TestCase):
+    """Test class for the scanner and parser"""
+    def test_tokenize(self):
+        self.assertEqual(
+            Parser.tokenize("(f 1 -2.5 'sym)"),
+            [
+                Token(Token.OPEN, "(", 1, 1),
+                Token(Token.ID, "f", 1, 2),
+                Token(Token.NUM, 1, 1, 4),
+                Token(Token.NUM, -2.5, 1, 6),
+                Token(Token.SYM, "sym", 1, 11),
+                Token(Token.CLOSE, ")", 1, 15)
+            ]
+        )
+
+    def test_positions(self):
+        tkns = Parser.tokenize("; header\n(+ 1\n   ; note\n   x) \"a\\nb\"")
+        self.assertEqual(
+            [(t.value, t.line, t.col) for t in tkns],
+            [("(", 2, 1), ("+", 2, 2), (1, 2, 4), ("x", 4, 4), (")", 4, 5),
+                ("a\nb", 4, 7)]
+        )
+
+    def test_atoms(self):
+        self.assertEqual(
+            [t.kind for t in Parser.tokenize("1+ -x 1e3 .5 - '")],
+            [Token.ID, Token.ID, Token.NUM, Token.NUM, Token.ID, Token.ID]
+        )
+
+    def test_errors(self):
+        for stx in ["(+ 1 2", "(+ 1 2))", "1 2", "\"open"]:
+            self.assertRaises(LispParsingException, Parser.parse, stx)
+
+    def test_unicode(self):
+        self.assertEqual(
+            repr(Parser.parse(u"(f 'a)")),
+            repr(Parser.parse("(f 'a)"))
+        )
+
+    def test_lexAll(self):
+        exprs = Parser.lexAll(Parser.tokenize("(f x) 2 ; end\n(g)"))
+        self.assertEqual(len(exprs), 3)
+        self.assertEqual(Parser.form(exprs[2]), "g")
+        self.assertEqual(Parser.lexAll([]), [])
+
+    def test_case(self):
+        case = Parser.parse("(case x ((1 'a t) 2) (b 3) (else 4))")
+        self.assertEqual(case.cases, [[1, SymV("a"), True], [SymV("b")], None])
+        for stx in ["(case x (1))", "(case x (else 1) (2 3))",
+                "(case x (((1)) 2))", "(case)"]:
+            self.assertRaises(LispParsingException, Parser.parse, stx)
+
+    def test_parse(self):
+        self.assertEqual(
+            repr(Parser.parse("(let ((x 1)) (if t x 2))")),
+            repr(ASTWith(
+                [ASTId("x")],
+                [ASTNum(1)],
+                ASTIf(ASTBool(True), ASTId("x"), ASTNum(2))
+            ))
+        )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import bisect
+import tempfile
+import threading
+import unittest
+from lisp_exceptions import *
+from runtime import Budget
+
+'''
+Registry of counters and latency histograms describing an interpreter's work
+'''
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets"""
+    def __init__(self, bounds):
+        # counts[i] is the number of values at most bounds[i] (and above the
+        # previous bound); the last count is of values above every bound
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count, self.sum = 0, 0.0
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Histogram(" + str(self.count) + ", " + str(self.sum) + ")"
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # (bound, number of values at most bound) pairs, ending with infinity
+        total, pairs = 0, []
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class Phase(object):
+    """Measurement of one phase of a run, used as a with block"""
+    def __init__(self, metrics, name, budget, split):
+        # A split phase may be entered any number of times, and is recorded
+        # as a single observation of their total when it is closed
+        self.metrics, self.name, self.budget = metrics, name, budget
+        self.split, self.elapsed, self.allocated = split, 0.0, 0
+        self.excType = None
+
+    def __enter__(self):
+        budget = self.budget
+        if budget is not None:
+            # The evaluator's stack is sampled whenever the budget is polled
+            self.base = depth(sys._getframe(1))
+            self.allocs = budget.allocs
+            budget.watch(self.probe)
+        self.start = time.time()
+
+    def __exit__(self, excType, exc, tb):
+        self.elapsed += time.time() - self.start
+        budget = self.budget
+        if budget is not None:
+            budget.watch(None)
+            self.allocated += self.allocs - budget.allocs
+        if excType is not None:
+            self.excType = excType
+        if not self.split:
+            self.close()
+
+    def close(self):
+        self.metrics.record(
+            self.name, self.elapsed, self.allocated, self.excType
+        )
+
+    def probe(self):
+        self.metrics.reach(depth(sys._getframe(1)) - self.base)
+
+class Metrics(object):
+    """Counters and latency histograms shared by the runs of interpreters"""
+    # Phases of Interpreter.run, each timed separately
+    phases = ["parse", "compile", "eval", "normalize"]
+
+    # Upper bounds in seconds of the latency histograms' buckets
+    bounds = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict(
+            (phase, Histogram(self.bounds)) for phase in self.phases
+        )
+        # Exceptions raised out of each phase, by LispException subclass
+        self.exceptions = {}
+        # Cons cells and other values charged to evaluation budgets
+        self.allocations = 0
+        # Deepest evaluator stack seen, in Python frames, as sampled every
+        # Budget.probeInterval steps
+        self.maxDepth = 0
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Metrics(" + str(self.latencies["eval"].count) + " runs)"
+
+    def phase(self, name, budget=None, split=False):
+        # Time the with block as the named phase. Given the budget the phase
+        # charges, its allocations and evaluation depth are measured too. A
+        # split phase is timed over every with block it is used for, and
+        # only recorded once closed
+        return Phase(self, name, budget, split)
+
+    def record(self, name, elapsed, allocated, excType):
+        with self.lock:
+            self.latencies[name].observe(elapsed)
+            self.allocations += allocated
+            if excType is not None and issubclass(excType, LispException):
+                self.exceptions[excType.__name__] = \
+                    self.exceptions.get(excType.__name__, 0) + 1
+
+    def reach(self, depth):
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def text(self):
+        # The metrics in Prometheus' text exposition format
+        with self.lock:
+            lines = [
+                "# HELP lispy_phase_seconds Time spent in each phase of runs",
+                "# TYPE lispy_phase_seconds histogram"
+            ]
+            for phase in self.phases:
+                histogram = self.latencies[phase]
+                for bound, count in histogram.cumulative():
+                    lines.append(
+                        'lispy_phase_seconds_bucket{phase="%s",le="%s"} %d' %
+                        (phase, "+Inf" if bound == float("inf") else
+                            repr(bound), count)
+                    )
+                lines.append('lispy_phase_seconds_sum{phase="%s"} %r' %
+                    (phase, histogram.sum))
+                lines.append('lispy_phase_seconds_count{phase="%s"} %d' %
+                    (phase, histogram.count))
+
+            lines += [
+                "# HELP lispy_exceptions_total Exceptions raised, by type",
+                "# TYPE lispy_exceptions_total counter"
+            ]
+            for name, count in sorted(self.exceptions.items()):
+                lines.append('lispy_exceptions_total{type="%s"} %d' %
+                    (name, count))
+
+            lines += [
+                "# HELP lispy_allocations_total Values allocated by runs",
+                "# TYPE lispy_allocations_total counter",
+                "lispy_allocations_total %d" % self.allocations,
+                "# HELP lispy_max_depth Deepest evaluator stack, in frames",
+                "# TYPE lispy_max_depth gauge",
+                "lispy_max_depth %d" % self.maxDepth
+            ]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Write text() to path, replacing it in one step so that a scraper
+        # never reads a partial dump
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.text())
+            os.rename(temp, path)
+        except:
+            os.remove(temp)
+            raise
+
+class Unmetered(object):
+    """Stand-in for Metrics which measures nothing, at next to no cost"""
+    def __enter__(self):
+        pass
+
+    def __exit__(self, excType, exc, tb):
+        pass
+
+    def phase(self, name, budget=None, split=False):
+        return self
+
+    def close(self):
+        pass
+
+# Metrics of interpreters created without any
+UNMETERED = Unmetered()
+
+def depth(frame):
+    count = 0
+    while frame is not None:
+        count += 1
+        frame = frame.f_back
+    return count
+
+'''
+Tests!
+'''
+
+class MetricsTest(unittest.TestCase):
+    """Test class for the metrics registry"""
+    def test_histogram(self):
+        histogram = Histogram([1, 2])
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.cumulative(),
+            [(1, 2), (2, 3), (float("inf"), 4)]
+        )
+        self.assertEqual(histogram.sum, 6)
+
+    def test_phase(self):
+        metrics = Metrics()
+        budget = Budget()
+
+        def recurse(n):
+            budget.alloc(1)
+            budget.steps = -1
+            budget.exhausted()
+            if n > 0:
+                recurse(n - 1)
+
+        with metrics.phase("eval", budget):
+            recurse(50)
+        self.assertTrue(50 <= metrics.maxDepth < 60)
+        self.assertEqual(metrics.allocations, 51)
+        self.assertIs(budget.probe, None)
+
+        # A split phase is one observation, however many blocks it spans
+        phase = metrics.phase("normalize", budget, True)
+        for i in range(3):
+            with phase:
+                budget.alloc(1)
+        self.assertEqual(metrics.latencies["normalize"].count, 0)
+        phase.close()
+        self.assertEqual(metrics.latencies["normalize"].count, 1)
+        self.assertEqual(metrics.allocations, 54)
+
+        def fail():
+            with metrics.phase("parse"):
+                raise LispParsingException("parse", "oops")
+        self.assertRaises(LispParsingException, fail)
+        self.assertEqual(metrics.exceptions, {"LispParsingException": 1})
+        self.assertEqual(metrics.latencies["parse"].count, 1)
+
+    def test_dump(self):
+        metrics = Metrics()
+        with metrics.phase("compile"):
+            pass
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "metrics.prom")
+            metrics.dump(path)
+            with open(path) as f:
+                text = f.read()
+        finally:
+            os.remove(path)
+            os.rmdir(directory)
+        self.assertIn('lispy_phase_seconds_count{phase="compile"} 1\n', text)
+        self.assertIn('lispy_phase_seconds_bucket{phase="eval",le="+Inf"} 0\n',
+            text)
+        self.assertIn("lispy_allocations_total 0\n", text)
+
+if __name__ == "__main__":
+    unittest.main()
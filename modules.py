@@ -0,0 +1,364 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import cPickle as pickle
+from cStringIO import StringIO
+from lisp_exceptions import LispParsingException, LispRuntimeException, \
+    LispCompilationException
+from lisp_parser import Parser, Token
+from env import Global
+from runtime import Budget
+from optimizer import valueType
+
+'''
+Loading of source files into an interpreter session, with the compiled code of
+each file cached on disk
+'''
+
+# Recorded in every cache file, which is ignored unless it matches. It must be
+# bumped whenever the compiled representation changes: the core classes, the
+# optimizer's output or the set of primitives
+VERSION = 6
+
+# Compiled code is cached in this directory next to each source file, much as
+# Python caches bytecode in __pycache__. Cache files are pickles, and loading a
+# pickle can run arbitrary code: anyone able to write to this directory can
+# run code in every interpreter that loads a module from it, so it must only
+# be writable by users trusted to do so
+CACHE_DIR = "__lispcache__"
+
+# Errors raised by unpickling a corrupt or out-of-date cache, such as one
+# naming a class or module that no longer exists
+UNPICKLING_ERRORS = (
+    EOFError, ValueError, TypeError, AttributeError, ImportError, IndexError,
+    KeyError, pickle.UnpicklingError
+)
+
+# Modules named by require and load are looked up relative to the requiring
+# file, with this suffix added
+SUFFIX = ".lisp"
+
+class StaleCache(Exception):
+    """Cached code referring to bindings the session no longer provides"""
+    pass
+
+def load(interpreter, path, once=False):
+    # Evaluate the definitions of the module at path into the session. With
+    # once set, a module the session has already loaded is skipped. Loaded
+    # modules are recorded in the globals themselves, so that snapshots and
+    # forks agree on them
+    path = os.path.abspath(path)
+    key = ("module", path)
+    if once and key in interpreter.globals:
+        return
+
+    previous = interpreter.snapshot()
+    try:
+        try:
+            stat = os.stat(path)
+        except OSError, e:
+            raise LispParsingException(
+                "load",
+                "cannot read module " + path + ": " + e.strerror
+            )
+
+        items = cached(path, stat)
+        if items is not None:
+            try:
+                execute(interpreter, path, items, None)
+            except StaleCache:
+                interpreter.restore(previous)
+                items = None
+
+        if items is None:
+            with open(path, "rb") as f:
+                source = f.read()
+            items = []
+            execute(interpreter, path, parseModule(source), items)
+            writeCache(path, stat, digest(source), items)
+
+        interpreter.restore(interpreter.globals.set(key, True))
+    except:
+        interpreter.restore(previous)
+        raise
+
+def execute(interpreter, path, items, compiled):
+    # Run the items of a module in order. When compiled is None, definitions
+    # hold code pickled by an earlier run; otherwise they hold syntax trees,
+    # and the items are appended to compiled with their code pickled
+    directory = os.path.dirname(path)
+    for item in items:
+        form, name = item[0], item[1]
+        if form == "define":
+            # As with Interpreter.define, the binding exists before its
+            # expression is compiled so that it may refer to itself
+            glob = Global(name)
+            interpreter.restore(interpreter.globals.set(name, glob))
+            if compiled is None:
+                code = loads(interpreter, item[2])
+            else:
+                code = interpreter.compileParsed(item[2])
+                compiled.append((form, name, dumps(interpreter, code)))
+            glob.value = interpreter.evaluate(code, Budget())
+        else:
+            load(
+                interpreter,
+                os.path.join(directory, name + SUFFIX),
+                form == "require"
+            )
+            if compiled is not None:
+                compiled.append(item)
+
+def parseModule(stx):
+    # A module is a sequence of (define name expr), (require name) and
+    # (load name) forms
+    items = []
+    for expr in Parser.lexAll(Parser.tokenize(stx)):
+        form = Parser.form(expr) if type(expr) is list and expr else None
+        arity = {"define": 3, "require": 2, "load": 2}.get(form)
+        if arity is None or len(expr) != arity or \
+                type(expr[1]) is list or expr[1].kind != Token.ID:
+            raise LispParsingException(
+                "module",
+                "expected a define, require or load form; got " + \
+                (str(expr[0]) if type(expr) is list and expr else str(expr))
+            )
+        if form == "define":
+            items.append((form, expr[1].value, Parser.interpret(expr[2])))
+        else:
+            items.append((form, expr[1].value))
+    return items
+
+def digest(source):
+    return hashlib.sha1(source).hexdigest()
+
+def cacheFile(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, CACHE_DIR, name + "c")
+
+def cached(path, stat):
+    # Items cached for the current contents of the module at path, or None.
+    # A cache recording the source's modification time and size is trusted
+    # without reading the source; otherwise the source is hashed, and the
+    # cache is refreshed if its contents turn out to be unchanged
+    try:
+        with open(cacheFile(path), "rb") as f:
+            version, sourceDigest, mtime, size = pickle.load(f)
+            if version != VERSION:
+                return None
+            unchanged = (mtime, size) == (stat.st_mtime, stat.st_size)
+            if not unchanged:
+                with open(path, "rb") as source:
+                    if digest(source.read()) != sourceDigest:
+                        return None
+            items = pickle.load(f)
+    except (IOError,) + UNPICKLING_ERRORS:
+        return None
+
+    if not unchanged:
+        writeCache(path, stat, sourceDigest, items)
+    return items
+
+def writeCache(path, stat, sourceDigest, items):
+    # The cache is written to a temporary file and renamed into place, so
+    # concurrent loads never see a partial cache. Failing to write it (say,
+    # to a read-only directory) only costs later loads a recompilation
+    if any(item[0] == "define" and item[2] is None for item in items):
+        return
+
+    directory = os.path.dirname(cacheFile(path))
+    try:
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        fd, temp = tempfile.mkstemp(dir=directory)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            header = (VERSION, sourceDigest, stat.st_mtime, stat.st_size)
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, cacheFile(path))
+    except (IOError, OSError):
+        os.remove(temp)
+
+'''
+Pickling of compiled code. Globals and primitive operations belong to the
+session, so they are pickled by name and linked to the loading session's own.
+The optimizer specializes code by the types of the globals it refers to, so
+each global is pickled along with the type its value had when the code was
+compiled
+'''
+
+def dumps(interpreter, code):
+    # Pickled code, or None if it cannot be pickled (for instance if it is
+    # nested too deeply)
+    primNames = dict(
+        (id(prim[1]), name) for name, prim in interpreter.primOps.items()
+    )
+
+    def persistentId(obj):
+        if type(obj) is Global:
+            return ("global", obj.name, valueType(obj.value))
+        elif id(obj) in primNames:
+            return ("prim", primNames[id(obj)])
+        else:
+            return None
+
+    out = StringIO()
+    pickler = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistentId
+    try:
+        pickler.dump(code)
+    except (RuntimeError, TypeError, pickle.PicklingError):
+        return None
+    return out.getvalue()
+
+def loads(interpreter, data):
+    def persistentLoad(pid):
+        # A primitive inlined into the cached code must still be bound to the
+        # same name, and a global whose type the code was specialized for must
+        # still have that type, or compiling afresh would give different code
+        kind, name = pid[:2]
+        glob = interpreter.globals.get(name)
+        if glob is None or kind == "prim" and glob.prim is None:
+            raise StaleCache(name)
+        if kind == "global":
+            if pid[2] is not None and valueType(glob.value) != pid[2]:
+                raise StaleCache(name)
+            return glob
+        return glob.prim[1]
+
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = persistentLoad
+    try:
+        return unpickler.load()
+    except UNPICKLING_ERRORS, e:
+        raise StaleCache(str(e))
+
+'''
+Tests!
+'''
+
+class ModulesTest(unittest.TestCase):
+    """Test class for module loading and its cache"""
+    def setUp(self):
+        from interpreter import Interpreter
+        self.interpreter = Interpreter()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, stx):
+        path = os.path.join(self.directory, name + SUFFIX)
+        with open(path, "w") as f:
+            f.write(stx)
+        return path
+
+    def test_parse(self):
+        items = parseModule("(require base) ; comment\n(define x (+ y 1))")
+        self.assertEqual([item[:2] for item in items],
+            [("require", "base"), ("define", "x")])
+        for stx in ["(+ 1 2)", "(define x)", "(require (f))", "5"]:
+            self.assertRaises(LispParsingException, parseModule, stx)
+
+    def test_cache(self):
+        self.write("base", "(define twice (lambda (x) (* 2 x)))")
+        path = self.write("main", """
+            (require base)
+            (define fact (lambda (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+            (define answer (twice (fact 4)))
+        """)
+        self.interpreter.require(path)
+        self.assertTrue(os.path.exists(cacheFile(path)))
+        self.assertEqual(self.interpreter.run("answer"), 48)
+
+        # Loading from the cache must compile nothing
+        session = self.interpreter.fork()
+        session.compileParsed = None
+        session.load(path)
+        del session.compileParsed
+        self.assertEqual(session.run("(fact 5)"), 120)
+
+        # Touching the source only refreshes the cache, while changing it
+        # recompiles the module
+        os.utime(path, (0, 0))
+        session.load(path)
+        self.assertEqual(pickle.load(open(cacheFile(path), "rb"))[2], 0)
+        with open(path, "r+") as f:
+            f.write(f.read().replace("(fact 4)", "(fact 3)"))
+        self.interpreter.load(path)
+        self.assertEqual(self.interpreter.run("answer"), 12)
+
+    def test_stale(self):
+        path = self.write("main", "(define y (+ 1 (f 2)))")
+        self.interpreter.define("f", "(lambda (x) x)")
+        self.interpreter.require(path)
+        self.assertEqual(self.interpreter.run("y"), 3)
+
+        # Cached code inlines +, which the new session has shadowed
+        session = self.interpreter.fork()
+        session.define("+", "(lambda (x y) (* x y))")
+        session.load(path)
+        self.assertEqual(session.run("y"), 2)
+
+        # Cached code specialized for the types of the globals it refers to
+        # is recompiled for globals of other types, just as it would be
+        # without a cache
+        path = self.write("calls", """
+            (define g (lambda (y) (h y)))
+            (define k (lambda (y) (if x y (+ y 1))))
+        """)
+        session = self.interpreter.fork()
+        session.define("h", "(lambda (y) (* y 10))")
+        session.define("x", "t")
+        session.require(path)
+        self.assertEqual(session.run("(list (g 1) (k 1))"), [10, 1])
+        for name, stx in [("h", "7"), ("x", "5")]:
+            session = self.interpreter.fork()
+            session.define("h", "(lambda (y) (* y 10))")
+            session.define("x", "t")
+            session.define(name, stx)
+            self.assertRaises(LispCompilationException, session.require, path)
+        session = self.interpreter.fork()
+        session.define("h", "(lambda (y) (+ y 10))")
+        session.define("x", "nil")
+        session.require(path)
+        self.assertEqual(session.run("(list (g 1) (k 1))"), [11, 2])
+
+    def test_corrupt(self):
+        # Caches naming classes or modules which no longer exist are
+        # recompiled, whether the whole file or one definition is affected
+        path = self.write("main", "(define y (+ 1 2))")
+        self.interpreter.require(path)
+        with open(cacheFile(path), "rb") as f:
+            header = pickle.load(f)
+        for data in ["ccore\nNoSuchNode\n.", "cno_such_module\nX\n.", "(."]:
+            for cache in [data, pickle.dumps([("define", "y", data)])]:
+                with open(cacheFile(path), "wb") as f:
+                    pickle.dump(header, f)
+                    f.write(cache)
+                session = self.interpreter.fork()
+                session.load(path)
+                self.assertEqual(session.run("y"), 3)
+
+    def test_errors(self):
+        path = self.write("main", "(define x 1) (define y (car 1))")
+        before = self.interpreter.snapshot()
+        self.assertRaises(
+            LispRuntimeException,
+            self.interpreter.require, path
+        )
+        self.assertIs(self.interpreter.snapshot(), before)
+        self.assertRaises(
+            LispParsingException,
+            self.interpreter.require,
+            os.path.join(self.directory, "missing" + SUFFIX)
+        )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,599 @@
+import os
+import time
+import unittest
+import itertools
+from lisp_exceptions import LispRuntimeException
+from core import CCall, CNumOp
+from val import *
+from pmap import PMap
+import runtime
+import data
+
+'''
+Native implementations of primitives too involved to be written inline in the
+interpreter's primitive table. They take and return evaluator values
+'''
+
+def elements(lst):
+    # Evaluator values in a cons list (walked iteratively), a stream or a
+    # vector. Each element is charged a step, as a function application is,
+    # so that the limits stop native traversals of long lists; streams charge
+    # for their elements themselves
+    if type(lst) is StreamV:
+        for x in lst:
+            yield x
+        return
+
+    budget = runtime.state.budget
+    if type(lst) is VectorV:
+        for x in lst:
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+            yield x
+        return
+
+    while type(lst) is ConsV:
+        budget.steps -= 1
+        if budget.steps < 0:
+            budget.exhausted()
+        yield lst.head
+        lst = lst.tail
+
+    if lst is not False:
+        raise LispRuntimeException("eval", "expected a list, got: " + str(lst))
+
+def collect(lst):
+    # Elements of lst in a Python list, charging an allocation for each as
+    # it is pulled so that the limit stops a long stream before it is held
+    budget, items = runtime.state.budget, []
+    for x in elements(lst):
+        budget.alloc(1)
+        items.append(x)
+    return items
+
+def cells(items):
+    # Cons list of items already charged for, as by collect
+    lst = False
+    for x in reversed(items):
+        lst = ConsV(x, lst)
+    return lst
+
+def test(pred, val):
+    # Apply a predicate, insisting on a boolean result like if does
+    result = CCall.apply(pred, val)
+    if result is not True and result is not False:
+        raise LispRuntimeException(
+            "eval",
+            "expected a boolean from predicate, got: " + str(result)
+        )
+    return result
+
+'''
+Natives related to numbers
+'''
+
+# Types of numbers; booleans are unboxed too, but are not numbers
+NUMBERS = frozenset([int, long, float])
+
+def numeric(name):
+    # Native for an arithmetic primitive or ordering. Operands the optimizer
+    # proves numbers are computed by CNumOp without any check, and operands
+    # it proves not to be are compile errors; the rest are checked here, so
+    # that evaluation agrees with the optimizer
+    op = CNumOp.operators[name]
+    def checked(x, y):
+        if type(x) not in NUMBERS or type(y) not in NUMBERS:
+            i, arg = (1, x) if type(x) not in NUMBERS else (2, y)
+            raise LispRuntimeException(
+                "eval",
+                name + " expects a number as argument " + str(i) +
+                ", got: " + str(arg)
+            )
+        return op(x, y)
+    return checked
+
+'''
+Natives related to lists
+'''
+
+def listMap(f, lst):
+    # Results are charged as they are computed, before they are held
+    budget, results = runtime.state.budget, []
+    for x in elements(lst):
+        budget.alloc(1)
+        results.append(CCall.apply(f, x))
+    return cells(results)
+
+def listFilter(pred, lst):
+    budget, results = runtime.state.budget, []
+    for x in elements(lst):
+        if test(pred, x):
+            budget.alloc(1)
+            results.append(x)
+    return cells(results)
+
+def foldl(f, init, lst):
+    # f receives each element followed by the accumulator
+    acc = init
+    for x in elements(lst):
+        acc = CCall.apply(CCall.apply(f, x), acc)
+    return acc
+
+def foldr(f, init, lst):
+    acc = init
+    for x in reversed(collect(lst)):
+        acc = CCall.apply(CCall.apply(f, x), acc)
+    return acc
+
+def length(lst):
+    count = 0
+    for x in elements(lst):
+        count += 1
+    return count
+
+def append(front, back):
+    # The back list is shared rather than copied
+    back = force(back)
+    for x in reversed(collect(front)):
+        back = ConsV(x, back)
+    return back
+
+def reverse(lst):
+    # Each cell is charged as it is built, so that the allocation limit
+    # stops a long reversal before its memory is spent
+    budget, rev = runtime.state.budget, False
+    for x in elements(lst):
+        budget.alloc(1)
+        rev = ConsV(x, rev)
+    return rev
+
+def nth(n, lst):
+    for i, x in enumerate(elements(lst)):
+        if i == n:
+            return x
+    raise LispRuntimeException(
+        "eval",
+        "nth: index " + str(n) + " out of range"
+    )
+
+def listSum(lst):
+    return sum(elements(lst))
+
+'''
+Natives related to streams
+'''
+
+def listRange(start, end):
+    return StreamV(lambda: iter(xrange(start, end)))
+
+def streamMap(f, lst):
+    return StreamV(lambda: (CCall.apply(f, x) for x in elements(lst)))
+
+def streamFilter(pred, lst):
+    return StreamV(lambda: (x for x in elements(lst) if test(pred, x)))
+
+def take(n, lst):
+    return StreamV(lambda: itertools.islice(elements(lst), n))
+
+def reduce(f, init, lst):
+    # Unlike foldl, f receives the accumulator followed by each element
+    acc = init
+    for x in elements(lst):
+        acc = CCall.apply(CCall.apply(f, acc), x)
+    return acc
+
+def force(lst):
+    # Materialize a stream into a cons list
+    if type(lst) is StreamV:
+        return cells(collect(lst))
+    else:
+        return lst
+
+'''
+Natives related to vectors
+'''
+
+def vector(lst):
+    return VectorV(collect(lst))
+
+def checkVector(func, vec):
+    if type(vec) is not VectorV:
+        raise LispRuntimeException(
+            "eval",
+            func + " expects a vector, got: " + str(vec)
+        )
+    return vec
+
+def checkIndex(func, idx):
+    # Booleans are unboxed like integers, but are not indices
+    if type(idx) is not int and type(idx) is not long:
+        raise LispRuntimeException(
+            "eval",
+            func + " expects an integer index, got: " + str(idx)
+        )
+    return idx
+
+def vectorRef(vec, idx):
+    checkVector("vector-ref", vec)
+    checkIndex("vector-ref", idx)
+    if not 0 <= idx < vec.end - vec.start:
+        raise LispRuntimeException(
+            "eval",
+            "vector-ref: index " + str(idx) + " out of range"
+        )
+    return vec.items[vec.start + idx]
+
+def vectorLength(vec):
+    checkVector("vector-length", vec)
+    return vec.end - vec.start
+
+def vectorSlice(vec, start, end):
+    checkVector("vector-slice", vec)
+    checkIndex("vector-slice", start)
+    checkIndex("vector-slice", end)
+    if not 0 <= start <= end <= vec.end - vec.start:
+        raise LispRuntimeException(
+            "eval",
+            "vector-slice: range " + str(start) + " to " + str(end) + \
+            " out of bounds"
+        )
+    runtime.state.budget.alloc(1)
+    return VectorV(vec.items, vec.start + start, vec.start + end)
+
+def vectorToList(vec):
+    return cells(collect(checkVector("vector->list", vec)))
+
+'''
+Natives related to hash maps
+'''
+
+def hashKey(key):
+    # Only numbers, symbols and strings hash consistently with their equality.
+    # Booleans are unboxed like numbers, but Python takes t to be 1 and nil
+    # to be 0, so they are refused rather than confused with them
+    if type(key) not in NUMBERS and type(key) is not SymV and \
+            type(key) is not StrV:
+        raise LispRuntimeException(
+            "eval",
+            "hash keys must be numbers, symbols or strings, got: " + str(key)
+        )
+    return key
+
+def hashFromList(pairs):
+    # Build a hash map out of a list of (key . value) conses, charging each
+    # entry as it is added
+    budget, pmap = runtime.state.budget, PMap()
+    for pair in elements(pairs):
+        if type(pair) is not ConsV:
+            raise LispRuntimeException(
+                "eval",
+                "hash expects a list of key/value pairs, got: " + str(pair)
+            )
+        budget.alloc(1)
+        pmap = pmap.set(hashKey(pair.head), pair.tail)
+    return HashV(pmap)
+
+def hashRef(h, key):
+    value = h.pmap.get(hashKey(key))
+    if value is None:
+        raise LispRuntimeException("eval", "hash-ref: no value for " + str(key))
+    return value
+
+def hashSet(h, key, value):
+    runtime.state.budget.alloc(1)
+    return HashV(h.pmap.set(hashKey(key), value))
+
+def hashHas(h, key):
+    return hashKey(key) in h.pmap
+
+def hashKeys(h):
+    # Keys are charged as they are listed, before they are held
+    budget, keys = runtime.state.budget, []
+    for key, value in h.pmap.iteritems():
+        budget.alloc(1)
+        keys.append(key)
+    return cells(keys)
+
+'''
+Natives related to data files
+'''
+
+def dataReader(root):
+    # Native for read-data which only opens files under the directory root.
+    # Files are named by strings, or by symbols for short names, relative to
+    # root; names resolving outside it (through "..", an absolute path or a
+    # symbolic link) are refused
+    root = os.path.realpath(root)
+    def readData(path):
+        if type(path) is StrV:
+            name = path.flatten()
+        elif type(path) is SymV:
+            name = path.name
+        else:
+            raise LispRuntimeException(
+                "eval",
+                "read-data expects a string naming a file, got: " + str(path)
+            )
+        resolved = os.path.realpath(os.path.join(root, name))
+        if not resolved.startswith(os.path.join(root, "")):
+            raise LispRuntimeException(
+                "eval",
+                "read-data: " + name + " is outside the data directory"
+            )
+        return data.read(resolved)
+    return readData
+
+'''
+Natives related to strings
+'''
+
+def checkStr(func, s):
+    if type(s) is not StrV:
+        raise LispRuntimeException(
+            "eval",
+            func + " expects a string, got: " + str(s)
+        )
+    return s
+
+def stringAppend(s, t):
+    # Appending shares both strings rather than copying them, so building a
+    # string piece by piece takes linear rather than quadratic time
+    checkStr("string-append", s)
+    checkStr("string-append", t)
+    return StrV.concat(s, t)
+
+def substring(s, start, end):
+    text = checkStr("substring", s).flatten()
+    if type(start) not in (int, long) or type(end) not in (int, long) or \
+            not 0 <= start <= end <= len(text):
+        raise LispRuntimeException(
+            "eval",
+            "substring: invalid range " + str(start) + " to " + str(end) + \
+            " of a string of length " + str(len(text))
+        )
+    StrV.charge(end - start)
+    return StrV(text[start:end])
+
+def stringLength(s):
+    return checkStr("string-length", s).length
+
+def stringJoin(lst, sep):
+    # Every piece is copied once, straight into the result
+    sep = checkStr("string-join", sep).flatten()
+    pieces = [checkStr("string-join", s).flatten() for s in collect(lst)]
+    StrV.charge(
+        sum(len(piece) for piece in pieces) +
+        len(sep) * max(0, len(pieces) - 1)
+    )
+    return StrV(sep.join(pieces))
+
+def stringBuilder(s):
+    runtime.state.budget.alloc(1)
+    return BuilderV(checkStr("string-builder", s))
+
+def builderAdd(b, s):
+    if type(b) is not BuilderV:
+        raise LispRuntimeException(
+            "eval",
+            "builder-add expects a string builder, got: " + str(b)
+        )
+    runtime.state.budget.alloc(1)
+    return b.add(checkStr("builder-add", s))
+
+def builderToString(b):
+    if type(b) is not BuilderV:
+        raise LispRuntimeException(
+            "eval",
+            "builder->string expects a string builder, got: " + str(b)
+        )
+    return b.build()
+
+'''
+Tests!
+'''
+
+class NativesTest(unittest.TestCase):
+    """Test class for native primitive implementations"""
+    def setUp(self):
+        self.lst = Val.fromList([1, 2, 3, 4])
+        self.add = NativeFunV(2, lambda x, y: x + y)
+        self.cons = NativeFunV(2, ConsV)
+
+    def assertList(self, lst, elems):
+        return self.assertEqual(list(elements(lst)), elems)
+
+    def test_folds(self):
+        self.assertEqual(foldl(self.add, 0, self.lst), 10)
+        self.assertList(foldl(self.cons, False, self.lst), [4, 3, 2, 1])
+        self.assertList(foldr(self.cons, False, self.lst), [1, 2, 3, 4])
+
+    def test_lists(self):
+        self.assertEqual(length(self.lst), 4)
+        self.assertEqual(length(False), 0)
+        self.assertList(reverse(self.lst), [4, 3, 2, 1])
+        self.assertList(append(self.lst, self.lst), [1, 2, 3, 4] * 2)
+        self.assertEqual(nth(2, self.lst), 3)
+        self.assertRaises(LispRuntimeException, nth, 4, self.lst)
+        self.assertList(listRange(2, 5), [2, 3, 4])
+        self.assertEqual(listSum(self.lst), 10)
+
+    def test_predicates(self):
+        even = NativeFunV(1, lambda x: x % 2 == 0)
+        self.assertList(listFilter(even, self.lst), [2, 4])
+        self.assertRaises(
+            LispRuntimeException,
+            listFilter,
+            NativeFunV(1, lambda x: x),
+            self.lst
+        )
+
+    def test_long(self):
+        lst = listRange(0, 100000)
+        self.assertEqual(length(reverse(lst)), 100000)
+        self.assertEqual(foldr(self.add, 0, lst), sum(range(100000)))
+
+    def test_streams(self):
+        nums = listRange(0, 10 ** 9)
+        evens = streamFilter(NativeFunV(1, lambda x: x % 2 == 0), nums)
+        squares = take(4, streamMap(NativeFunV(1, lambda x: x * x), evens))
+        self.assertEqual(list(squares), [0, 4, 16, 36])
+        self.assertEqual(list(squares), [0, 4, 16, 36])
+        self.assertEqual(reduce(self.add, 0, take(5, nums)), 10)
+        self.assertEqual(length(take(5, nums)), 5)
+        self.assertList(force(take(3, nums)), [0, 1, 2])
+        self.assertList(append(self.lst, take(1, nums)), [1, 2, 3, 4, 0])
+
+    def test_vectors(self):
+        vec = vector(listRange(0, 10))
+        self.assertEqual((vectorLength(vec), vectorRef(vec, 7)), (10, 7))
+        self.assertRaises(LispRuntimeException, vectorRef, vec, 10)
+
+        view = vectorSlice(vectorSlice(vec, 2, 8), 1, 4)
+        self.assertIs(view.items, vec.items)
+        self.assertEqual((vectorLength(view), vectorRef(view, 0)), (3, 3))
+        self.assertRaises(LispRuntimeException, vectorRef, view, 3)
+        self.assertRaises(LispRuntimeException, vectorSlice, view, 2, 4)
+        self.assertList(vectorToList(view), [3, 4, 5])
+        self.assertEqual(listSum(view), 12)
+
+        for f, args in [(vectorRef, (self.lst, 0)), (vectorRef, (vec, True)),
+                (vectorRef, (vec, 1.0)), (vectorLength, (self.lst,)),
+                (vectorSlice, (vec, False, 2)), (vectorSlice, (vec, 0, 2.5)),
+                (vectorSlice, (self.lst, 0, 1)), (vectorToList, (self.lst,))]:
+            self.assertRaises(LispRuntimeException, f, *args)
+
+    def test_hashes(self):
+        pairs = Val.fromList([ConsV(SymV("a"), 1), ConsV(2, SymV("b"))])
+        h = hashFromList(pairs)
+        self.assertEqual(hashRef(h, SymV("a")), 1)
+        self.assertEqual(hashRef(h, 2.0), SymV("b"))
+        self.assertTrue(hashHas(h, SymV("a")))
+        self.assertFalse(hashHas(h, SymV("c")))
+        self.assertRaises(LispRuntimeException, hashRef, h, SymV("c"))
+
+        h2 = hashSet(h, SymV("c"), False)
+        self.assertIs(hashRef(h2, SymV("c")), False)
+        self.assertFalse(hashHas(h, SymV("c")))
+        self.assertEqual(len(list(elements(hashKeys(h2)))), 3)
+        self.assertRaises(LispRuntimeException, hashSet, h, pairs, 1)
+
+        # Booleans would otherwise be the same keys as 1 and 0
+        h3 = hashFromList(Val.fromList([ConsV(1, SymV("one"))]))
+        self.assertRaises(LispRuntimeException, hashRef, h3, True)
+        self.assertRaises(LispRuntimeException, hashHas, h3, True)
+        self.assertRaises(LispRuntimeException, hashSet, h3, False, 1)
+        self.assertRaises(
+            LispRuntimeException,
+            hashFromList, Val.fromList([ConsV(1, 2), ConsV(True, 3)])
+        )
+
+        # Entries are charged as they are added
+        pairs = Val.fromList([ConsV(i, i) for i in range(20)])
+        with runtime.charging(runtime.Budget(maxAllocs=10)):
+            self.assertRaises(LispRuntimeException, hashFromList, pairs)
+        h4 = hashFromList(pairs)
+        with runtime.charging(runtime.Budget(maxAllocs=10)):
+            self.assertRaises(LispRuntimeException, hashKeys, h4)
+
+    def test_strings(self):
+        a, b = StrV("a" * 40), StrV("b" * 40)
+        s = stringAppend(a, b)
+        self.assertEqual(s.pieces, (a, b))
+        self.assertEqual(stringLength(s), 80)
+        self.assertEqual(substring(s, 38, 42), StrV("aabb"))
+        self.assertRaises(LispRuntimeException, substring, s, 10, 81)
+        self.assertEqual(stringAppend(StrV("x"), StrV("y")).text, "xy")
+        self.assertEqual(
+            stringJoin(Val.fromList([StrV("x"), StrV("y")]), StrV(", ")),
+            StrV("x, y")
+        )
+        self.assertRaises(LispRuntimeException, stringAppend, a, 1)
+
+        # Ropes and builders may be arbitrarily deep
+        for i in range(100000):
+            s = stringAppend(s, StrV("c"))
+        self.assertEqual(stringLength(s), 100080)
+        self.assertEqual(s.flatten()[-3:], "ccc")
+        builder = stringBuilder(StrV(""))
+        for i in range(100000):
+            builder = builderAdd(builder, StrV("d"))
+        self.assertEqual(builderToString(builder).length, 100000)
+        self.assertEqual(hashRef(hashSet(HashV(PMap()), a, 1), a), 1)
+
+    def test_numeric(self):
+        self.assertEqual(numeric("+")(1, 2.5), 3.5)
+        self.assertTrue(numeric("<")(1, 2L))
+        for x, y in [(True, 1), (1, False), (SymV("a"), 1), (1, StrV("b"))]:
+            self.assertRaises(LispRuntimeException, numeric("-"), x, y)
+
+    def test_charged(self):
+        # Allocation limits stop long lists before they are built
+        with runtime.charging(runtime.Budget(maxAllocs=10)):
+            for f in [reverse, force]:
+                self.assertRaises(
+                    LispRuntimeException,
+                    f, listRange(0, 10 ** 9)
+                )
+            self.assertRaises(
+                LispRuntimeException,
+                foldr, self.add, 0, listRange(0, 10 ** 9)
+            )
+            self.assertRaises(
+                LispRuntimeException,
+                vector, listRange(0, 10 ** 9)
+            )
+            self.assertRaises(
+                LispRuntimeException,
+                append, listRange(0, 10 ** 9), False
+            )
+        with runtime.charging(runtime.Budget(maxAllocs=10)):
+            self.assertRaises(
+                LispRuntimeException,
+                vectorToList, VectorV(range(10 ** 6))
+            )
+        for f in [listMap, listFilter]:
+            with runtime.charging(runtime.Budget(maxAllocs=10)):
+                self.assertRaises(
+                    LispRuntimeException,
+                    f, NativeFunV(1, lambda x: x % 2 == 0),
+                    listRange(0, 10 ** 9)
+                )
+
+        # Strings are charged for their length, so a rope doubling in length
+        # is stopped when it is flattened, before its text is built
+        s = StrV("a" * 64)
+        for i in range(40):
+            s = stringAppend(s, s)
+        builder = builderAdd(stringBuilder(s), s)
+        text = StrV("a" * 1000)
+        for f, args in [(s.flatten, ()), (builderToString, (builder,)),
+                (stringJoin, (Val.fromList([text] * 10), StrV(""))),
+                (substring, (text, 0, 1000))]:
+            with runtime.charging(runtime.Budget(maxAllocs=10)):
+                self.assertRaises(LispRuntimeException, f, *args)
+        with runtime.charging(runtime.Budget(maxAllocs=10)):
+            self.assertEqual(substring(text, 0, 10), StrV("a" * 10))
+
+    def test_stepped(self):
+        # Traversals are charged a step per element, so step limits and
+        # timeouts stop them even when they apply no functions
+        lst = Val.fromList(range(1000))
+        for f, args in [(foldl, (self.add, 0, listRange(0, 10 ** 9))),
+                (length, (listRange(0, 10 ** 9),)),
+                (listSum, (listRange(0, 10 ** 9),)),
+                (nth, (10 ** 8, listRange(0, 10 ** 9)))]:
+            for budget in [runtime.Budget(maxSteps=100),
+                    runtime.Budget(deadline=time.time() - 1)]:
+                with runtime.charging(budget):
+                    self.assertRaises(LispRuntimeException, f, *args)
+        with runtime.charging(runtime.Budget(maxSteps=100)):
+            self.assertRaises(LispRuntimeException, length, lst)
+        with runtime.charging(runtime.Budget(maxSteps=1001)):
+            self.assertEqual(length(lst), 1000)
+
+    def test_improper(self):
+        self.assertRaises(LispRuntimeException, length, ConsV(1, 2))
+
+if __name__ == "__main__":
+    unittest.main()
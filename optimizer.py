@@ -0,0 +1,741 @@
+import unittest
+from lisp_exceptions import LispCompilationException
+from core import *
+from env import Global
+from val import *
+import natives
+import runtime
+
+'''
+Passes rewriting compiled expressions into cheaper equivalents
+'''
+
+def optimize(expr, stats=None):
+    # Run every pass over a freshly compiled expression. If a stats dict is
+    # given, the number of nodes removed is added to stats["removed"]
+    expr, removed = eliminate(fuse(expr))
+    expr = specialize(expr)
+    if stats is not None:
+        stats["removed"] = stats.get("removed", 0) + removed
+    return expr
+
+def walk(expr):
+    # Every node of a compiled expression, parents before their children
+    stack = [expr]
+    while len(stack) > 0:
+        expr = stack.pop()
+        yield expr
+        stack.extend(reversed(expr.subExprs()))
+
+def size(expr):
+    return sum(1 for node in walk(expr))
+
+def binders(node):
+    # Subexpressions paired with the number of variables node binds around
+    # them; those variables are the first entries of bound(node)
+    t = type(node)
+    if t is CFun:
+        return [(node.body, 1)]
+    elif t is CLet:
+        return [(node.expr, 0), (node.body, 1)]
+    elif t is CLoop:
+        return [(init, i) for i, init in enumerate(node.inits)] + \
+            [(node.body, len(node.inits))]
+    else:
+        return [(sub, 0) for sub in node.subExprs()]
+
+def bound(node):
+    # Variables bound by node, outermost first
+    if type(node) is CLoop:
+        return [(node, i) for i in range(len(node.inits))]
+    else:
+        return [node]
+
+def replace(parent, old, new):
+    # Swap a direct subexpression of parent for another
+    for name, value in parent.__dict__.items():
+        if value is old:
+            setattr(parent, name, new)
+            return
+        elif type(value) is list and any(sub is old for sub in value):
+            value[[sub is old for sub in value].index(True)] = new
+            return
+
+def shift(expr, amount, skip=()):
+    # Renumber references in expr to variables bound outside of it, leaving
+    # the subexpressions whose ids are in skip untouched
+    stack = [(expr, 0)]
+    while len(stack) > 0:
+        node, depth = stack.pop()
+        if id(node) in skip:
+            continue
+        elif type(node) is CRef:
+            if node.idx >= depth:
+                node.idx += amount
+        else:
+            stack.extend((sub, depth + n) for sub, n in binders(node))
+
+'''
+Fusion of list pipelines
+'''
+
+# Primitives which traverse the list at the given argument position exactly
+# once, and so are as happy with a stream as with a list
+consumers = {
+    natives.listMap: 1,
+    natives.listFilter: 1,
+    natives.foldl: 2,
+    natives.foldr: 2,
+    natives.reduce: 2,
+    natives.length: 0,
+    natives.reverse: 0,
+    natives.listSum: 0,
+    natives.hashFromList: 0,
+    natives.vector: 0,
+    natives.streamMap: 1,
+    natives.streamFilter: 1
+}
+
+# List-building primitives and their lazy equivalents
+lazy = {
+    natives.listMap: ("stream-map", natives.streamMap),
+    natives.listFilter: ("stream-filter", natives.streamFilter)
+}
+
+def fuse(expr):
+    # A map or filter whose result is only traversed by another list
+    # primitive is made lazy, so that a chain such as (sum (map f (filter p
+    # xs))) runs as a single traversal with no intermediate lists
+    for node in walk(expr):
+        if type(node) is CPrimOp and node.op in consumers:
+            idx = consumers[node.op]
+            arg = node.argExprs[idx]
+            if type(arg) is CPrimOp and arg.op in lazy:
+                name, op = lazy[arg.op]
+                node.argExprs[idx] = CPrimOp(name, op, arg.argExprs)
+    return expr
+
+'''
+Elimination of redundant bindings and subexpressions
+'''
+
+# Smallest subexpression worth binding to a variable; binding one costs about
+# as much as evaluating a couple of nodes
+minSize = 3
+
+def eliminate(expr):
+    # Drop dead bindings and share repeated subexpressions, returning the new
+    # expression along with the number of nodes removed
+    before = size(expr)
+    while True:
+        dead = deadLets(expr)
+        if len(dead) == 0:
+            break
+        expr = dropLets(expr, dead)
+    expr = share(expr)
+    return expr, before - size(expr)
+
+def pure(expr):
+    # Whether evaluating expr can neither fail nor fail to terminate, so that
+    # skipping it is unobservable
+    stack = [expr]
+    while len(stack) > 0:
+        node = stack.pop()
+        t = type(node)
+        if t is CCons:
+            stack.extend(node.subExprs())
+        elif t is CGlobal:
+            if node.glob.value is None:
+                return False
+        elif t not in (CNum, CBool, CSym, CStr, CRef, CFun, CPrimFun):
+            return False
+    return True
+
+def deadLets(expr):
+    # Ids of the CLets whose variable is never referenced and whose value is
+    # pure. Variables in scope are tracked on a stack, innermost last, with
+    # markers on the work stack saying when to push and pop them
+    scope, used, lets = [], set(), []
+    stack = [expr]
+    while len(stack) > 0:
+        node = stack.pop()
+        if type(node) is tuple:
+            if node[0] == "push":
+                scope.extend(node[1])
+            else:
+                del scope[len(scope) - node[1]:]
+        elif type(node) is CRef:
+            if node.idx < len(scope):
+                used.add(id(scope[-1 - node.idx]))
+        else:
+            if type(node) is CLet:
+                lets.append(node)
+            entries = bound(node)
+            for sub, n in reversed(binders(node)):
+                stack.extend([("pop", n), sub, ("push", entries[:n])])
+
+    return set(id(let) for let in lets
+        if id(let) not in used and pure(let.expr))
+
+def dropLets(expr, dead):
+    # Replace each dead CLet by its body. Scope entries record whether their
+    # variable is kept, along with a running count of kept variables, from
+    # which references are renumbered
+    def unwrap(sub, entries):
+        while id(sub) in dead:
+            sub = sub.body
+            entries.append(False)
+        return sub
+
+    entries = []
+    expr = unwrap(expr, entries)
+    counts = [0]
+    for kept in entries:
+        counts.append(counts[-1] + kept)
+
+    stack = [expr]
+    while len(stack) > 0:
+        node = stack.pop()
+        if type(node) is tuple:
+            if node[0] == "push":
+                for kept in node[1]:
+                    counts.append(counts[-1] + kept)
+            else:
+                del counts[len(counts) - node[1]:]
+        elif type(node) is CRef:
+            if node.idx < len(counts) - 1:
+                node.idx = counts[-1] - counts[-1 - node.idx]
+            else:
+                node.idx -= (len(counts) - 1) - counts[-1]
+        else:
+            for sub, n in reversed(binders(node)):
+                entries = [True] * n
+                new = unwrap(sub, entries)
+                if new is not sub:
+                    replace(node, sub, new)
+                stack.extend([("pop", len(entries)), new, ("push", entries)])
+    return expr
+
+# Attribute telling apart nodes of a type besides their subexpressions
+fields = {
+    CNum: "value",
+    CBool: "state",
+    CSym: "name",
+    CStr: "text",
+    CRef: "idx",
+    CGlobal: "glob",
+    CPrimOp: "op",
+    CNumOp: "op",
+    CPrimFun: "thunk",
+    CLoop: "inPlace",
+    CCase: "cases",
+    CCompiled: "code"
+}
+
+def numbering(expr):
+    # Number every subexpression so that structurally equal ones (which
+    # compute the same value in the same scope) share a number. Also note
+    # each one's size and whether it may be moved, which it may not if it
+    # contains a loop or a recur
+    numbers, sizes, movable, table = {}, {}, {}, {}
+    for node in reversed(list(walk(expr))):
+        t, subs = type(node), [id(sub) for sub in node.subExprs()]
+        key = [t]
+        if t in fields:
+            value = getattr(node, fields[t])
+            key.extend([type(value), value])
+        key.extend(numbers[sub] for sub in subs)
+        numbers[id(node)] = table.setdefault(tuple(key), len(table))
+        sizes[id(node)] = 1 + sum(sizes[sub] for sub in subs)
+        movable[id(node)] = t is not CLoop and t is not CRecur and \
+            all(movable[sub] for sub in subs)
+    return numbers, sizes, movable
+
+def region(root):
+    # (node, parent) pairs for the subexpressions evaluated whenever root is,
+    # in the same scope, in evaluation order
+    def inside(node):
+        t = type(node)
+        if t is CIf or t is CIfBool:
+            return [node.cond]
+        elif t is CCase:
+            return [node.key]
+        elif t is CFun:
+            return []
+        elif t is CLet:
+            return [node.expr]
+        elif t is CLoop:
+            return node.inits[:1]
+        else:
+            return node.subExprs()
+
+    pairs, stack = [], [(root, None)]
+    while len(stack) > 0:
+        node, parent = stack.pop()
+        pairs.append((node, parent))
+        stack.extend((sub, node) for sub in reversed(inside(node)))
+    return pairs, inside
+
+def share(expr):
+    # Bind subexpressions occurring more than once within a region to a
+    # variable wrapped around the region. Regions are processed outermost
+    # first, starting with the one rooted at expr
+    numbers, sizes, movable = numbering(expr)
+    candidate = lambda node: id(node) in numbers and \
+        sizes[id(node)] >= minSize and movable[id(node)]
+
+    # Nothing can be shared unless something is repeated somewhere
+    seen, repeated = set(), False
+    for key, number in numbers.iteritems():
+        if sizes[key] >= minSize and movable[key]:
+            if number in seen:
+                repeated = True
+                break
+            seen.add(number)
+    if not repeated:
+        return expr
+
+    queue = [(expr, None)]
+    while len(queue) > 0:
+        root, rootParent = queue.pop()
+        pairs, inside = region(root)
+
+        counts = {}
+        for node, parent in pairs:
+            if candidate(node):
+                counts[numbers[id(node)]] = counts.get(numbers[id(node)], 0) + 1
+
+        # Occurrences of repeated subexpressions, ignoring any nested in
+        # another occurrence
+        occurrences, skipped = {}, set()
+        for node, parent in pairs:
+            if id(parent) in skipped:
+                skipped.add(id(node))
+            elif candidate(node) and counts[numbers[id(node)]] > 1:
+                occurrences.setdefault(numbers[id(node)], []).append(
+                    (node, parent))
+                skipped.add(id(node))
+        order = dict((id(node), i) for i, (node, parent) in enumerate(pairs))
+        shared = sorted(
+            (occs for occs in occurrences.values() if len(occs) > 1),
+            key=lambda occs: order[id(occs[0][0])]
+        )
+
+        if len(shared) > 0:
+            shift(root, len(shared), set(
+                id(node) for occs in shared for node, parent in occs
+            ))
+            for i, occs in enumerate(shared):
+                for node, parent in occs:
+                    replace(parent, node, CRef(len(shared) - 1 - i))
+                shift(occs[0][0], i)
+
+            wrapped = root
+            for occs in reversed(shared):
+                wrapped = CLet(occs[0][0], wrapped)
+            if rootParent is None:
+                expr = wrapped
+            else:
+                replace(rootParent, root, wrapped)
+
+        # Continue with the regions nested inside this one, including those
+        # within the shared subexpressions
+        for top in [root] + [occs[0][0] for occs in shared]:
+            pairs, inside = region(top)
+            for node, parent in pairs:
+                ins = inside(node)
+                queue.extend(
+                    (sub, node) for sub in node.subExprs()
+                    if not any(sub is i for i in ins)
+                )
+    return expr
+
+'''
+Specialization by type inference
+'''
+
+# Static types of values, where known. A list may be nil, which is also a
+# boolean
+INT, FLOAT, NUM, BOOL, SYM, STR, LIST, FUN, PRIM = "integer", "float", \
+    "number", "boolean", "symbol", "string", "list", "function", "primitive"
+NUMERIC = (INT, FLOAT, NUM)
+
+# Type of a recur, which hands values back to its loop rather than producing
+# one of its own
+RECUR = "recur"
+
+# Types of the results of primitives which do not depend on their arguments
+results = {
+    "not": BOOL,
+    "hash-has?": BOOL,
+    "length": INT,
+    "string-length": INT,
+    "vector-length": INT,
+    "sum": NUM,
+    "map": LIST,
+    "filter": LIST,
+    "reverse": LIST,
+    "string-append": STR,
+    "substring": STR,
+    "string-join": STR,
+    "builder->string": STR
+}
+
+def join(a, b):
+    # Type of a value which may have either type
+    if a is RECUR:
+        return b
+    elif b is RECUR or a == b:
+        return a
+    elif a in NUMERIC and b in NUMERIC:
+        return NUM
+    else:
+        return None
+
+def valueType(value):
+    t = type(value)
+    if t is int or t is long:
+        return INT
+    elif t is float:
+        return FLOAT
+    elif t is bool:
+        return BOOL
+    elif t is FunV:
+        return FUN
+    elif isinstance(value, PrimFunV):
+        return PRIM
+    else:
+        return {SymV: SYM, StrV: STR, ConsV: LIST}.get(t)
+
+def article(name):
+    return ("an " if name[0] in "aeiou" else "a ") + name
+
+def specialize(expr):
+    # Replace nodes whose operands are proven to have the right types by
+    # variants which skip their runtime checks, and report operands proven
+    # to have the wrong types. Loop variables start out with the types of
+    # their initial values and are widened by each recur, so types are
+    # inferred again until they settle
+    loops = {}
+    while True:
+        types, rewrites, errors, widened = inferTypes(expr, loops)
+        if not widened:
+            break
+
+    if len(errors) > 0:
+        raise LispCompilationException("typecheck", errors[0])
+    for node, parent, build in rewrites:
+        new = build(node)
+        if parent is None:
+            expr = new
+        else:
+            replace(parent, node, new)
+    return expr
+
+def inferTypes(expr, loops):
+    # Type of every subexpression of expr, given the types assumed for the
+    # variables of each loop (which are widened by the recurs found), along
+    # with the rewrites the types allow and the type errors they show. The
+    # environment of variable types is a linked list of (type, rest) pairs
+    types, rewrites, errors = {}, [], []
+    widened = False
+
+    # Frames visit a node, bind the variables of a node between its
+    # subexpressions, or finish a node once its subexpressions are typed
+    stack = [("visit", expr, None, None, None)]
+    while len(stack) > 0:
+        action, node, env, loop, parent = stack.pop()
+        t = type(node)
+        if action == "visit":
+            stack.append(("finish", node, env, loop, parent))
+            if t is CLet or t is CLoop:
+                stack.append(("bind", node, env, loop, 0))
+            elif t is CFun:
+                stack.append(("visit", node.body, (None, env), None, node))
+            else:
+                stack.extend(
+                    ("visit", sub, env, loop, node)
+                    for sub in reversed(node.subExprs())
+                )
+
+        elif action == "bind":
+            # parent holds the number of the subexpression to visit next
+            i = parent
+            if t is CLet and i == 0:
+                stack.append(("bind", node, env, loop, 1))
+                stack.append(("visit", node.expr, env, loop, node))
+            elif t is CLet:
+                bodyEnv = (types[id(node.expr)], env)
+                stack.append(("visit", node.body, bodyEnv, loop, node))
+            elif i < len(node.inits):
+                initEnv = env
+                for init in node.inits[:i]:
+                    initEnv = (types[id(init)], initEnv)
+                stack.append(("bind", node, env, loop, i + 1))
+                stack.append(("visit", node.inits[i], initEnv, None, node))
+            else:
+                assumed = loops.setdefault(id(node), [RECUR] * i)
+                for j, init in enumerate(node.inits):
+                    assumed[j] = join(assumed[j], types[id(init)])
+                bodyEnv = env
+                for varType in assumed:
+                    bodyEnv = (varType, bodyEnv)
+                stack.append(("visit", node.body, bodyEnv, node, node))
+
+        else:
+            subTypes = [types[id(sub)] for sub in node.subExprs()]
+            if t is CNum:
+                result = FLOAT if type(node.value) is float else INT
+            elif t is CRef:
+                for i in xrange(node.idx):
+                    env = env[1] if env is not None else None
+                result = env[0] if env is not None else None
+            elif t is CGlobal:
+                result = valueType(node.glob.value)
+            elif t is CIf:
+                result = join(subTypes[1], subTypes[2])
+                condType = subTypes[0]
+                if condType == BOOL:
+                    rewrites.append((node, parent, ifBool))
+                elif condType is not None and condType != LIST:
+                    errors.append(
+                        "if expects a boolean condition, got " +
+                        article(condType)
+                    )
+            elif t is CCase:
+                result = reduce(join, subTypes[1:])
+            elif t is CLet or t is CLoop:
+                result = subTypes[-1]
+            elif t is CRecur:
+                result = RECUR
+                assumed = loops[id(loop)]
+                for j, argType in enumerate(subTypes):
+                    varType = join(assumed[j], argType)
+                    if varType != assumed[j]:
+                        assumed[j], widened = varType, True
+            elif t is CPrimOp:
+                result = primType(node, subTypes, rewrites, errors, parent)
+            elif t is CCall:
+                result = None
+                funType = subTypes[0]
+                if funType == FUN:
+                    rewrites.append((node, parent, callFun))
+                elif funType is not None and funType != PRIM:
+                    errors.append(
+                        "'call' expects a function, got " + article(funType)
+                    )
+            else:
+                result = {
+                    CBool: BOOL,
+                    CSym: SYM,
+                    CStr: STR,
+                    CCons: LIST,
+                    CFun: FUN,
+                    CPrimFun: PRIM
+                }.get(t)
+            types[id(node)] = result
+
+    return types, rewrites, errors, widened
+
+def primType(node, argTypes, rewrites, errors, parent):
+    # Type of the result of a primitive operation, noting whether it can be
+    # specialized and whether its operands must be numbers but are not
+    name = node.name
+    if name not in CNumOp.operators:
+        if name == "and" or name == "or":
+            return join(argTypes[0], argTypes[1])
+        elif name == "max" or name == "min":
+            result = join(argTypes[0], argTypes[1])
+            return result if result in NUMERIC else None
+        elif name == "append":
+            # Appending to nil gives back the second argument unchanged,
+            # whatever it is
+            return LIST if argTypes[1] == LIST else None
+        return results.get(name)
+
+    if name != "eq?":
+        for i, argType in enumerate(argTypes):
+            if argType is not None and argType not in NUMERIC:
+                errors.append(
+                    name + " expects a number as argument " + str(i + 1) +
+                    ", got " + article(argType)
+                )
+
+    numeric = all(argType in NUMERIC for argType in argTypes)
+    if numeric:
+        rewrites.append((node, parent, numOp))
+    if name not in ("+", "-", "*", "/"):
+        return BOOL
+    elif numeric:
+        return reduce(join, argTypes)
+    else:
+        return None
+
+def ifBool(node):
+    return CIfBool(node.cond, node.ifBranch, node.elseBranch)
+
+def numOp(node):
+    return CNumOp(node.name, node.op, node.argExprs[0], node.argExprs[1])
+
+def callFun(node):
+    return CCallFun(node.funExpr, node.argExpr)
+
+'''
+Tests!
+'''
+
+class OptimizerTest(unittest.TestCase):
+    """Test class for optimization passes"""
+    def setUp(self):
+        self.double = CPrimFun(lambda x: 2 * x)
+        self.even = CPrimFun(lambda x: x % 2 == 0)
+        self.nums = CPrimOp("range", natives.listRange, [CNum(0), CNum(10)])
+
+    def map(self, f, lst):
+        return CPrimOp("map", natives.listMap, [f, lst])
+
+    def filter(self, pred, lst):
+        return CPrimOp("filter", natives.listFilter, [pred, lst])
+
+    def test_fuse(self):
+        expr = CPrimOp("sum", natives.listSum, [
+            self.map(self.double, self.filter(self.even, self.nums))
+        ])
+        expected = expr.eval([])
+        fuse(expr)
+        self.assertEqual(expr.eval([]), expected)
+
+        stages = [node.name for node in walk(expr) if type(node) is CPrimOp]
+        self.assertEqual(stages, ["sum", "stream-map", "stream-filter", "range"])
+
+    def test_no_fuse(self):
+        # Results which escape must remain lists
+        expr = CCar(self.map(self.double, self.map(self.double, self.nums)))
+        fuse(expr)
+        self.assertEqual(
+            [node.name for node in walk(expr) if type(node) is CPrimOp],
+            ["map", "stream-map", "range"]
+        )
+        self.assertIs(type(expr.pair.eval([])), ConsV)
+        self.assertEqual(expr.eval([]), 0)
+
+    def test_dead_lets(self):
+        sub = lambda x, y: x - y
+        # (let ((a 1) (b 2) (c (a 0))) (lambda (d) (- d a)))
+        expr = CLet(CNum(1), CLet(CNum(2), CLet(CCall(CRef(1), CNum(0)),
+            CFun(CPrimOp("-", sub, [CRef(0), CRef(3)])))))
+        expr, removed = eliminate(expr)
+        self.assertEqual(removed, 2)
+        self.assertEqual(
+            expr,
+            CLet(CNum(1), CLet(CCall(CRef(0), CNum(0)),
+                CFun(CPrimOp("-", sub, [CRef(0), CRef(2)]))))
+        )
+
+        # Bindings only used by dead bindings die too
+        expr = CLet(CNum(1), CLet(CCons(CRef(0), CBool(False)), CNum(7)))
+        self.assertEqual(eliminate(expr), (CNum(7), 6))
+
+    def test_share(self):
+        add = lambda x, y: x + y
+        mul = lambda x, y: x * y
+        square = lambda: CPrimOp("*", mul, [CRef(0), CRef(0)])
+
+        # Only occurrences which are always evaluated are shared
+        expr = share(CFun(CPrimOp("+", add, [
+            square(),
+            CIf(CBool(True), square(), CNum(0))
+        ])))
+        self.assertEqual(expr.eval([]).apply(3), 18)
+        self.assertIs(type(expr.body), CPrimOp)
+
+        expr = share(CFun(CPrimOp("+", add, [square(), square()])))
+        self.assertEqual(
+            expr,
+            CFun(CLet(square(), CPrimOp("+", add, [CRef(0), CRef(0)])))
+        )
+
+    def test_share_scopes(self):
+        add = lambda x, y: x + y
+        # ((lambda (f) (lambda (x)
+        #    (+ (let ((y 1)) (+ (f x) y)) (+ (f x) (+ (f x) x))))) g)
+        fun = lambda: CFun(CPrimOp("+", add, [
+            CLet(CNum(1), CPrimOp("+", add, [CCall(CRef(2), CRef(1)), CRef(0)])),
+            CPrimOp("+", add, [
+                CCall(CRef(1), CRef(0)),
+                CPrimOp("+", add, [CCall(CRef(1), CRef(0)), CRef(0)])
+            ])
+        ]))
+        outer = lambda: CCall(CFun(fun()), CPrimFun(lambda x: x * 10))
+        before = CCall(outer(), CNum(4)).eval([])
+        expr = share(outer())
+        self.assertEqual(CCall(expr, CNum(4)).eval([]), before)
+        self.assertIs(type(expr.funExpr.body.body), CLet)
+
+    def test_share_case(self):
+        add = lambda x, y: x + y
+        # Repeats only within a branch, or across branches, stay in place
+        twice = lambda: CPrimOp("+", add, [CRef(0), CNum(1)])
+        expr = share(CCase(
+            CRef(0),
+            ((1,), (2,)),
+            [twice(), CPrimOp("+", add, [twice(), twice()])],
+            twice()
+        ))
+        self.assertIs(type(expr), CCase)
+        self.assertIs(type(expr.branches[1]), CLet)
+        self.assertEqual(
+            [expr.eval([k]) for k in [1, 2, 3]],
+            [2, 6, 4]
+        )
+
+    def test_specialize(self):
+        add = lambda x, y: x + y
+        less = lambda x, y: x < y
+        # (loop ((i 0) (x 0)) (if (< i 3) (recur (+ i 1) (+ x 0.5)) x))
+        expr = specialize(CLoop(
+            [CNum(0), CNum(0)],
+            CIf(
+                CPrimOp("<", less, [CRef(1), CNum(3)]),
+                CRecur([
+                    CPrimOp("+", add, [CRef(1), CNum(1)]),
+                    CPrimOp("+", add, [CRef(0), CNum(0.5)])
+                ]),
+                CRef(0)
+            ),
+            True
+        ))
+        self.assertEqual(
+            [type(node) for node in walk(expr)],
+            [CLoop, CNum, CNum, CIfBool, CNumOp, CRef, CNum, CRecur, CNumOp,
+                CRef, CNum, CNumOp, CRef, CNum, CRef]
+        )
+        self.assertEqual(expr.eval([]), 1.5)
+
+        # Unknown operands are left to be checked at runtime
+        expr = specialize(CFun(CIf(CRef(0), CCall(CRef(0), CNum(1)), CNum(2))))
+        self.assertEqual(
+            [type(node) for node in walk(expr)],
+            [CFun, CIf, CRef, CCall, CRef, CNum, CNum]
+        )
+        expr = specialize(CLet(CFun(CRef(0)), CCall(CRef(0), CNum(1))))
+        self.assertIs(type(expr.body), CCallFun)
+        self.assertEqual(expr.eval([]), 1)
+
+        for expr in [
+            CPrimOp("+", add, [CNum(1), CSym("a")]),
+            CIf(CNum(0), CNum(1), CNum(2)),
+            CCall(CStr("f"), CNum(1)),
+            CLet(CBool(True), CPrimOp("<", less, [CNum(1), CRef(0)]))
+        ]:
+            self.assertRaises(LispCompilationException, specialize, expr)
+
+    def test_walk(self):
+        expr = CIf(CBool(True), CCons(CNum(1), CBool(False)), CRef(0))
+        self.assertEqual(
+            [type(node) for node in walk(expr)],
+            [CIf, CBool, CCons, CNum, CBool, CRef]
+        )
+
+if __name__ == "__main__":
+    unittest.main()
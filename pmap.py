@@ -0,0 +1,203 @@
+import unittest
+
+'''
+Persistent hash map with structural sharing
+'''
+
+class PMap(object):
+    """Persistent hash map, implemented as a hash array mapped trie"""
+    # Updates return a new map which shares every untouched node with the old
+    # one, so copies are free and an update costs O(log32 n)
+    __slots__ = ["root", "size"]
+
+    def __init__(self, root=None, size=0):
+        self.root, self.size = root, size
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "PMap(" + repr(dict(self.iteritems())) + ")"
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def get(self, key, default=None):
+        h = _hash(key)
+        node, shift = self.root, 0
+        while node is not None:
+            if type(node) is _Collision:
+                for k, v in node.pairs:
+                    if k == key:
+                        return v
+                return default
+
+            bit = 1 << ((h >> shift) & 31)
+            if not node.bitmap & bit:
+                return default
+
+            entry = node.array[_popcount(node.bitmap & (bit - 1))]
+            if type(entry) is tuple:
+                if entry[0] == h and entry[1] == key:
+                    return entry[2]
+                else:
+                    return default
+            node, shift = entry, shift + 5
+        return default
+
+    def set(self, key, value):
+        root, added = _set(self.root, 0, (_hash(key), key, value))
+        return PMap(root, self.size + 1 if added else self.size)
+
+    def iteritems(self):
+        stack = [] if self.root is None else [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if type(node) is _Collision:
+                for pair in node.pairs:
+                    yield pair
+            else:
+                for entry in node.array:
+                    if type(entry) is tuple:
+                        yield entry[1], entry[2]
+                    else:
+                        stack.append(entry)
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def values(self):
+        return [value for key, value in self.iteritems()]
+
+    @staticmethod
+    def fromItems(items):
+        pmap = PMap()
+        for key, value in items:
+            pmap = pmap.set(key, value)
+        return pmap
+
+class _Bitmap(object):
+    """Trie node holding up to 32 entries, which are leaves or child nodes"""
+    # Leaves are (hash, key, value) tuples
+    __slots__ = ["bitmap", "array"]
+
+    def __init__(self, bitmap, array):
+        self.bitmap, self.array = bitmap, array
+
+class _Collision(object):
+    """Trie node holding keys whose full hashes are equal"""
+    __slots__ = ["hash", "pairs"]
+
+    def __init__(self, hash, pairs):
+        self.hash, self.pairs = hash, pairs
+
+_missing = object()
+
+def _hash(key):
+    return hash(key) & 0xFFFFFFFFFFFFFFFF
+
+def _popcount(n):
+    return bin(n).count("1")
+
+def _set(node, shift, leaf):
+    # Returns the updated copy of node and whether a key was added
+    h, key, value = leaf
+    if node is None:
+        return _Bitmap(1 << ((h >> shift) & 31), [leaf]), True
+
+    if type(node) is _Collision:
+        if node.hash == h:
+            pairs = [pair for pair in node.pairs if pair[0] != key]
+            return _Collision(h, pairs + [(key, value)]), \
+                len(pairs) == len(node.pairs)
+        else:
+            # Push the collision node one level down
+            bit = 1 << ((node.hash >> shift) & 31)
+            return _set(_Bitmap(bit, [node]), shift, leaf)
+
+    bit = 1 << ((h >> shift) & 31)
+    idx = _popcount(node.bitmap & (bit - 1))
+    array = node.array[:]
+
+    if not node.bitmap & bit:
+        array.insert(idx, leaf)
+        return _Bitmap(node.bitmap | bit, array), True
+
+    entry = array[idx]
+    if type(entry) is not tuple:
+        array[idx], added = _set(entry, shift + 5, leaf)
+        return _Bitmap(node.bitmap, array), added
+    elif entry[0] == h and entry[1] == key:
+        array[idx] = leaf
+        return _Bitmap(node.bitmap, array), False
+    else:
+        array[idx] = _merge(entry, leaf, shift + 5)
+        return _Bitmap(node.bitmap, array), True
+
+def _merge(leaf1, leaf2, shift):
+    # Smallest subtree holding two leaves which share a prefix before shift
+    if leaf1[0] == leaf2[0]:
+        return _Collision(leaf1[0], [leaf1[1:], leaf2[1:]])
+
+    bit1 = 1 << ((leaf1[0] >> shift) & 31)
+    bit2 = 1 << ((leaf2[0] >> shift) & 31)
+    if bit1 == bit2:
+        return _Bitmap(bit1, [_merge(leaf1, leaf2, shift + 5)])
+    elif bit1 < bit2:
+        return _Bitmap(bit1 | bit2, [leaf1, leaf2])
+    else:
+        return _Bitmap(bit1 | bit2, [leaf2, leaf1])
+
+'''
+Tests!
+'''
+
+class Colliding(object):
+    """Key type whose instances all hash alike"""
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return isinstance(other, Colliding) and self.name == other.name
+
+class PMapTest(unittest.TestCase):
+    """Test class for persistent maps"""
+    def test_set_get(self):
+        pmap = PMap.fromItems((i, i * i) for i in range(5000))
+        self.assertEqual(len(pmap), 5000)
+        self.assertEqual([pmap.get(i) for i in range(5000)],
+            [i * i for i in range(5000)])
+        self.assertEqual(pmap.get(5000), None)
+        self.assertEqual(sorted(pmap.keys()), range(5000))
+
+    def test_persistence(self):
+        old = PMap.fromItems([("a", 1), ("b", 2)])
+        new = old.set("a", 3).set("c", 4)
+        self.assertEqual((old.get("a"), old.get("c"), len(old)), (1, None, 2))
+        self.assertEqual((new.get("a"), new.get("c"), len(new)), (3, 4, 3))
+        self.assertTrue("b" in new and "c" not in old)
+
+    def test_collisions(self):
+        keys = [Colliding(str(i)) for i in range(10)]
+        pmap = PMap.fromItems((k, k.name) for k in keys).set(42, "int")
+        self.assertEqual([pmap.get(k) for k in keys], map(str, range(10)))
+        self.assertEqual(pmap.get(42), "int")
+        self.assertEqual(len(pmap.set(keys[0], "x")), 11)
+        self.assertEqual(pmap.get(Colliding("x")), None)
+
+    def test_negative_hashes(self):
+        keys = [-i for i in range(1000)] + ["x" * i for i in range(100)]
+        pmap = PMap.fromItems((k, k) for k in keys)
+        self.assertTrue(all(pmap.get(k) == k for k in keys))
+
+if __name__ == "__main__":
+    unittest.main()
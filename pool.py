@@ -0,0 +1,230 @@
+import os
+import time
+import Queue
+import resource
+import unittest
+import threading
+import multiprocessing
+from lisp_exceptions import *
+from interpreter import Interpreter
+from runtime import Budget
+
+'''
+Pool of pre-forked worker processes, each running jobs in its own interpreter
+'''
+
+def serve(conn, interpreter):
+    # Main loop of a worker process: run each job received over conn and send
+    # back its outcome, until the pool closes conn or sends None
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        stx, maxSteps, maxAllocs, timeout = job
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        budget = Budget(maxSteps, maxAllocs, deadline)
+
+        # Lisp exceptions do not pickle, so their parts are sent instead
+        try:
+            outcome = (True, interpreter.execute(stx, budget))
+        except LispException, e:
+            outcome = (False, (type(e), e.func, e.msg))
+        except Exception, e:
+            outcome = (False, (
+                LispRuntimeException,
+                "eval",
+                "encountered unknown error in worker: " + str(e)
+            ))
+
+        # Peak resident memory in KB, as Linux reports it
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send((outcome, budget.exceeded(), rss))
+
+class Worker(object):
+    """Worker process along with the pool's end of its pipe"""
+    def __init__(self, interpreter):
+        # The worker is forked from the pool, so it starts out with the
+        # interpreter and its prelude already set up
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve,
+            args=(child, interpreter)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Worker(" + str(self.process.pid) + ")"
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def kill(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+class WorkerPool(object):
+    """Supervisor running jobs in a pool of warm interpreter processes"""
+    # Seconds a worker may overrun a job's timeout before it is killed
+    grace = 1.0
+
+    def __init__(self, size=4, prelude=[], maxJobs=1000, maxMemory=None):
+        # A worker is replaced by a fresh one after maxJobs jobs, once its
+        # peak memory exceeds maxMemory KB, or after a job which was stopped
+        # by its step, allocation or time limit; a worker which stops
+        # responding is killed. Jobs may be submitted from several threads
+        self.maxJobs, self.maxMemory = maxJobs, maxMemory
+        self.interpreter = Interpreter(prelude)
+        self.workers = [Worker(self.interpreter) for i in range(size)]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "WorkerPool(" + str(len(self.workers)) + ")"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, stx, maxSteps=None, maxAllocs=None, timeout=None):
+        # Like Interpreter.run, but in whichever worker is free first
+        worker = self.idle.get()
+        retire, responsive = True, False
+        try:
+            worker.conn.send((stx, maxSteps, maxAllocs, timeout))
+            wait = None if timeout is None else timeout + self.grace
+            if not worker.conn.poll(wait):
+                raise LispRuntimeException("eval", "timed out")
+            (success, result), exceeded, rss = worker.conn.recv()
+
+            worker.jobs += 1
+            responsive = True
+            retire = exceeded or worker.jobs >= self.maxJobs or \
+                self.maxMemory is not None and rss > self.maxMemory
+        except (EOFError, IOError, OSError):
+            raise LispRuntimeException("eval", "worker process died")
+        finally:
+            # Workers are only handed out again once they are known to be
+            # fit for another job
+            if retire:
+                worker = self.replace(worker, responsive)
+            self.idle.put(worker)
+
+        if not success:
+            exception, func, msg = result
+            raise exception(func, msg)
+        return result
+
+    def replace(self, worker, responsive):
+        # Swap a fresh worker in for the given one, which is stopped (or
+        # killed, if it has stopped responding)
+        with self.lock:
+            fresh = Worker(self.interpreter)
+            if worker in self.workers:
+                self.workers[self.workers.index(worker)] = fresh
+        if responsive:
+            worker.stop()
+        else:
+            worker.kill()
+        return fresh
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+'''
+Tests!
+'''
+
+class PoolTest(unittest.TestCase):
+    """Test class for pools of worker processes"""
+    def setUp(self):
+        self.pool = WorkerPool(2, [("square", "(lambda (x) (* x x))")], 3)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def pids(self):
+        return set(worker.process.pid for worker in self.pool.workers)
+
+    def test_run(self):
+        self.assertEqual(self.pool.run("(map square (list 1 2 3))"), [1, 4, 9])
+        self.assertRaises(LispCompilationException, self.pool.run, "(f 1)")
+        self.assertRaises(LispRuntimeException, self.pool.run, "(car 1)")
+        self.assertFalse(os.getpid() in self.pids())
+
+    def test_threads(self):
+        results = []
+        def client(i):
+            results.append(self.pool.run("(square " + str(i) + ")"))
+        threads = [
+            threading.Thread(target=client, args=(i,)) for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [i * i for i in range(20)])
+
+    def test_recycling(self):
+        pids = self.pids()
+        for i in range(6):
+            self.pool.run("1")
+        self.assertEqual(len(self.pids() & pids), 0)
+
+        pids = self.pids()
+        loop = "(loop ((i 0)) (if (< i 100) (recur (+ i 1)) i))"
+        self.assertEqual(self.pool.run(loop, maxSteps=1000), 100)
+        self.assertRaises(
+            LispRuntimeException,
+            self.pool.run, loop, maxSteps=10
+        )
+        self.assertEqual(len(self.pids() & pids), 1)
+
+        pool = WorkerPool(1, maxMemory=1)
+        pid = pool.workers[0].process.pid
+        self.assertEqual(pool.run("2"), 2)
+        self.assertNotEqual(pool.workers[0].process.pid, pid)
+        pool.close()
+
+    def test_died(self):
+        worker = self.pool.workers[0]
+        worker.process.terminate()
+        worker.process.join()
+        for i in range(2):
+            try:
+                self.pool.run("1")
+            except LispRuntimeException:
+                pass
+        self.assertEqual(self.pool.run("3"), 3)
+        self.assertNotIn(worker, self.pool.workers)
+
+if __name__ == "__main__":
+    unittest.main()
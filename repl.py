@@ -27,6 +27,7 @@ class REPL:
 //      -integer                                                             //
 //      -float                                                               //
 //      -symbol                                                              //
+//      -string                                                              //
 //      -list/cons                                                           //
 //      -boolean                                                             //
 //      -lambda function                                                     //
@@ -37,13 +38,41 @@ class REPL:
 //      -function currying                                                   //
 //      -if branches                                                         //
 //      -cond blocks                                                         //
+//      -case blocks, dispatching on literal keys in a single lookup         //
+//      -';' line comments                                                   //
+//      -loop/recur iteration                                                //
+//      -native list functions (foldl, foldr, filter, length, append,        //
+//       reverse, nth, sum)                                                  //
+//      -lazy streams (range, stream-map, stream-filter, take, reduce,       //
+//       force)                                                              //
+//      -vectors with shared slices (vector, vector-ref, vector-length,      //
+//       vector-slice, vector->list)                                         //
+//      -persistent hash maps (hash, hash-ref, hash-set, hash-has?,          //
+//       hash-keys)                                                          //
+//      -source files of (define name expr) forms, loaded with               //
+//       Interpreter.require or (require name), and cached compiled in       //
+//       __lispcache__                                                       //
+//      -memory-mapped data files read lazily into streams (read-data,       //
+//       only for interpreters given a dataRoot directory to read under)     //
+//      -pool of pre-forked interpreter worker processes (pool.WorkerPool)   //
+//      -optional metrics (metrics.Metrics): phase latency histograms,       //
+//       exception counts, allocations and evaluation depth, dumped in       //
+//       Prometheus format                                                   //
+//      -strings concatenated as ropes (string-append, substring,            //
+//       string-length, string-join) and built piecewise (string-builder,    //
+//       builder-add, builder->string)                                       //
+//      -results streamed to a file as JSON or s-expressions                 //
+//       (Interpreter.write), in constant memory however large they are      //
+//      -compile-time type inference: arithmetic, conditionals and calls     //
+//       proven well-typed skip their runtime checks, and proven type        //
+//       errors are reported before evaluation                               //
+//      -batches evaluating one expression over columns of parameter values  //
+//       (Interpreter.batch), a whole column at a time where possible        //
 //  Missing Features:                                                        //
 //      -global definitions                                                  //
 //      -recursive bindings without using a Y-combinator                     //
 //      -lazy evaluation                                                     //
 //      -arbitrary number of arguments for functions like + and or           //
-//      -tests for the parser (I was tired and lazy writing that bit)        //
-//      -parser error handling (same reason as above)                        //
 //      -(help) and (exit) functions                                         //
 //                                                                           //
 ///////////////////////////////////////////////////////////////////////////////
@@ -0,0 +1,183 @@
+import sys
+import time
+import threading
+import unittest
+from contextlib import contextmanager
+from lisp_exceptions import LispRuntimeException
+
+'''
+Mutable state belonging to a single evaluation
+'''
+
+class Budget(object):
+    """Limits on the work a single evaluation may perform"""
+    # Number of steps between checks of the clock and the cancellation flag
+    checkInterval = 1000
+    # Number of steps between calls to a probe; see watch
+    probeInterval = 64
+
+    def __init__(self, maxSteps=None, maxAllocs=None, deadline=None,
+            cancel=None):
+        # deadline is a time.time() value and cancel a threading.Event
+        self.maxSteps, self.maxAllocs = maxSteps, maxAllocs
+        self.deadline, self.cancel = deadline, cancel
+
+        # Called whenever the clock and flag are polled; see watch
+        self.probe = None
+
+        # Allowances are counted down so that the evaluator only needs a
+        # decrement and a comparison per step. Steps are handed out in chunks
+        # from the reserve whenever the clock or flag has to be polled
+        self.reserve = sys.maxint if maxSteps is None else maxSteps
+        self.steps = 0
+        self.refill()
+        self.allocs = sys.maxint if maxAllocs is None else maxAllocs
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Budget(" + str(self.maxSteps) + ", " + str(self.maxAllocs) + ")"
+
+    def refill(self):
+        chunk = self.reserve
+        if self.probe is not None:
+            chunk = min(chunk, self.probeInterval)
+        elif self.deadline is not None or self.cancel is not None:
+            chunk = min(chunk, self.checkInterval)
+        self.steps += chunk
+        self.reserve -= chunk
+
+    def alloc(self, count):
+        self.allocs -= count
+        if self.allocs < 0:
+            raise LispRuntimeException(
+                "eval",
+                "allocation limit of " + str(self.maxAllocs) + " exceeded"
+            )
+
+    def watch(self, probe):
+        # Call probe every probeInterval steps from now on, or stop if probe
+        # is None. The steps handed out so far are returned to the reserve
+        # so that the new interval takes effect at once
+        self.probe = probe
+        if self.steps > 0:
+            self.reserve += self.steps
+            self.steps = 0
+        self.refill()
+
+    def exceeded(self):
+        # Whether the evaluation charged to this budget was stopped by one of
+        # its limits
+        return self.allocs < 0 or self.steps < 0 and self.reserve <= 0 or \
+            self.deadline is not None and time.time() > self.deadline or \
+            self.cancel is not None and self.cancel.is_set()
+
+    def exhausted(self):
+        # Called once the step countdown has gone negative
+        if self.probe is not None:
+            self.probe()
+        if self.reserve <= 0:
+            raise LispRuntimeException(
+                "eval",
+                "step limit of " + str(self.maxSteps) + " exceeded"
+            )
+        elif self.deadline is not None and time.time() > self.deadline:
+            raise LispRuntimeException("eval", "timed out")
+        elif self.cancel is not None and self.cancel.is_set():
+            raise LispRuntimeException("eval", "cancelled")
+        else:
+            self.refill()
+
+class State(threading.local):
+    """Per-thread evaluation state"""
+    def __init__(self):
+        self.budget = Budget()
+        self.tiering = None
+
+# Evaluation state of the current thread; the evaluator charges its steps
+# (function applications) and allocations (cons cells) to state.budget and
+# promotes hot functions as directed by state.tiering
+state = State()
+
+@contextmanager
+def charging(budget, tiering=None):
+    # Charge the evaluation performed within the block to budget; lazy values
+    # compute their elements whenever they are pulled, so pulling them needs
+    # a budget just as evaluating them does
+    outer = state.budget, state.tiering
+    state.budget, state.tiering = budget, tiering
+    try:
+        yield budget
+    finally:
+        state.budget, state.tiering = outer
+
+'''
+Tests!
+'''
+
+class BudgetTest(unittest.TestCase):
+    """Test class for evaluation budgets"""
+    def test_alloc(self):
+        budget = Budget(maxAllocs=10)
+        budget.alloc(10)
+        self.assertFalse(budget.exceeded())
+        self.assertRaises(LispRuntimeException, budget.alloc, 1)
+        self.assertTrue(budget.exceeded())
+
+    def test_steps(self):
+        budget = Budget(maxSteps=2500)
+        for i in range(2500):
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+        budget.steps -= 1
+        self.assertRaises(LispRuntimeException, budget.exhausted)
+        self.assertTrue(budget.exceeded())
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        budget = Budget(cancel=cancel)
+        budget.steps = -1
+        budget.exhausted()
+        cancel.set()
+        budget.steps = -1
+        self.assertRaises(LispRuntimeException, budget.exhausted)
+
+        budget = Budget(deadline=time.time() - 1)
+        budget.steps = -1
+        self.assertRaises(LispRuntimeException, budget.exhausted)
+
+    def test_watch(self):
+        calls = []
+        budget = Budget(maxSteps=5000)
+        budget.steps -= 500
+        budget.watch(lambda: calls.append(budget.reserve))
+        for i in range(4000):
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+        self.assertEqual(len(calls), 62)
+        self.assertEqual(calls[:2], [4436, 4372])
+        budget.watch(None)
+        self.assertEqual(budget.reserve, 0)
+
+    def test_unlimited(self):
+        budget = Budget()
+        budget.alloc(10 ** 6)
+        self.assertTrue(budget.steps > 0 and budget.allocs > 0)
+
+    def test_thread_local(self):
+        budgets = []
+        thread = threading.Thread(target=lambda: budgets.append(state.budget))
+        thread.start()
+        thread.join()
+        self.assertFalse(budgets[0] is state.budget)
+
+    def test_charging(self):
+        outer, budget = state.budget, Budget()
+        with charging(budget):
+            self.assertIs(state.budget, budget)
+        self.assertIs(state.budget, outer)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import sys
+import unittest
+from lisp_exceptions import LispRuntimeException
+from core import *
+from val import *
+import runtime
+
+'''
+Promotion of frequently called functions from tree-walking to Python code
+'''
+
+class Tiering(object):
+    """Policy deciding when a function is compiled to Python code"""
+    def __init__(self, threshold=1000, hook=None):
+        # hook, if given, is called with each CFun once it has been promoted
+        self.threshold, self.hook = threshold, hook
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "Tiering(" + str(self.threshold) + ")"
+
+    def observe(self, fun):
+        # A CFun starts out with no countdown, since the threshold is only
+        # known once it is called; the first call starts the countdown and
+        # the call which exhausts it promotes the function
+        if not fun.counting:
+            fun.counting = True
+            fun.countdown = self.threshold - 1
+        else:
+            fun.countdown = sys.maxint
+            if self.promote(fun) and self.hook is not None:
+                self.hook(fun)
+
+    def promote(self, fun):
+        # Calls are entered by CCall.eval's loop, and functions returning
+        # functions gain nothing, so neither kind of body is compiled
+        if type(fun.body) in (CCall, CFun, CCompiled):
+            return False
+        code = CodeGen().function(fun.body)
+        fun.body = CCompiled(code, fun.body)
+        return True
+
+def truth(b):
+    # Test a condition the way CIf does
+    if b is True or b is False:
+        return b
+    elif type(b) is BoolV:
+        return b.state
+    else:
+        raise LispRuntimeException(
+            "eval",
+            "expected a boolean but got " + str(b)
+        )
+
+def fetch(glob):
+    # Value of a global, which may still be undefined
+    return CGlobal(glob).eval(None)
+
+class CodeGen(object):
+    """Translator of core expressions into a Python lambda over an env"""
+    # Deeper subexpressions are left to the tree-walker, keeping both this
+    # translation and Python's parser clear of their recursion limits
+    maxDepth = 16
+
+    # Python operator for each primitive of a CNumOp
+    symbols = {
+        "+": "+",
+        "-": "-",
+        "*": "*",
+        "/": "/",
+        "eq?": "==",
+        ">": ">",
+        ">=": ">=",
+        "<": "<",
+        "<=": "<="
+    }
+
+    def __init__(self):
+        self.namespace = {
+            "truth": truth,
+            "fetch": fetch,
+            "call": CCall.apply,
+            "car": CCar.of,
+            "cdr": CCdr.of,
+            "FunV": FunV,
+            "SymV": SymV
+        }
+
+    def constant(self, value):
+        name = "k" + str(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def function(self, body):
+        return eval("lambda env: " + self.expr(body, 0), self.namespace)
+
+    def expr(self, cexpr, depth):
+        t, depth = type(cexpr), depth + 1
+        if depth > self.maxDepth:
+            return self.constant(cexpr) + ".eval(env)"
+        elif t is CNum and type(cexpr.value) in (int, long):
+            return "(" + repr(cexpr.value) + ")"
+        elif t is CNum:
+            return self.constant(cexpr.value)
+        elif t is CBool:
+            return repr(cexpr.state)
+        elif t is CRef:
+            return "env[" + str(cexpr.idx) + "]"
+        elif t is CGlobal:
+            glob = self.constant(cexpr.glob)
+            return "(" + glob + ".value or fetch(" + glob + "))"
+        elif t is CStr:
+            return self.constant(cexpr.value)
+        elif t is CSym:
+            return "SymV(" + repr(cexpr.name) + ")"
+        elif t is CIfBool:
+            return "(" + self.expr(cexpr.ifBranch, depth) + \
+                " if " + self.expr(cexpr.cond, depth) + \
+                " else " + self.expr(cexpr.elseBranch, depth) + ")"
+        elif t is CIf:
+            return "(" + self.expr(cexpr.ifBranch, depth) + \
+                " if truth(" + self.expr(cexpr.cond, depth) + ")" + \
+                " else " + self.expr(cexpr.elseBranch, depth) + ")"
+        elif t is CCar:
+            return "car(" + self.expr(cexpr.pair, depth) + ")"
+        elif t is CCdr:
+            return "cdr(" + self.expr(cexpr.pair, depth) + ")"
+        elif t is CPrimOp:
+            return self.constant(cexpr.op) + "(" + ", ".join(
+                self.expr(arg, depth) for arg in cexpr.argExprs
+            ) + ")"
+        elif t is CNumOp:
+            return "(" + self.expr(cexpr.left, depth) + " " + \
+                self.symbols[cexpr.name] + " " + \
+                self.expr(cexpr.right, depth) + ")"
+        elif t is CCallFun:
+            return self.expr(cexpr.funExpr, depth) + ".apply(" + \
+                self.expr(cexpr.argExpr, depth) + ")"
+        elif t is CCall:
+            return "call(" + self.expr(cexpr.funExpr, depth) + ", " + \
+                self.expr(cexpr.argExpr, depth) + ")"
+        elif t is CLet:
+            return "(lambda env: " + self.expr(cexpr.body, depth) + ")(" + \
+                "[" + self.expr(cexpr.expr, depth) + "] + env)"
+        elif t is CFun:
+            return "FunV(" + self.constant(cexpr) + ", env)"
+        else:
+            # Loops, conses and anything else keep being tree-walked
+            return self.constant(cexpr) + ".eval(env)"
+
+'''
+Tests!
+'''
+
+class TieringTest(unittest.TestCase):
+    """Test class for promotion to compiled code"""
+    def setUp(self):
+        self.promoted = []
+        self.tiering = Tiering(10, self.promoted.append)
+        self.add = lambda x, y: x + y
+
+    def call(self, fval, argVal):
+        with runtime.charging(runtime.Budget(), self.tiering):
+            return CCall.apply(fval, argVal)
+
+    def test_threshold(self):
+        fun = CFun(CPrimOp("+", self.add, [CRef(0), CNum(1)]))
+        fval = fun.eval([])
+        results = [self.call(fval, i) for i in range(20)]
+        self.assertEqual(results, range(1, 21))
+        self.assertEqual(self.promoted, [fun])
+        self.assertIs(type(fun.body), CCompiled)
+
+    def test_codegen(self):
+        body = CIf(
+            CPrimOp("<", lambda x, y: x < y, [CRef(0), CNum(2.5)]),
+            CCar(CRef(1)),
+            CCall(CFun(CSym("x")), CBool(False))
+        )
+        code = CodeGen().function(body)
+        env = [1, ConsV(7, False)]
+        self.assertEqual(code(env), body.eval(env))
+        env = [3, False]
+        self.assertEqual(code(env), body.eval(env))
+        body = CLet(CNum(4), CCons(CRef(0), CRef(1)))
+        self.assertEqual(CodeGen().function(body)([False]), ConsV(4, False))
+        code = CodeGen().function(CIf(CRef(0), CNum(1), CNum(2)))
+        self.assertEqual(code([BoolV(False)]), 2)
+        self.assertRaises(LispRuntimeException, code, [5])
+
+    def test_deep(self):
+        body = CRef(0)
+        for i in range(500):
+            body = CPrimOp("+", self.add, [CNum(1), body])
+        self.assertEqual(CodeGen().function(body)([0]), 500)
+
+    def test_untiered(self):
+        fun = CFun(CCall(CFun(CRef(0)), CRef(0)))
+        fval = fun.eval([])
+        for i in range(20):
+            self.call(fval, i)
+        self.assertNotIn(fun, self.promoted)
+        self.assertIs(type(fun.body), CCall)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,15 @@
 from abc import ABCMeta, abstractmethod
 from numbers import Number
+import runtime
 
 '''
 Possible final result values of a Lisp expression
 '''
 
+# Python types which flow through the evaluator as-is; they are only boxed into
+# a Val at boundaries such as normalization
+UNBOXED = frozenset([int, long, float, bool])
+
 class Val:
     """Lisp value type"""
     __metaclass__ = ABCMeta
@@ -30,25 +35,59 @@ class Val:
 
     @staticmethod
     def wrap(prim):
-        if issubclass(type(prim), Val):
-            # Anything that's already a valid type
-            return prim
-        elif type(prim) is bool:
+        # Box a native Python object, including unboxed evaluator values
+        if type(prim) is bool:
             # Boolean values
             return BoolV(prim)
-        if issubclass(type(prim), Number):
+        elif type(prim) in UNBOXED:
             # Numeric types
             return NumV(prim)
+        elif isinstance(prim, Val):
+            # Anything that's already a valid type
+            return prim
+        elif isinstance(prim, Number):
+            # Other numeric types
+            return NumV(prim)
+        elif type(prim) is str:
+            # Strings
+            return StrV(prim)
         elif type(prim) is list:
             # Cons list
-            if len(prim) == 0:
-                return BoolV(False)
-            else:
-                return ConsV(Val.wrap(prim[0]), Val.wrap(prim[1:]))
+            return Val.fromList(map(Val.wrap, prim))
         else:
             # Lambda functions
             return PrimFunV(prim)
 
+    @staticmethod
+    def lift(prim):
+        # Convert a native Python object into an evaluator value, leaving
+        # numbers and booleans unboxed
+        if type(prim) in UNBOXED or isinstance(prim, (Val, Number)):
+            return prim
+        elif type(prim) is str:
+            return StrV(prim)
+        elif type(prim) is list:
+            return Val.fromList(map(Val.lift, prim))
+        else:
+            return PrimFunV(prim)
+
+    @staticmethod
+    def unbox(val):
+        # Convert an evaluator value into a native Python object
+        if type(val) in UNBOXED or not isinstance(val, Val):
+            return val
+        else:
+            return val.unwrap()
+
+    @staticmethod
+    def fromList(vals):
+        # Build a cons list out of evaluator values
+        runtime.state.budget.alloc(len(vals))
+        lst = False
+        for val in reversed(vals):
+            lst = ConsV(val, lst)
+        return lst
+
 class BoolV(Val):
     """Boolean value"""
     def __init__(self, state):
@@ -59,6 +98,12 @@ class BoolV(Val):
     def __repr__(self):
         return "t" if self.state else "nil"
 
+    def __eq__(self, other):
+        if type(other) in UNBOXED:
+            return self.state == other
+        else:
+            return Val.__eq__(self, other)
+
     def unwrap(self):
         return self.state
 
@@ -72,6 +117,12 @@ class NumV(Val):
     def __repr__(self):
         return str(self.num)
 
+    def __eq__(self, other):
+        if type(other) in UNBOXED:
+            return self.num == other
+        else:
+            return Val.__eq__(self, other)
+
     def unwrap(self):
         return self.num
 
@@ -86,10 +137,12 @@ class ConsV(Val):
         return "(cons " + repr(self.head) + " "  + repr(self.tail) + ")"
 
     def unwrap(self):
-        if self.tail.unwrap():
-            return [self.head] + self.tail.unwrap()
-        else:
-            return [self.head]
+        # Walk the chain iteratively; long lists would overflow the stack
+        elements, lst = [], self
+        while type(lst) is ConsV:
+            elements.append(lst.head)
+            lst = lst.tail
+        return elements
 
     def normalize(self):
         return [
@@ -97,6 +150,90 @@ class ConsV(Val):
             for v in self.unwrap()
         ]
 
+class StreamV(Val):
+    """Lazy sequence of values"""
+    def __init__(self, factory):
+        # factory returns a fresh iterator over the elements, so that a stream
+        # can be traversed any number of times without being materialized
+        self.factory = factory
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "[stream]"
+
+    def __iter__(self):
+        # Each element is charged a step as it is produced, so that however a
+        # stream is consumed (by natives, car and cdr, or normalization) the
+        # limits bound its iteration even where no function is applied
+        budget = runtime.state.budget
+        for x in self.factory():
+            budget.steps -= 1
+            if budget.steps < 0:
+                budget.exhausted()
+            yield x
+
+    def unwrap(self):
+        return list(self)
+
+    def normalize(self):
+        return [
+            v.normalize() if issubclass(type(v), Val) else v
+            for v in self
+        ]
+
+class VectorV(Val):
+    """Fixed-size sequence of values with constant-time indexing"""
+    def __init__(self, items, start=0, end=None):
+        # A vector is a view of items[start:end]; slices share the items of
+        # the vector they were taken from rather than copying them
+        self.items, self.start = items, start
+        self.end = len(items) if end is None else end
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "(vector " + " ".join(repr(v) for v in self) + ")"
+
+    def __iter__(self):
+        items = self.items
+        for i in xrange(self.start, self.end):
+            yield items[i]
+
+    def unwrap(self):
+        return [Val.unbox(v) for v in self]
+
+    def normalize(self):
+        return [
+            v.normalize() if issubclass(type(v), Val) else v
+            for v in self
+        ]
+
+class HashV(Val):
+    """Persistent hash map from numbers or symbols to values"""
+    def __init__(self, pmap):
+        self.pmap = pmap
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "(hash " + " ".join(
+            "(" + repr(k) + " " + repr(v) + ")"
+            for k, v in self.pmap.iteritems()
+        ) + ")"
+
+    def unwrap(self):
+        return dict(
+            (Val.unbox(k), Val.unbox(v)) for k, v in self.pmap.iteritems()
+        )
+
+    def normalize(self):
+        return dict(
+            (k.normalize() if issubclass(type(k), Val) else k,
+             v.normalize() if issubclass(type(v), Val) else v)
+            for k, v in self.pmap.iteritems()
+        )
+
 class SymV(Val):
     """Symbol value"""
     def __init__(self, name):
@@ -107,23 +244,144 @@ class SymV(Val):
     def __repr__(self):
         return "'" + self.name
 
+    def __hash__(self):
+        # Symbols are used as hash keys, so equal symbols must hash alike
+        return hash(self.name)
+
     def unwrap(self):
         return "'" + self.name
 
+class StrV(Val):
+    """String value. Concatenations form a rope, flattened when first read"""
+    # Concatenations of strings this short are copied rather than roped
+    leafSize = 64
+
+    def __init__(self, text, pieces=()):
+        # A rope has no text until it is flattened; until then its pieces are
+        # the strings it concatenates, in order
+        self.text, self.pieces = text, pieces
+        if text is None:
+            self.length = sum(piece.length for piece in pieces)
+        else:
+            self.length = len(text)
+
+    def __str__(self):
+        return "StrV(" + repr(self) + ")"
+    def __repr__(self):
+        text = self.flatten().replace("\\", "\\\\").replace('"', '\\"')
+        return '"' + text.replace("\n", "\\n") + '"'
+
+    def __eq__(self, other):
+        if type(other) is StrV:
+            return self.length == other.length and \
+                self.flatten() == other.flatten()
+        else:
+            return False
+
+    def __hash__(self):
+        # Strings are used as hash keys, so equal strings must hash alike
+        return hash(self.flatten())
+
+    @staticmethod
+    def charge(length):
+        # Text is charged to the budget in proportion to its length, one
+        # allocation for each leafSize characters besides the string itself,
+        # before it is built
+        runtime.state.budget.alloc(1 + length // StrV.leafSize)
+
+    @staticmethod
+    def concat(left, right):
+        # Strings are never modified, so either side may be shared with other
+        # strings; only a node referring to both is allocated. Its text is
+        # charged when it is flattened
+        if left.length == 0:
+            return right
+        elif right.length == 0:
+            return left
+        elif left.text is not None and right.text is not None and \
+                left.length + right.length <= StrV.leafSize:
+            StrV.charge(left.length + right.length)
+            return StrV(left.text + right.text)
+        else:
+            runtime.state.budget.alloc(1)
+            return StrV(None, (left, right))
+
+    def flatten(self):
+        # Text of the string. A rope is walked iteratively, however deep, and
+        # keeps its text so that it is only ever flattened once
+        if self.text is None:
+            StrV.charge(self.length)
+            parts, stack = [], [self]
+            while len(stack) > 0:
+                node = stack.pop()
+                if node.text is not None:
+                    parts.append(node.text)
+                else:
+                    stack.extend(reversed(node.pieces))
+            self.text, self.pieces = "".join(parts), ()
+        return self.text
+
+    def unwrap(self):
+        return self.flatten()
+
+class BuilderV(Val):
+    """String under construction, to which pieces are added in constant time"""
+    def __init__(self, piece, rest=None):
+        # Builders are persistent: adding a piece makes a new builder which
+        # shares every piece of the old one
+        self.piece, self.rest = piece, rest
+        self.length = piece.length + (0 if rest is None else rest.length)
+        self.built = None
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "[string builder]"
+
+    def add(self, piece):
+        return BuilderV(piece, self)
+
+    def build(self):
+        # The pieces are joined in one pass, the first time they are needed
+        if self.built is None:
+            StrV.charge(self.length)
+            parts, builder = [], self
+            while builder is not None:
+                parts.append(builder.piece.flatten())
+                builder = builder.rest
+            parts.reverse()
+            self.built = StrV("".join(parts))
+        return self.built
+
+    def unwrap(self):
+        return self.build().flatten()
 
 class FunV(Val):
     """Function value"""
-    def __init__(self, body, env):
-        self.body, self.env = body, env
+    def __init__(self, fun, env):
+        # fun is the CFun the function was created by, whose body may be
+        # replaced by a faster tier once it has been called often enough
+        self.fun, self.env = fun, env
 
     def __str__(self):
         return repr(self)
     def __repr__(self):
         return "[user-defined function]"
 
+    def apply(self, argVal):
+        budget = runtime.state.budget
+        budget.steps -= 1
+        if budget.steps < 0:
+            budget.exhausted()
+
+        fun = self.fun
+        fun.countdown -= 1
+        if fun.countdown < 0:
+            fun.hot()
+        return fun.body.eval([argVal] + self.env)
+
     def unwrap(self):
-        return lambda argVal: \
-            self.body.eval([argVal] + self.env)
+        return self.apply
 
 class PrimFunV(Val):
     """Primitive (native) function value"""
@@ -135,6 +393,20 @@ class PrimFunV(Val):
     def __repr__(self):
         return "[native function]"
 
+    def apply(self, argVal):
+        return Val.lift(self.thunk(Val.unbox(argVal)))
+
     def unwrap(self):
-        return lambda argVal: \
-            Val.wrap(self.thunk(argVal.unwrap()))
\ No newline at end of file
+        return self.apply
+
+class NativeFunV(PrimFunV):
+    """Primitive (native) operation over evaluator values, curried"""
+    def __init__(self, arity, op, args=()):
+        self.arity, self.op, self.args = arity, op, args
+
+    def apply(self, argVal):
+        args = self.args + (argVal,)
+        if len(args) == self.arity:
+            return self.op(*args)
+        else:
+            return NativeFunV(self.arity, self.op, args)
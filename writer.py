@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from abc import ABCMeta, abstractmethod
+from cStringIO import StringIO
+from lisp_exceptions import LispRuntimeException
+from val import *
+from pmap import PMap
+import data
+
+'''
+Iterative traversal of result values, for normalizing them or streaming them
+to a file without building them in memory
+'''
+
+# Kinds of events produced by walk
+OPEN, CLOSE, KEY, ATOM = "open", "close", "key", "atom"
+
+# Kinds of containers, given with OPEN and CLOSE events. Each entry of a hash
+# is closed once its value is complete
+LIST, HASH, ENTRY = "list", "hash", "entry"
+
+def walk(val):
+    # Events describing val in order: (OPEN, kind) and (CLOSE, kind) around
+    # the items of a list or the entries of a hash, (KEY, key) opening each
+    # entry, and (ATOM, value) for everything else. Nesting is tracked on a
+    # stack of iterators rather than by recursion, and streams are only
+    # traversed as their events are consumed
+    stack = [(iter([val]), LIST)]
+    while True:
+        items, kind = stack[-1]
+        try:
+            item = next(items)
+        except StopIteration:
+            stack.pop()
+            if len(stack) == 0:
+                return
+            yield CLOSE, kind
+            continue
+
+        if kind is HASH:
+            key, item = item
+            stack.append((iter([item]), ENTRY))
+            yield KEY, key
+            continue
+
+        t = type(item)
+        if t is ConsV:
+            stack.append((conses(item), LIST))
+            yield OPEN, LIST
+        elif t is StreamV or t is VectorV:
+            stack.append((iter(item), LIST))
+            yield OPEN, LIST
+        elif t is HashV:
+            stack.append((item.pmap.iteritems(), HASH))
+            yield OPEN, HASH
+        else:
+            yield ATOM, item
+
+def conses(lst):
+    # Heads of a cons list; as with ConsV.unwrap, an improper tail is dropped
+    while type(lst) is ConsV:
+        yield lst.head
+        lst = lst.tail
+
+def atom(val):
+    # Normalized form of a value which is not a list or hash
+    if type(val) in UNBOXED:
+        return val
+    return Val.wrap(val).normalize()
+
+def normalize(val):
+    # Same as Val.wrap(val).normalize(), but however deeply val is nested
+    stack, keys = [[]], []
+    for event, value in walk(val):
+        if event is OPEN:
+            stack.append([] if value is LIST else {})
+            continue
+        elif event is KEY:
+            keys.append(atom(value))
+            continue
+        elif event is CLOSE:
+            if value is ENTRY:
+                keys.pop()
+                continue
+            value = stack.pop()
+        else:
+            value = atom(value)
+
+        top = stack[-1]
+        if type(top) is list:
+            top.append(value)
+        else:
+            top[keys[-1]] = value
+    return stack[0][0]
+
+class Writer:
+    """Serializer streaming a value's events to a file"""
+    __metaclass__ = ABCMeta
+
+    # Characters buffered before they are written out
+    bufferSize = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, val):
+        # The output is built in a bounded buffer, so memory use depends only
+        # on how deeply val is nested
+        f, size, parts, count = self.f, self.bufferSize, [], 0
+        previous = OPEN
+        for event, value in walk(val):
+            if event is CLOSE:
+                text = self.close(value)
+            else:
+                # Items are separated, but neither the first item of a
+                # container nor the value of an entry is preceded by one
+                text = "" if previous is OPEN or previous is KEY \
+                    else self.separator
+                if event is OPEN:
+                    text += self.open(value)
+                elif event is KEY:
+                    text += self.key(value)
+                else:
+                    text += self.atom(value)
+            previous = event
+
+            parts.append(text)
+            count += len(text)
+            if count >= size:
+                f.write("".join(parts))
+                parts, count = [], 0
+        f.write("".join(parts))
+
+    @abstractmethod
+    def open(self, kind):
+        pass
+
+    @abstractmethod
+    def close(self, kind):
+        pass
+
+    @abstractmethod
+    def key(self, key):
+        pass
+
+    @abstractmethod
+    def atom(self, val):
+        pass
+
+class JSONWriter(Writer):
+    """Writer of JSON: lists become arrays and hashes objects"""
+    separator = ", "
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "JSONWriter(" + repr(self.f) + ")"
+
+    def open(self, kind):
+        return "[" if kind is LIST else "{"
+
+    def close(self, kind):
+        return {LIST: "]", HASH: "}", ENTRY: ""}[kind]
+
+    def key(self, key):
+        # Object keys must be strings, so other keys are written as they would
+        # be as values
+        key = atom(key)
+        if type(key) is not str:
+            key = json.dumps(key)
+        return json.dumps(key) + ": "
+
+    def atom(self, val):
+        t = type(val)
+        if t is int or t is long:
+            return str(val)
+        elif t is bool:
+            return "true" if val else "false"
+        return json.dumps(atom(val))
+
+class SexpWriter(Writer):
+    """Writer of s-expression data, as read back by read-data"""
+    separator = " "
+
+    def __str__(self):
+        return repr(self)
+    def __repr__(self):
+        return "SexpWriter(" + repr(self.f) + ")"
+
+    def open(self, kind):
+        return "("
+
+    def close(self, kind):
+        return ")"
+
+    def key(self, key):
+        # A hash is written as a list of (key value) lists
+        return "(" + self.atom(key) + " "
+
+    def atom(self, val):
+        t = type(val)
+        if t is bool or t is BoolV:
+            return "t" if val == True else "nil"
+        elif t is int or t is long:
+            return str(val)
+        elif t is float or t is NumV or t is SymV or t is StrV:
+            return repr(val)
+        else:
+            # Functions and other opaque values are written as descriptions
+            return repr(StrV(str(atom(val))))
+
+# Writers by the name of their format
+FORMATS = {
+    "json": JSONWriter,
+    "sexp": SexpWriter
+}
+
+def formatWriter(format):
+    writer = FORMATS.get(format)
+    if writer is None:
+        raise LispRuntimeException(
+            "write",
+            "unknown output format " + repr(format) + "; expected one of " + \
+            ", ".join(sorted(FORMATS.keys()))
+        )
+    return writer
+
+def write(val, f, format="json"):
+    # Stream val to the file f in the named format
+    formatWriter(format)(f).write(val)
+
+'''
+Tests!
+'''
+
+class WriterTest(unittest.TestCase):
+    """Test class for traversing and writing values"""
+    def setUp(self):
+        pmap = PMap().set(SymV("k"), Val.fromList([1, StrV("a\"b")]))
+        self.val = Val.fromList([1, 2.5, True, False, SymV("s"), HashV(pmap)])
+
+    def written(self, val, format):
+        out = StringIO()
+        write(val, out, format)
+        return out.getvalue()
+
+    def test_normalize(self):
+        self.assertEqual(normalize(self.val), Val.wrap(self.val).normalize())
+        self.assertEqual(normalize(7), 7)
+
+        # Nesting far deeper than the Python stack allows
+        deep = False
+        for i in range(100000):
+            deep = ConsV(deep, False)
+        depth, lst = 0, normalize(deep)
+        while lst is not False:
+            depth, lst = depth + 1, lst[0]
+        self.assertEqual(depth, 100000)
+
+    def test_json(self):
+        self.assertEqual(
+            json.loads(self.written(self.val, "json")),
+            [1, 2.5, True, False, "'s", {"'k": [1, "a\"b"]}]
+        )
+        self.assertEqual(self.written(Val.fromList([]), "json"), "false")
+        self.assertEqual(
+            self.written(VectorV([StreamV(lambda: iter([])), 1]), "json"),
+            "[[], 1]"
+        )
+
+    def test_sexp(self):
+        text = self.written(self.val, "sexp")
+        self.assertEqual(text, '(1 2.5 t nil \'s ((\'k (1 "a\\"b"))))')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "out.sexp")
+            with open(path, "w") as f:
+                write(self.val, f, "sexp")
+            self.assertEqual(
+                data.read(path).normalize(),
+                [[1, 2.5, True, False, "'s", [["'k", [1, "a\"b"]]]]]
+            )
+        finally:
+            shutil.rmtree(directory)
+        self.assertRaises(LispRuntimeException, self.written, self.val, "xml")
+
+if __name__ == "__main__":
+    unittest.main()